@@ -0,0 +1 @@
+# MyExpense benchmarks, run with: python -m myexpense.benchmarks.<name>
@@ -0,0 +1,99 @@
+# benchmarks/analytics.py
+"""Milliseconds per report for one user, comparing the SQL path with the
+NumPy columns of project.models.analytics, cold (columns loaded) and warm
+(columns cached).
+
+    python -m myexpense.benchmarks.analytics --expenses 200000 --users 10 --repeat 5
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from sqlalchemy.sql import func
+
+from myexpense import project
+from myexpense.benchmarks import data
+from myexpense.project.models import analytics
+from myexpense.project.models.balance import Balance, BalanceSeries, series_dates
+from myexpense.project.models.account import Account
+from myexpense.project.models.expense import Expense
+
+def sql_category_stats(user_id, from_date, to_date):
+    """Totals grouped in SQL, percentiles over the amounts fetched per category"""
+    query = Expense.query.join(Account, Account.account_id == Expense.account_id).filter(Expense.user_id == user_id, Account.has_plafond == False, Expense.date.between(from_date, to_date))
+    stats = []
+    for category, total, count in query.with_entities(Expense.category, func.sum(Expense.amount), func.count(Expense.expense_id)).group_by(Expense.category).order_by(Expense.category):
+        amounts = [a for a, in query.with_entities(Expense.amount).filter(Expense.category == category).order_by(Expense.amount)]
+        item = {'category': category, 'count': count, 'total': int(total), 'min': amounts[0], 'max': amounts[-1]}
+        for p in analytics.PERCENTILES:
+            position = (len(amounts) - 1) * p / 100.0
+            low = int(position)
+            high = min(low + 1, len(amounts) - 1)
+            item['p{}'.format(p)] = amounts[low] + (amounts[high] - amounts[low]) * (position - low)
+        stats.append(item)
+    return stats
+
+def sql_moving_average(user_id, from_date, to_date, window):
+    """Daily totals grouped in SQL, averaged in a Python loop"""
+    first = from_date - datetime.timedelta(days = window - 1)
+    totals = dict(Expense.query.join(Account, Account.account_id == Expense.account_id).with_entities(Expense.date, func.sum(Expense.amount)).filter(Expense.user_id == user_id, Account.has_plafond == False, Expense.date.between(first, to_date)).group_by(Expense.date))
+    days = [first + datetime.timedelta(days = i) for i in range((to_date - first).days + 1)]
+    values = [totals.get(d, 0) for d in days]
+    return [sum(values[i - window + 1:i + 1]) / float(window) for i in range(window - 1, len(values))]
+
+def measure(label, func, repeat, baseline = None):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - started) / repeat * 1000
+    speedup = '{:>8.1f}x'.format(baseline / elapsed) if baseline else ''
+    print('{:<48} {:>10.2f} ms {}'.format(label, elapsed, speedup))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--users', type = int, default = 10)
+    parser.add_argument('--accounts', type = int, default = 3)
+    parser.add_argument('--expenses', type = int, default = 200000)
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--window', type = int, default = 30)
+    args = parser.parse_args()
+
+    app, db = project.app, project.db
+    path = tempfile.mktemp(prefix = 'myexpense-analytics-', suffix = '.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    try:
+        with app.app_context():
+            db.create_all()
+            data.generate(db, users = args.users, accounts = args.accounts, expenses = args.expenses)
+            user_id = 1
+            from_date, to_date = datetime.date(2018, 1, 1), datetime.date(2018, 12, 31)
+            dates = series_dates(from_date, to_date, 'day')
+            print('{:,} expenses for user {}, {} dates'.format(len(analytics.Columns.load(user_id)), user_id, len(dates)))
+
+            def cold(report):
+                return lambda: report(analytics.Columns.load(user_id))
+            warm = analytics.Columns.load(user_id)
+
+            baseline = measure('balance: Balance per date (x{})'.format(len(dates)), lambda: [Balance(user_id, from_date = datetime.date.min, to_date = d) for d in dates], 1)
+            measure('balance: BalanceSeries window query', lambda: BalanceSeries(user_id, from_date, to_date), args.repeat, baseline)
+            measure('balance: numpy cold', cold(lambda c: analytics.balance_at(c, dates)), args.repeat, baseline)
+            measure('balance: numpy warm', lambda: analytics.balance_at(warm, dates), args.repeat, baseline)
+
+            baseline = measure('categories: SQL + per category fetch', lambda: sql_category_stats(user_id, from_date, to_date), args.repeat)
+            measure('categories: numpy cold', cold(lambda c: analytics.category_stats(c, from_date, to_date)), args.repeat, baseline)
+            measure('categories: numpy warm', lambda: analytics.category_stats(warm, from_date, to_date), args.repeat, baseline)
+
+            baseline = measure('moving average: SQL + python loop', lambda: sql_moving_average(user_id, from_date, to_date, args.window), args.repeat)
+            measure('moving average: numpy cold', cold(lambda c: analytics.moving_average(c, from_date, to_date, args.window)), args.repeat, baseline)
+            measure('moving average: numpy warm', lambda: analytics.moving_average(warm, from_date, to_date, args.window), args.repeat, baseline)
+            db.session.remove()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# benchmarks/api.py
+"""Latency percentiles and throughput of the API routes as the data set
+grows, through the Flask test client and a real gunicorn on local SQLite,
+compared with a stored baseline.
+
+    python -m myexpense.benchmarks.api --expenses 10000,100000 --requests 200
+    python -m myexpense.benchmarks.api --driver gunicorn --workers 4 --concurrency 8
+    python -m myexpense.benchmarks.api --save-baseline
+    python -m myexpense.benchmarks.api --compare --tolerance 0.2
+
+--compare exits with status 1 when the p95 of a route regressed by more than
+the tolerance against the baseline of the same driver and data size.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import myexpense
+from myexpense import project
+from myexpense.benchmarks import data
+from myexpense.project.models.balance import balance_cache
+from myexpense.project.users.auth import user_cache
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'api.json')
+
+# name: (method, path, body), path and body are built per request from a
+# seeded random generator, the user id and the accounts of the user
+ROUTES = {
+    'login': ('POST', lambda rng, user_id, accounts: '/auth', lambda user_id: {'username': data.email(user_id), 'password': data.PASSWORD}),
+    'expenses': ('GET', lambda rng, user_id, accounts: '/api/v1/expenses?per_page=20&page={}'.format(rng.randrange(1, 6)), None),
+    'expenses_no_total': ('GET', lambda rng, user_id, accounts: '/api/v1/expenses?per_page=20&include_total=false&page={}'.format(rng.randrange(1, 6)), None),
+    'expenses_cursor': ('GET', lambda rng, user_id, accounts: '/api/v1/expenses?per_page=20&after=', None),
+    'expenses_filtered': ('GET', lambda rng, user_id, accounts: '/api/v1/expenses?per_page=20&category={},{}&amount_min=-5000&sort=-date'.format(rng.choice(data.CATEGORIES), rng.choice(data.CATEGORIES)), None),
+    'search': ('GET', lambda rng, user_id, accounts: '/api/v1/expenses/search?per_page=20&q=' + rng.choice(data.WORDS)[:4], None),
+    'balance': ('GET', lambda rng, user_id, accounts: '/api/v1/balance', None),
+    'account_balance': ('GET', lambda rng, user_id, accounts: '/api/v1/accounts/{}/balance'.format(rng.choice(accounts)), None),
+    'summary': ('GET', lambda rng, user_id, accounts: '/api/v1/reports/summary?group_by=category,month', None),
+}
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+class ClientDriver():
+    """Requests through the Flask test client, in this process"""
+
+    name = 'client'
+    concurrency = 1
+
+    def __init__(self, db_uri, cache):
+        project.app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+        project.app.config['BALANCE_CACHE_ENABLED'] = cache
+        self.client = project.app.test_client()
+
+    def request(self, method, path, headers, body):
+        response = self.client.open(path, method = method, headers = headers, data = json.dumps(body) if body is not None else None, content_type = 'application/json')
+        return response.status_code, response.get_data()
+
+    def close(self):
+        project.db.session.remove()
+
+class GunicornDriver():
+    """Requests over HTTP to a gunicorn started on a free local port"""
+
+    name = 'gunicorn'
+
+    def __init__(self, db_uri, cache, workers = 2, concurrency = 4):
+        self.concurrency = concurrency
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        root = os.path.dirname(os.path.dirname(os.path.abspath(myexpense.__file__)))
+        env = dict(os.environ, MYEXPENSE_BENCH_DB = db_uri, MYEXPENSE_BENCH_CACHE = '1' if cache else '0', PYTHONPATH = root)
+        self.process = subprocess.Popen([
+            sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+            '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(self.port), '--log-level', 'warning',
+            'myexpense.benchmarks.wsgi:app',
+        ], cwd = root, env = env)
+        deadline = time.monotonic() + 60
+        while True:
+            if self.process.poll() is not None:
+                raise SystemExit('gunicorn exited with status {}'.format(self.process.returncode))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout = 1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise SystemExit('gunicorn did not start')
+                time.sleep(0.2)
+
+    def request(self, method, path, headers, body):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout = 60)
+        try:
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+            connection.request(method, path, body = json.dumps(body) if body is not None else None, headers = headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def login(driver, user_id):
+    status, body = driver.request('POST', '/auth', {}, {'username': data.email(user_id), 'password': data.PASSWORD})
+    if status != 200:
+        raise SystemExit('Login of user {} failed with status {}'.format(user_id, status))
+    return json.loads(body.decode('utf-8'))['access_token']
+
+def measure(driver, route, owned, tokens, requests, seed):
+    """Send requests to route, returns the latency percentiles (ms), the
+    throughput (requests/s) and the number of errors"""
+    method, path, body = ROUTES[route]
+    rng = random.Random(seed)
+    users = sorted(owned)
+    calls = []
+    for _ in range(requests):
+        user_id = rng.choice(users)
+        headers = {} if route == 'login' else {'Authorization': 'JWT ' + tokens[user_id]}
+        calls.append((method, path(rng, user_id, owned[user_id]), headers, body(user_id) if body else None))
+
+    def call(args):
+        started = time.perf_counter()
+        status, _ = driver.request(*args)
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(driver.concurrency) as pool:
+        results = list(pool.map(call, calls))
+    wall = time.perf_counter() - started
+    latencies = sorted(elapsed * 1000 for elapsed, status in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for elapsed, status in results if status >= 400),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'rps': requests / wall,
+    }
+
+def seed_database(path, args, expenses):
+    app, db = project.app, project.db
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        owned = data.generate(db, users = args.users, accounts = args.accounts, expenses = expenses, years = args.years, seed = args.seed)
+        db.session.remove()
+    print('seeded {:,} expenses in {:.1f}s'.format(expenses, time.perf_counter() - started))
+    return owned
+
+def compare(results, baseline, tolerance):
+    """Print the p95 change of every route found in the baseline, returns the regressions"""
+    regressions = []
+    for key, result in sorted(results.items()):
+        previous = baseline.get('results', {}).get(key)
+        if previous is None or not previous.get('p95'):
+            continue
+        change = (result['p95'] - previous['p95']) / previous['p95']
+        flag = 'REGRESSION' if change > tolerance else ''
+        print('{:<44} p95 {:>9.2f} -> {:>9.2f} ms {:>+8.1%} {}'.format(key, previous['p95'], result['p95'], change, flag))
+        if flag:
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--users', type = int, default = 10)
+    parser.add_argument('--accounts', type = int, default = 3, help = 'accounts per user, every third one has a plafond')
+    parser.add_argument('--expenses', default = '10000', help = 'comma separated data set sizes')
+    parser.add_argument('--years', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 42)
+    parser.add_argument('--requests', type = int, default = 100, help = 'requests per route')
+    parser.add_argument('--routes', default = ','.join(ROUTES))
+    parser.add_argument('--driver', choices = ('client', 'gunicorn', 'both'), default = 'client')
+    parser.add_argument('--workers', type = int, default = 2, help = 'gunicorn workers')
+    parser.add_argument('--concurrency', type = int, default = 4, help = 'concurrent requests against gunicorn')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'turn the balance cache off')
+    parser.add_argument('--baseline', default = BASELINE)
+    parser.add_argument('--save-baseline', action = 'store_true')
+    parser.add_argument('--compare', action = 'store_true')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed p95 slowdown before --compare fails')
+    args = parser.parse_args()
+
+    routes = [r for r in args.routes.split(',') if r]
+    for route in routes:
+        if route not in ROUTES:
+            parser.error('unknown route: ' + route)
+    drivers = ('client', 'gunicorn') if args.driver == 'both' else (args.driver, )
+    results = {}
+    workdir = tempfile.mkdtemp(prefix = 'myexpense-bench-')
+    try:
+        for expenses in [int(size) for size in args.expenses.split(',')]:
+            path = os.path.join(workdir, 'bench-{}.db'.format(expenses))
+            owned = seed_database(path, args, expenses)
+            for name in drivers:
+                with project.app.app_context():
+                    balance_cache.clear()
+                    user_cache.clear()
+                if name == 'client':
+                    driver = ClientDriver('sqlite:///' + path, not args.no_cache)
+                else:
+                    driver = GunicornDriver('sqlite:///' + path, not args.no_cache, args.workers, args.concurrency)
+                try:
+                    tokens = dict((user_id, login(driver, user_id)) for user_id in owned)
+                    print('{:<44} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('{} / {:,} expenses'.format(name, expenses), 'n', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+                    for route in routes:
+                        result = measure(driver, route, owned, tokens, args.requests, args.seed)
+                        results['{}/{}/{}'.format(name, expenses, route)] = result
+                        print('  {:<42} {:>7} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(route, result['requests'], result['errors'], result['p50'], result['p95'], result['p99'], result['rps']))
+                finally:
+                    driver.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    status = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            raise SystemExit('No baseline at {}, run with --save-baseline first'.format(args.baseline))
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            status = 1
+    if args.save_baseline:
+        baseline = {'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline['results'].update(results)
+        baseline['machine'] = {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor()}
+        baseline['options'] = {'users': args.users, 'accounts': args.accounts, 'years': args.years, 'seed': args.seed, 'requests': args.requests, 'workers': args.workers, 'concurrency': args.concurrency, 'cache': not args.no_cache}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok = True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+        print('baseline saved to ' + args.baseline)
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
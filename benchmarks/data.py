@@ -0,0 +1,75 @@
+# benchmarks/data.py
+"""Seeded data set generator shared by the benchmarks: users, a mix of
+plafond (credit card) and plain accounts, and expenses spread over years.
+The same arguments always produce the same rows."""
+import datetime
+import random
+
+from myexpense.project.helpers.passwords import hash_password
+from myexpense.project.models.account import Account
+from myexpense.project.models.expense import Expense
+from myexpense.project.models.snapshot import MonthlySnapshot
+from myexpense.project.models.user import User
+
+PASSWORD = 'Secret12'
+CATEGORIES = ('Food', 'Home', 'Car', 'Health', 'Travel', 'Shopping', 'Bills', 'Salary', 'Gifts', 'Sport', 'Restaurant', 'Other')
+WORDS = ('dinner', 'lunch', 'groceries', 'fuel', 'rent', 'cinema', 'books', 'train', 'taxi', 'pharmacy', 'gym', 'coffee', 'insurance', 'phone', 'holiday', 'present')
+
+def email(i):
+    return 'bench{}@example.com'.format(i)
+
+def generate(db, users = 10, accounts = 3, expenses = 10000, years = 3, seed = 42, chunk_size = 10000):
+    """Insert the data set with Core executemany in chunks, then build the
+    monthly snapshots. Returns {user_id: [account_id, ...]}."""
+    rng = random.Random(seed)
+    # Hashing once keeps seeding fast, every user shares the password. The
+    # app's cost is used so logins do not rehash.
+    pw_hash = hash_password(PASSWORD)
+    now = datetime.datetime(2019, 1, 1)
+    db.session.execute(User.__table__.insert(), [
+        {'user_id': i, 'email': email(i), 'name': 'Bench {}'.format(i), 'password': pw_hash, 'confirmed': True, 'created_at': now}
+        for i in range(1, users + 1)
+    ])
+    owned = {}
+    rows = []
+    account_id = 0
+    for user_id in range(1, users + 1):
+        owned[user_id] = []
+        for j in range(accounts):
+            account_id += 1
+            # Every third account is a credit card with a monthly plafond
+            has_plafond = j % 3 == 2
+            rows.append({
+                'account_id': account_id,
+                'name': 'Card {}'.format(j) if has_plafond else 'Account {}'.format(j),
+                'has_plafond': has_plafond,
+                'plafond': rng.choice((100000, 150000, 300000)) if has_plafond else None,
+                'initial_balance': 0 if has_plafond else rng.randrange(0, 1000000, 100),
+                'user_id': user_id,
+            })
+            owned[user_id].append(account_id)
+    db.session.execute(Account.__table__.insert(), rows)
+    end = datetime.date(2018, 12, 31)
+    days = 365 * years
+    table = Expense.__table__
+    per_user = max(1, expenses // users)
+    chunk = []
+    for n in range(expenses):
+        user_id = min(n // per_user, users - 1) + 1
+        income = rng.random() < 0.05
+        chunk.append({
+            'amount': rng.randrange(100000, 300000, 100) if income else -rng.randrange(100, 20000, 10),
+            'category': 'Salary' if income else rng.choice(CATEGORIES),
+            'date': end - datetime.timedelta(days = rng.randrange(days)),
+            'note': ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(1, 4))),
+            'user_id': user_id,
+            'account_id': rng.choice(owned[user_id]),
+        })
+        if len(chunk) >= chunk_size:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+    db.session.commit()
+    MonthlySnapshot.rebuild()
+    return owned
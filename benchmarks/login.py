@@ -0,0 +1,34 @@
+# benchmarks/login.py
+"""Password verifications per second on one core for each bcrypt cost, and
+the cost `flask bcrypt calibrate --target-ms` would pick on this machine.
+
+    python -m myexpense.benchmarks.login --min-rounds 8 --max-rounds 13 --target-ms 250
+"""
+import argparse
+import time
+
+from myexpense.project import bcrypt
+from myexpense.project.helpers.passwords import calibrate
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--min-rounds', type = int, default = 8)
+    parser.add_argument('--max-rounds', type = int, default = 13)
+    parser.add_argument('--seconds', type = float, default = 2.0, help = 'time spent on each cost')
+    parser.add_argument('--target-ms', type = float, default = 250)
+    args = parser.parse_args()
+
+    print('{:>5} {:>12} {:>16}'.format('cost', 'ms/verify', 'verify/s/core'))
+    for rounds in range(args.min_rounds, args.max_rounds + 1):
+        pw_hash = bcrypt.generate_password_hash('Secret12', rounds)
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.seconds or count == 0:
+            bcrypt.check_password_hash(pw_hash, 'Secret12')
+            count += 1
+        elapsed = time.perf_counter() - started
+        print('{:>5} {:>12.2f} {:>16.1f}'.format(rounds, elapsed / count * 1000, count / elapsed))
+    print('calibrated cost for {}ms: {}'.format(args.target_ms, calibrate(args.target_ms, args.min_rounds, args.max_rounds)))
+
+if __name__ == '__main__':
+    main()
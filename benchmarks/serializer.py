@@ -0,0 +1,66 @@
+# benchmarks/serializer.py
+"""Rows per second of the expense and account list serialization, comparing
+the marshmallow schemas with the compiled serializer used by the API.
+
+    python -m myexpense.benchmarks.serializer --rows 100 --repeat 200
+"""
+import argparse
+import datetime
+import time
+
+from myexpense import project
+from myexpense.project.helpers import serializer
+from myexpense.project.models.account import Account, AccountSchema
+from myexpense.project.models.expense import Expense, ExpenseSchema
+from myexpense.project.models.user import User
+
+def seed(db, rows):
+    user = User(email = 'bench@example.com', name = 'Bench', password = 'Secret12', confirmed = True)
+    db.session.add(user)
+    db.session.flush()
+    account = Account(name = 'Conto', has_plafond = False, user_id = user.user_id, initial_balance = 0)
+    db.session.add(account)
+    db.session.flush()
+    start = datetime.date(2018, 1, 1)
+    for i in range(rows):
+        db.session.add(Expense(amount = -(i % 5000), category = 'cat{}'.format(i % 12), date = start + datetime.timedelta(days = i % 365), note = 'note {}'.format(i), user_id = user.user_id, account_id = account.account_id))
+    db.session.commit()
+
+def measure(label, func, rows, repeat):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    rate = rows * repeat / elapsed
+    print('{:<40} {:>12,.0f} rows/s  {:>8.3f} ms/page'.format(label, rate, elapsed / repeat * 1000))
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--rows', type = int, default = 100, help = 'rows per page (per_page)')
+    parser.add_argument('--repeat', type = int, default = 200, help = 'pages serialized per measure')
+    args = parser.parse_args()
+
+    app = project.app
+    db = project.db
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        db.create_all()
+        seed(db, args.rows)
+        with app.test_request_context('/api/v1/expenses'):
+            expenses = Expense.query.all()
+            accounts = Account.query.all() * args.rows
+            for e in expenses:
+                e.account
+            if serializer.dump(ExpenseSchema, expenses, many = True) != ExpenseSchema(many = True).dump(expenses).data:
+                raise SystemExit('Compiled serializer output differs from ExpenseSchema')
+            before = measure('ExpenseSchema(many=True).dump', lambda: ExpenseSchema(many = True).dump(expenses).data, args.rows, args.repeat)
+            after = measure('serializer.dump(ExpenseSchema)', lambda: serializer.dump(ExpenseSchema, expenses, many = True), args.rows, args.repeat)
+            print('{:<40} {:>12.1f}x'.format('expenses speedup', after / before))
+            before = measure('AccountSchema(many=True).dump', lambda: AccountSchema(many = True, exclude = ('expenses', )).dump(accounts).data, args.rows, args.repeat)
+            after = measure('serializer.dump(AccountSchema)', lambda: serializer.dump(AccountSchema, accounts, many = True, exclude = ('expenses', )), args.rows, args.repeat)
+            print('{:<40} {:>12.1f}x'.format('accounts speedup', after / before))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# benchmarks/startup.py
+"""Cold start of the API in fresh interpreters: import of the package,
+create_app() and the first request, then the time gunicorn takes to serve
+its first response with and without --preload.
+
+    python -m myexpense.benchmarks.startup --repeat 5 --workers 4
+"""
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import myexpense
+
+# Printed by a fresh interpreter: milliseconds of each startup phase
+PHASES = '''
+import time
+started = time.perf_counter()
+import myexpense.project
+imported = time.perf_counter()
+app = myexpense.project.create_app({{'SQLALCHEMY_DATABASE_URI': {uri!r}, 'METRICS_ALLOWED_IPS': ['127.0.0.1']}})
+created = time.perf_counter()
+app.test_client().get('/metrics')
+served = time.perf_counter()
+print((imported - started) * 1000, (created - imported) * 1000, (served - created) * 1000)
+'''
+
+def root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(myexpense.__file__)))
+
+def phases(uri):
+    output = subprocess.check_output([sys.executable, '-c', PHASES.format(uri = uri)], cwd = root(), env = dict(os.environ, PYTHONPATH = root()))
+    return [float(value) for value in output.split()]
+
+def gunicorn_ready(uri, workers, preload):
+    """Milliseconds from the gunicorn launch to its first 200 response"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning']
+    if preload:
+        command.append('--preload')
+    env = dict(os.environ, PYTHONPATH = root(), MYEXPENSE_BENCH_DB = uri)
+    started = time.perf_counter()
+    process = subprocess.Popen(command + ['myexpense.benchmarks.wsgi:app'], cwd = root(), env = env)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise SystemExit('gunicorn did not start')
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 10)
+            try:
+                connection.request('GET', '/metrics')
+                if connection.getresponse().status == 200:
+                    return (time.perf_counter() - started) * 1000
+            except OSError:
+                time.sleep(0.01)
+            finally:
+                connection.close()
+    finally:
+        process.terminate()
+        process.wait(10)
+
+def report(label, samples):
+    print('{:<36} median {:>9.1f} ms   min {:>9.1f} ms   max {:>9.1f} ms'.format(label, statistics.median(samples), min(samples), max(samples)))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--workers', type = int, default = 2)
+    parser.add_argument('--no-gunicorn', action = 'store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = 'myexpense-startup-')
+    uri = 'sqlite:///' + os.path.join(workdir, 'startup.db')
+    try:
+        samples = [phases(uri) for _ in range(args.repeat)]
+        report('import myexpense.project', [s[0] for s in samples])
+        report('create_app()', [s[1] for s in samples])
+        report('first request', [s[2] for s in samples])
+        report('total', [sum(s) for s in samples])
+        if not args.no_gunicorn:
+            report('gunicorn first response', [gunicorn_ready(uri, args.workers, False) for _ in range(args.repeat)])
+            report('gunicorn --preload first response', [gunicorn_ready(uri, args.workers, True) for _ in range(args.repeat)])
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+if __name__ == '__main__':
+    main()
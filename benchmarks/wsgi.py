@@ -0,0 +1,12 @@
+# benchmarks/wsgi.py
+"""gunicorn entry point of the API benchmark, serving the database named
+by MYEXPENSE_BENCH_DB instead of the configured one."""
+import os
+
+from myexpense.project import create_app
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ['MYEXPENSE_BENCH_DB'],
+    'BALANCE_CACHE_ENABLED': os.environ.get('MYEXPENSE_BENCH_CACHE', '1') == '1',
+    'METRICS_ALLOWED_IPS': ['127.0.0.1'],
+})
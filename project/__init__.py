@@ -1,125 +1,183 @@
 # init MyExpense API
 import datetime
+import os
+import weakref
 
-from flask import Flask, make_response, request, jsonify, redirect, flash
+from flask import Flask, request, jsonify
 from flask_marshmallow import Marshmallow
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_mail import Mail
 from flask_login import LoginManager
-from flask_jwt import JWT
 from sqlalchemy.exc import DatabaseError
 
 from .models.models import db
 from .exceptions import InvalidRequest
-from .helpers import error_log
+from .helpers import error_log, metrics
 
-app = Flask(__name__)
-app.config.from_pyfile('_config.py')
-
-bcrypt = Bcrypt(app)
-mail = Mail(app)
-db.init_app(app)
-ma = Marshmallow(app)
-migrate = Migrate(app, db)
+# Unbound extensions, create_app binds them. Models and blueprints import
+# these, so they must not need an app.
+bcrypt = Bcrypt()
+mail = Mail()
+ma = Marshmallow()
 login_manager = LoginManager()
-login_manager.init_app(app)
-
-from .models import *
-from .models.user import User
-
-# import Blueprint
-from .api.api import api_blueprint
-from .users.views import user_blueprint
-from .users.auth import authenticate, identity
-
-jwt = JWT(app, authenticate, identity)
-
-@jwt.jwt_payload_handler
-def make_payload(identity):
-    iat = datetime.datetime.utcnow()
-    exp = iat + app.config.get('JWT_EXPIRATION_DELTA')
-    nbf = iat + app.config.get('JWT_NOT_BEFORE_DELTA')
-    identity = getattr(identity, 'user_id') or identity['user_id']
-    return {'exp': exp, 'iat': iat, 'nbf': nbf, 'identity': identity}
-
-@jwt.auth_response_handler
-def auth_response(access_token, identity):
-    return jsonify({'access_token': access_token.decode('utf-8'), 'expires_in': int(app.config.get('JWT_EXPIRATION_DELTA').total_seconds())})
-
 login_manager.login_view = 'users.user_login'
 login_manager.login_message_category = 'info'
 login_manager.login_message = 'Please log in!'
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.filter(User.user_id==user_id).first()
-
-app.register_blueprint(api_blueprint)
-app.register_blueprint(user_blueprint)
-
-@app.errorhandler(404)
-def not_found(err):
-    if app.debug is True:
-        error_log.write_log('{} {}: {}'.format(404, err.__class__.__name__, request.url))
-    error = {
-        'error': {
-            'message' : str(err),
-            'type' : err.__class__.__name__,
+_apps = weakref.WeakSet()
+
+def create_app(config = None):
+    """Build an app from _config.py updated with config (a dict, or the
+    path of a python file).
+
+    Models, blueprints, JWT and Migrate are imported here rather than with
+    the package. Nothing connects or starts a thread: engines are created
+    on the first query and the email workers with the first message, so
+    the app can be built in a gunicorn --preload master and forked. Each
+    app keeps its own caches and email queue in app.extensions."""
+    app = Flask(__name__)
+    app.config.from_pyfile('_config.py')
+    if isinstance(config, str):
+        app.config.from_pyfile(config)
+    elif config is not None:
+        app.config.update(config)
+
+    from flask_jwt import JWT
+    from flask_migrate import Migrate
+    from . import commands
+    from .api.api import api_blueprint
+    from .helpers.pagination import count_cache
+    from .helpers.replica import sticky_writers
+    from . import email
+    # Models register their tables and session listeners on import
+    from .models import search
+    from .models.analytics import columns_cache
+    from .models.balance import balance_cache
+    from .models.snapshot import MonthlySnapshot
+    from .models.user import User
+    from .models.version import DataVersion
+    from .users.auth import authenticate, identity, load_principal, user_cache
+    from .users.views import user_blueprint
+
+    metrics.init_app(app)
+    bcrypt.init_app(app)
+    mail.init_app(app)
+    db.init_app(app)
+    ma.init_app(app)
+    Migrate(app, db)
+    login_manager.init_app(app)
+    commands.init_app(app)
+    for cache in (user_cache, balance_cache, columns_cache, count_cache, sticky_writers):
+        cache.init_app(app)
+    email.init_app(app, mail.connect)
+    error_log.init_app(app)
+
+    jwt = JWT(None, authenticate, identity)
+
+    @jwt.jwt_payload_handler
+    def make_payload(identity):
+        iat = datetime.datetime.utcnow()
+        exp = iat + app.config.get('JWT_EXPIRATION_DELTA')
+        nbf = iat + app.config.get('JWT_NOT_BEFORE_DELTA')
+        identity = getattr(identity, 'user_id') or identity['user_id']
+        return {'exp': exp, 'iat': iat, 'nbf': nbf, 'identity': identity}
+
+    @jwt.auth_response_handler
+    def auth_response(access_token, identity):
+        return jsonify({'access_token': access_token.decode('utf-8'), 'expires_in': int(app.config.get('JWT_EXPIRATION_DELTA').total_seconds())})
+
+    jwt.init_app(app)
+    login_manager.user_loader(load_principal)
+
+    metrics.registry.gauge('user_cache', user_cache.stats)
+    metrics.registry.gauge('email_queue', email.queue_stats)
+    metrics.registry.gauge('balance_cache', balance_cache.stats)
+    metrics.registry.gauge('analytics_cache', columns_cache.stats)
+
+    app.register_blueprint(api_blueprint)
+    app.register_blueprint(user_blueprint)
+    register_error_handlers(app)
+    _apps.add(app)
+    return app
+
+def _after_fork():
+    for app in list(_apps):
+        db.reset_engines(app)
+
+# A worker forked after the app was used (gunicorn --preload) must not share
+# the database connections of its parent
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def __getattr__(name):
+    # `from myexpense.project import app` keeps working: the app of
+    # _config.py is built on first use, not when the package is imported
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def register_error_handlers(app):
+
+    @app.errorhandler(404)
+    def not_found(err):
+        if error_log.enabled(app):
+            error_log.write_log('{} {}: {}'.format(404, err.__class__.__name__, request.url))
+        error = {
+            'error': {
+                'message' : str(err),
+                'type' : err.__class__.__name__,
+                }
             }
-        }
-    return jsonify(error), 404
-
-@app.errorhandler(DatabaseError)
-def database_error(err):
-    if app.debug is True:
-        error_log.write_log('{} {}: {}'.format(500, err.__class__.__name__, request.url))
-    error = {
-        'error': {
-            'message' : 'Error occurred during database activity',
-            'type' : err.__class__.__name__,
+        return jsonify(error), 404
+
+    @app.errorhandler(DatabaseError)
+    def database_error(err):
+        if error_log.enabled(app):
+            error_log.write_log('{} {}: {}'.format(500, err.__class__.__name__, request.url))
+        error = {
+            'error': {
+                'message' : 'Error occurred during database activity',
+                'type' : err.__class__.__name__,
+                }
             }
-        }
-    return jsonify(error), 500
-
-@app.errorhandler(InvalidRequest)
-def bad_request(err):
-    if app.debug is True:
-        error_log.write_log('{} {}: {}'.format(err.status_code, err.__class__.__name__, request.url))
-    error = {
-        'error': {
-            'message' : err.message,
-            'type' : err.type,
+        return jsonify(error), 500
+
+    @app.errorhandler(InvalidRequest)
+    def bad_request(err):
+        if error_log.enabled(app):
+            error_log.write_log('{} {}: {}'.format(err.status_code, err.__class__.__name__, request.url))
+        error = {
+            'error': {
+                'message' : err.message,
+                'type' : err.type,
+                }
             }
-        }
-    if err.payload is not None:
-        error['error'].update(err.payload)
-    return jsonify(error), err.status_code
-
-@app.errorhandler(403)
-def not_found(err):
-    if app.debug is True:
-        error_log.write_log('{} {}: {}'.format(403, err.__class__.__name__, request.url))
-    error = {
-        'error': {
-            'message' : str(err),
-            'type' : err.__class__.__name__,
+        if err.payload is not None:
+            error['error'].update(err.payload)
+        return jsonify(error), err.status_code
+
+    @app.errorhandler(403)
+    def forbidden(err):
+        if error_log.enabled(app):
+            error_log.write_log('{} {}: {}'.format(403, err.__class__.__name__, request.url))
+        error = {
+            'error': {
+                'message' : str(err),
+                'type' : err.__class__.__name__,
+                }
             }
-        }
-    return jsonify(error), 403
-
-@app.errorhandler(500)
-def internal_error(err):
-    if app.debug is True:
-        error_log.write_log('{} {}: {}'.format(500, err.__class__.__name__, request.url))
-    error = {
-        'error': {
-            'message' : str(err),
-            'type' : err.__class__.__name__ ,
+        return jsonify(error), 403
+
+    @app.errorhandler(500)
+    def internal_error(err):
+        if error_log.enabled(app):
+            error_log.write_log('{} {}: {}'.format(500, err.__class__.__name__, request.url))
+        error = {
+            'error': {
+                'message' : str(err),
+                'type' : err.__class__.__name__ ,
+                }
             }
-        }
-    return jsonify(error), 500
-
-#if __name__ == '__main__':
-    #app.run()
\ No newline at end of file
+        return jsonify(error), 500
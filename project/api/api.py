@@ -1,6 +1,7 @@
 import json, datetime
+from dateutil.relativedelta import relativedelta
 
-from flask import Blueprint, make_response, jsonify, request, abort, render_template, url_for
+from flask import Blueprint, Response, current_app, make_response, jsonify, request, abort, render_template, url_for, stream_with_context
 from flask_jwt import jwt_required, current_identity
 from marshmallow.exceptions import ValidationError
 from sqlalchemy import exc
@@ -8,11 +9,17 @@ from sqlalchemy.orm import lazyload, joinedload, selectinload, raiseload
 
 from .. import db, email
 from ..exceptions import InvalidRequest, ValidationApiError
+from ..helpers import export
+from ..helpers.etag import conditional
+from ..helpers import serializer
 from ..helpers.pagination import Pagination
 from ..models.user import User, UserSchema
 from ..models.expense import Expense, ExpenseSchema
 from ..models.account import  Account, AccountSchema
-from ..models.balance import Balance, BalanceSchema
+from ..models.balance import Balance, BalanceSchema, BalanceSeries, BalanceSeriesSchema, SERIES_STEPS, PlafondHistory, PlafondHistorySchema, series_dates
+from ..models import analytics
+from ..models import search
+from ..models.snapshot import month_of
 from ..token import generate_confirmation_token, confirm_token
 
 
@@ -44,27 +51,62 @@ def api_user_register():
     confirm_url = url_for('users.user_confirm', token=token, _external=True)
     html = render_template('users/email/confirm.html', confirm_url=confirm_url, user=new_user)
     subject = 'Welcome to MyExpense, please confirm your email.'
-    email.AsyncEmail(new_user.email, subject, html).start()
+    email.send_email_async(new_user.email, subject, html)
     return response
 
 # Expenses routes
 @api_blueprint.route('/api/v1/expenses/', methods=['GET'])
 @api_blueprint.route('/api/v1/expenses', methods=['GET'])
 @jwt_required()
+@conditional
 def api_expenses_get_items():
-    try:
-        query = Expense.filter(request.args).filter_by(user_id=current_identity.user_id)
-    except Exception as err:
-        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    if request.args.get('ids') is not None:
+        ids = list(dict.fromkeys(batch_ids(request.args.get('ids'))))
+        found = {}
+        for start in range(0, len(ids), 500):
+            found.update((e.expense_id, e) for e in Expense.eager(Expense.query).filter(Expense.expense_id.in_(ids[start:start + 500])))
+        owned = [found[i] for i in ids if i in found and found[i].user_id == current_identity.user_id]
+        errors = [{'expense_id': i, 'status': 403 if i in found else 404} for i in ids if i not in found or found[i].user_id != current_identity.user_id]
+        return make_response(jsonify({'expenses': serializer.dump(ExpenseSchema, owned, many=True), 'errors': errors}), 207 if errors else 200)
+    query = Expense.eager(Expense.filter(request.args)).filter_by(user_id=current_identity.user_id)
+    expenses = Pagination(query, request, 'expenses', Expense.cursor_columns(), current_identity.user_id)
+    paginated = expenses.paginated_json(serializer.dump(ExpenseSchema, expenses.data, many=True))
+    return make_response(jsonify(paginated), 200)
+
+@api_blueprint.route('/api/v1/expenses/search/', methods=['GET'])
+@api_blueprint.route('/api/v1/expenses/search', methods=['GET'])
+@jwt_required()
+@conditional
+def api_expenses_search():
+    args = request.args.copy()
+    q = args.pop('q', None)
+    query = search.match(Expense.eager(Expense.filter(args)).filter_by(user_id=current_identity.user_id), q)
     expenses = Pagination(query, request, 'expenses')
-    paginated = expenses.paginated_json(ExpenseSchema(many=True).dump(expenses.data).data)
+    paginated = expenses.paginated_json(serializer.dump(ExpenseSchema, expenses.data, many=True))
     return make_response(jsonify(paginated), 200)
 
+@api_blueprint.route('/api/v1/expenses/export', methods=['GET'])
+@jwt_required()
+def api_expenses_export():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        raise InvalidRequest('Invalid query params: format should be one of ' + ', '.join(sorted(export.FORMATS)), 400, type = 'ExportFormatError')
+    args = request.args.copy()
+    args.pop('format', None)
+    query = Expense.filter(args).filter_by(user_id=current_identity.user_id)
+    columns = Expense.export_columns()
+    rows = query.with_entities(*columns).order_by(Expense.date, Expense.expense_id).execution_options(stream_results=True).yield_per(1000)
+    serializer, mimetype = export.FORMATS[export_format]
+    response = Response(stream_with_context(serializer(rows, [c.key for c in columns])), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=expenses.' + export_format
+    return response
+
 @api_blueprint.route('/api/v1/expenses/<int:expense_id>/', methods=['GET'])
 @api_blueprint.route('/api/v1/expenses/<int:expense_id>', methods=['GET'])
 @jwt_required()
+@conditional
 def api_expenses_get_item(expense_id):
-    expense = Expense.query.filter_by(expense_id=expense_id).first_or_404()
+    expense = Expense.eager(Expense.query, many=False).filter_by(expense_id=expense_id).first_or_404()
     if expense.user_id != current_identity.user_id:
         abort(403)
     return make_response(ExpenseSchema().jsonify(expense), 200)
@@ -81,10 +123,75 @@ def api_expenses_post():
     response.headers['Location'] = '/api/v1/expenses/' + str(new_expense.expense_id)
     return response
 
+@api_blueprint.route('/api/v1/expenses/bulk', methods=['POST'])
+@jwt_required()
+def api_expenses_post_bulk():
+    if not request.json:
+        abort(400)
+    data = request.get_json()
+    rows = data.get('expenses') if isinstance(data, dict) else data
+    if not isinstance(rows, list):
+        raise InvalidRequest('Invalid data', 422, type = 'BulkError', payload = {"error": "A list of expenses is required."})
+    if len(rows) > current_app.config.get('BULK_MAX_EXPENSES', 5000):
+        raise InvalidRequest('Too many expenses', 413, type = 'BulkError')
+    created, errors = Expense.bulk_create(rows, current_identity.user_id, ExpenseSchema)
+    status = 201 if not errors else (207 if created else 422)
+    return make_response(jsonify({'created': created, 'errors': errors}), status)
+
+def batch_ids(ids):
+    """Expense ids of a batch request, a list or a comma separated string"""
+    try:
+        ids = [int(i) for i in (ids.split(',') if isinstance(ids, str) else ids)]
+    except (TypeError, ValueError):
+        raise InvalidRequest('Invalid ids!', 400, type = 'BatchError')
+    if len(ids) > current_app.config.get('BULK_MAX_EXPENSES', 5000):
+        raise InvalidRequest('Too many expenses', 413, type = 'BatchError')
+    return ids
+
+def batch_target(data):
+    """The ids or the filter selecting the expenses of a batch request"""
+    if data.get('ids') is not None:
+        return batch_ids(data['ids']), None
+    args = data.get('filter', {})
+    if not isinstance(args, dict):
+        raise InvalidRequest('Invalid filter!', 400, type = 'BatchError')
+    return None, dict((k, str(v)) for k, v in args.items())
+
+@api_blueprint.route('/api/v1/expenses', methods=['PATCH'])
+@jwt_required()
+def api_expenses_patch_items():
+    if not request.json:
+        abort(400)
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(400)
+    ids, args = batch_target(data)
+    try:
+        updated, errors = Expense.batch_update(current_identity.user_id, data.get('changes'), ExpenseSchema, ids, args, current_app.config.get('BULK_MAX_EXPENSES', 5000))
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    return make_response(jsonify({'updated': updated, 'errors': errors}), 207 if errors else 200)
+
+@api_blueprint.route('/api/v1/expenses', methods=['DELETE'])
+@jwt_required()
+def api_expenses_delete_items():
+    data = request.get_json(silent=True) if request.data else None
+    if data is None:
+        data = request.args.to_dict()
+        data = {'ids': data.pop('ids')} if 'ids' in data else {'filter': data}
+    if not isinstance(data, dict):
+        abort(400)
+    ids, args = batch_target(data)
+    try:
+        deleted, errors = Expense.batch_delete(current_identity.user_id, ids, args, current_app.config.get('BULK_MAX_EXPENSES', 5000))
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    return make_response(jsonify({'deleted': deleted, 'errors': errors}), 207 if errors else 200)
+
 @api_blueprint.route('/api/v1/expenses/<int:expense_id>', methods=['DELETE'])
 @jwt_required()
 def api_expenses_delete_item(expense_id):
-    expense = Expense.query.filter_by(expense_id=expense_id).first()
+    expense = Expense.query.options(lazyload(Expense.account)).filter_by(expense_id=expense_id).first()
     if expense.user_id != current_identity.user_id:
         abort(403)
     if expense is not None:
@@ -99,7 +206,7 @@ def api_expenses_update_item(expense_id):
         abort(400)
     data = request.get_json()
     data['user_id'] = current_identity.user_id
-    expense = Expense.query.filter_by(expense_id=expense_id).first_or_404()
+    expense = Expense.eager(Expense.query, many=False).filter_by(expense_id=expense_id).first_or_404()
     if expense is None:
         abort(404)
     if expense.user_id != current_identity.user_id:
@@ -109,21 +216,95 @@ def api_expenses_update_item(expense_id):
     expense.update(data)
     return make_response(ExpenseSchema().jsonify(expense), 200)
 
+# Reports routes
+@api_blueprint.route('/api/v1/reports/summary/', methods=['GET'])
+@api_blueprint.route('/api/v1/reports/summary', methods=['GET'])
+@jwt_required()
+@conditional
+def api_reports_summary():
+    args = request.args.copy()
+    group_by = [g for g in args.pop('group_by', 'category,month').split(',') if g]
+    try:
+        query = Expense.filter(args).filter_by(user_id=current_identity.user_id)
+        summary = Expense.summary(query, group_by)
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    return make_response(jsonify({'group_by': group_by, 'summary': summary}), 200)
+
+def report_accounts():
+    """The account_id list of a report, None for the default accounts"""
+    try:
+        return [int(x) for x in request.args.get('account_id').split(',')] if request.args.get('account_id') is not None else None
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+
+@api_blueprint.route('/api/v1/reports/balance/', methods=['GET'])
+@api_blueprint.route('/api/v1/reports/balance', methods=['GET'])
+@jwt_required()
+@conditional
+def api_reports_balance():
+    accounts = report_accounts()
+    if request.args.get('dates') is not None:
+        try:
+            dates = [datetime.datetime.strptime(d, "%Y-%m-%d").date() for d in request.args.get('dates').split(',')]
+        except ValueError as err:
+            raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+        if len(dates) > current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000):
+            raise InvalidRequest('Invalid query params: the series is limited to {} points'.format(current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000)), 400, type = 'SeriesTooLong')
+    else:
+        dates = series_dates(*series_args(), max_points=current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000))
+    columns = analytics.Columns.cached(current_identity.user_id)
+    balances = analytics.balance_at(columns, dates, accounts)
+    return make_response(jsonify({'balances': [{'date': d.isoformat(), 'balance': b} for d, b in zip(dates, balances)]}), 200)
+
+@api_blueprint.route('/api/v1/reports/categories/', methods=['GET'])
+@api_blueprint.route('/api/v1/reports/categories', methods=['GET'])
+@jwt_required()
+@conditional
+def api_reports_categories():
+    accounts = report_accounts()
+    try:
+        from_date = datetime.datetime.strptime(request.args.get('from'), "%Y-%m-%d").date() if request.args.get('from') is not None else None
+        to_date = datetime.datetime.strptime(request.args.get('to'), "%Y-%m-%d").date() if request.args.get('to') is not None else None
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    columns = analytics.Columns.cached(current_identity.user_id)
+    return make_response(jsonify({'categories': analytics.category_stats(columns, from_date, to_date, accounts)}), 200)
+
+@api_blueprint.route('/api/v1/reports/moving-average/', methods=['GET'])
+@api_blueprint.route('/api/v1/reports/moving-average', methods=['GET'])
+@jwt_required()
+@conditional
+def api_reports_moving_average():
+    accounts = report_accounts()
+    from_date, to_date, _ = series_args()
+    categories = request.args.get('category').split(',') if request.args.get('category') is not None else None
+    try:
+        window = int(request.args.get('window', 30))
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    if window > current_app.config.get('ANALYTICS_MAX_WINDOW', 365):
+        raise InvalidRequest('Invalid query params: window should be at most {}'.format(current_app.config.get('ANALYTICS_MAX_WINDOW', 365)), 400, type = 'WindowError')
+    if (to_date - from_date).days + 1 > current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000):
+        raise InvalidRequest('Invalid query params: the series is limited to {} points, use a shorter period'.format(current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000)), 400, type = 'SeriesTooLong')
+    columns = analytics.Columns.cached(current_identity.user_id)
+    points = analytics.moving_average(columns, from_date, to_date, window, accounts, categories)
+    return make_response(jsonify({'window': window, 'series': [dict(point, date=point['date'].isoformat()) for point in points]}), 200)
+
 # Accounts routes
 @api_blueprint.route('/api/v1/accounts/', methods=['GET'])
 @api_blueprint.route('/api/v1/accounts', methods=['GET'])
 @jwt_required()
+@conditional
 def api_accounts_get_items():
-    try:
-        query = Account.filter(request.args)
-    except Exception as err:
-        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    query = Account.filter(request.args)
     account = query.options(raiseload('expenses')).filter_by(user_id=current_identity.user_id).all()
-    return make_response(AccountSchema(many=True, exclude=('expenses', )).jsonify(account), 200)
+    return make_response(jsonify(serializer.dump(AccountSchema, account, many=True, exclude=('expenses', ))), 200)
 
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/', methods=['GET'])
 @api_blueprint.route('/api/v1/accounts/<int:account_id>', methods=['GET'])
 @jwt_required()
+@conditional
 def api_accounts_get_item(account_id):
     account = Account.query.options(raiseload('expenses')).filter_by(account_id=account_id).first_or_404()
     if account.user_id != current_identity.user_id:
@@ -169,20 +350,19 @@ def api_accounts_update_item(account_id):
 
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/expenses', methods=['GET'])
 @jwt_required()
+@conditional
 def api_accounts_get_expenses_items(account_id):
-    try:
-        query = Expense.filter(request.args).filter_by(user_id=current_identity.user_id, account_id=account_id)
-    except Exception as err:
-        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
-    expenses = Pagination(query, request, 'expenses')
-    paginated = expenses.paginated_json(ExpenseSchema(many=True, exclude=('account',)).dump(expenses.data).data)
+    query = Expense.eager(Expense.filter(request.args), exclude=('account',)).filter_by(user_id=current_identity.user_id, account_id=account_id)
+    expenses = Pagination(query, request, 'expenses', Expense.cursor_columns(), current_identity.user_id)
+    paginated = expenses.paginated_json(serializer.dump(ExpenseSchema, expenses.data, many=True, exclude=('account',)))
     return make_response(jsonify(paginated), 200)
 
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/expenses/<int:expense_id>/', methods=['GET'])
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/expenses/<int:expense_id>', methods=['GET'])
 @jwt_required()
+@conditional
 def api_accounts_get_expenses_item(account_id, expense_id):
-    expense = Expense.query.filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
+    expense = Expense.eager(Expense.query, exclude=('account',)).filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
     if expense.user_id != current_identity.user_id:
         abort(403)
     return make_response(ExpenseSchema(exclude=('account',)).jsonify(expense))
@@ -206,7 +386,7 @@ def api_accounts_post_expenses(account_id):
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/expenses/<int:expense_id>', methods=['DELETE'])
 @jwt_required()
 def api_accounts_delete_expenses_item(account_id, expense_id):
-    expense = Expense.query.filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
+    expense = Expense.query.options(lazyload(Expense.account)).filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
     if expense.user_id != current_identity.user_id:
         abort(403)
     if expense is not None:
@@ -221,7 +401,7 @@ def api_accounts_update_expenses_item(account_id, expense_id):
     data = request.get_json()
     data['user_id'] = current_identity.user_id
     data['account_id'] = account_id
-    expense = Expense.query.filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
+    expense = Expense.eager(Expense.query, many=False).filter_by(expense_id=expense_id, account_id=account_id).first_or_404()
     if expense is None:
         abort(404)
     if expense.user_id != current_identity.user_id:
@@ -234,6 +414,7 @@ def api_accounts_update_expenses_item(account_id, expense_id):
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/balance/', methods=['GET'])
 @api_blueprint.route('/api/v1/accounts/<int:account_id>/balance', methods=['GET'])
 @jwt_required()
+@conditional
 def api_accounts_get_balance(account_id):
     account = Account.query.options(raiseload('expenses')).filter_by(account_id=account_id).first_or_404()
     if account.user_id != current_identity.user_id:
@@ -248,19 +429,81 @@ def api_accounts_get_balance(account_id):
         m_date = datetime.date(int(year), int(month), 1)
     except ValueError as err:
         raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
-    balance = Balance(current_identity.user_id, account, from_date, to_date, m_date)
+    balance = Balance.cached(current_identity.user_id, account, from_date, to_date, m_date)
     return make_response(BalanceSchema().jsonify(balance), 200)
 
 @api_blueprint.route('/api/v1/balance/', methods=['GET'])
 @api_blueprint.route('/api/v1/balance', methods=['GET'])
 @jwt_required()
+@conditional
 def api_get_balance():
     try:
         from_date = datetime.datetime.strptime(request.args.get('from'), "%Y-%m-%d") if request.args.get('from') is not None else datetime.date.min
         to_date = datetime.datetime.strptime(request.args.get('to'), "%Y-%m-%d") if request.args.get('to') is not None else datetime.date.today()
         if from_date > to_date:
             raise InvalidRequest('Invalid query params: to should be greater than from', 400, type = "DateFilterError")
+        accounts = [int(x) for x in request.args.get('account_id').split(',')] if request.args.get('account_id') is not None else None
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    balance = Balance.cached(current_identity.user_id, from_date=from_date, to_date=to_date, accounts=accounts)
+    return make_response(BalanceSchema(exclude=('account',)).jsonify(balance), 200)
+
+def series_args():
+    """The from, to and step of a balance series, the last twelve months by default"""
+    try:
+        to_date = datetime.datetime.strptime(request.args.get('to'), "%Y-%m-%d").date() if request.args.get('to') is not None else datetime.date.today()
+        from_date = datetime.datetime.strptime(request.args.get('from'), "%Y-%m-%d").date() if request.args.get('from') is not None else month_of(to_date) - relativedelta(months=11)
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    if from_date > to_date:
+        raise InvalidRequest('Invalid query params: to should be greater than from', 400, type = "DateFilterError")
+    step = request.args.get('step', 'day')
+    if step not in SERIES_STEPS:
+        raise InvalidRequest('Invalid step: should be one of ' + ', '.join(SERIES_STEPS), 400, type = "StepError")
+    return from_date, to_date, step
+
+@api_blueprint.route('/api/v1/accounts/<int:account_id>/balance/series/', methods=['GET'])
+@api_blueprint.route('/api/v1/accounts/<int:account_id>/balance/series', methods=['GET'])
+@jwt_required()
+@conditional
+def api_accounts_get_balance_series(account_id):
+    account = Account.query.options(raiseload('expenses')).filter_by(account_id=account_id).first_or_404()
+    if account.user_id != current_identity.user_id:
+        abort(403)
+    from_date, to_date, step = series_args()
+    series = BalanceSeries(current_identity.user_id, from_date, to_date, step, account=account)
+    return make_response(BalanceSeriesSchema().jsonify(series), 200)
+
+@api_blueprint.route('/api/v1/balance/series/', methods=['GET'])
+@api_blueprint.route('/api/v1/balance/series', methods=['GET'])
+@jwt_required()
+@conditional
+def api_get_balance_series():
+    from_date, to_date, step = series_args()
+    try:
+        accounts = [int(x) for x in request.args.get('account_id').split(',')] if request.args.get('account_id') is not None else None
+    except ValueError as err:
+        raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
+    series = BalanceSeries(current_identity.user_id, from_date, to_date, step, accounts=accounts)
+    return make_response(BalanceSeriesSchema(exclude=('account',)).jsonify(series), 200)
+
+@api_blueprint.route('/api/v1/accounts/<int:account_id>/plafond/', methods=['GET'])
+@api_blueprint.route('/api/v1/accounts/<int:account_id>/plafond', methods=['GET'])
+@jwt_required()
+@conditional
+def api_accounts_get_plafond(account_id):
+    account = Account.query.options(raiseload('expenses')).filter_by(account_id=account_id).first_or_404()
+    if account.user_id != current_identity.user_id:
+        abort(403)
+    try:
+        months = int(request.args.get('months', 12))
+        statement_day = int(request.args.get('statement_day')) if request.args.get('statement_day') is not None else None
+        to_date = datetime.datetime.strptime(request.args.get('to'), "%Y-%m-%d").date() if request.args.get('to') is not None else None
     except ValueError as err:
         raise InvalidRequest('Invalid query params!', 400, type = err.__class__.__name__)
-    balance = Balance(current_identity.user_id, from_date=from_date, to_date=to_date)
-    return make_response(BalanceSchema(exclude=('account',)).jsonify(balance), 200)
\ No newline at end of file
+    if not 1 <= months <= current_app.config.get('PLAFOND_MAX_MONTHS', 60):
+        raise InvalidRequest('Invalid query params: months should be between 1 and {}'.format(current_app.config.get('PLAFOND_MAX_MONTHS', 60)), 400, type = "MonthsError")
+    if statement_day is not None and not 1 <= statement_day <= 28:
+        raise InvalidRequest('Invalid query params: statement_day should be between 1 and 28', 400, type = "StatementDayError")
+    history = PlafondHistory(account, months, statement_day, to_date)
+    return make_response(PlafondHistorySchema().jsonify(history), 200)
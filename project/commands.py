@@ -0,0 +1,81 @@
+# project/commands.py
+import re
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .helpers import passwords
+from .models import search as expense_search
+from .models.snapshot import MonthlySnapshot
+
+@click.group(cls=AppGroup)
+def snapshots():
+    """Manage the monthly balance snapshots."""
+
+@snapshots.command()
+@click.option('--user-id', type=int, default=None, help='Only rebuild the snapshots of this user.')
+def rebuild(user_id):
+    """Recompute the snapshots from the expenses."""
+    count = MonthlySnapshot.rebuild(user_id)
+    click.echo('Rebuilt {} monthly snapshots.'.format(count))
+
+@snapshots.command()
+@click.option('--user-id', type=int, default=None, help='Only verify the snapshots of this user.')
+def verify(user_id):
+    """Compare the snapshots with the expenses."""
+    mismatches = MonthlySnapshot.verify(user_id)
+    for account_id, month, expected, stored in mismatches:
+        click.echo('Account {} {:%Y-%m}: expected {}, stored {}'.format(account_id, month, expected, stored))
+    if mismatches:
+        raise click.ClickException('{} monthly snapshots out of date, run "flask snapshots rebuild".'.format(len(mismatches)))
+    click.echo('All monthly snapshots are up to date.')
+
+@click.group(cls=AppGroup)
+def search():
+    """Manage the full-text index of the expenses."""
+
+@search.command('rebuild')
+def rebuild_search():
+    """Create the full-text index if missing and reindex every expense."""
+    mode = expense_search.rebuild()
+    if mode == 'like':
+        raise click.ClickException('No full-text index on this database, searches use LIKE.')
+    click.echo('Rebuilt the {} full-text index.'.format(mode))
+
+@click.group('bcrypt', cls=AppGroup)
+def bcrypt_cost():
+    """Tune the cost of the password hashes."""
+
+@bcrypt_cost.command('calibrate')
+@click.option('--target-ms', type=float, default=None, help='Longest hash time wanted, BCRYPT_TARGET_MS (250) by default.')
+@click.option('--config', type=click.Path(dir_okay=False), default=None, help='Python config file to store BCRYPT_LOG_ROUNDS in.')
+def calibrate_bcrypt(target_ms, config):
+    """Time bcrypt on this machine and pick BCRYPT_LOG_ROUNDS.
+
+    Run it once per deployment: the workers read the stored cost, so they
+    all hash (and rehash on login) with the same one."""
+    target_ms = target_ms or current_app.config.get('BCRYPT_TARGET_MS', 250)
+    rounds = passwords.calibrate(target_ms, current_app.config.get('BCRYPT_MIN_ROUNDS', 10), current_app.config.get('BCRYPT_MAX_ROUNDS', 16))
+    line = 'BCRYPT_LOG_ROUNDS = {}'.format(rounds)
+    if config is None:
+        click.echo(line)
+        return
+    try:
+        with open(config) as f:
+            source = f.read()
+    except FileNotFoundError:
+        source = ''
+    if re.search(r'^BCRYPT_LOG_ROUNDS\s*=.*$', source, re.M):
+        source = re.sub(r'^BCRYPT_LOG_ROUNDS\s*=.*$', line, source, flags=re.M)
+    else:
+        source += ('' if not source or source.endswith('\n') else '\n') + line + '\n'
+    with open(config, 'w') as f:
+        f.write(source)
+    click.echo('Stored {} in {}.'.format(line, config))
+
+
+def init_app(app):
+    app.cli.add_command(snapshots)
+    app.cli.add_command(search)
+    app.cli.add_command(bcrypt_cost)
@@ -1,8 +1,15 @@
 # project/email.py
-from threading import Thread
+import atexit
+import os
+import queue
+import threading
+import time
+import weakref
+
+from flask import current_app
 from flask_mail import Message
 
-from . import app, mail
+from . import mail
 
 
 def send_email(to, subject, template):
@@ -10,25 +17,208 @@ def send_email(to, subject, template):
         subject,
         recipients=[to],
         html=template,
-        sender=app.config['MAIL_DEFAULT_SENDER']
+        sender=current_app.config['MAIL_DEFAULT_SENDER']
     )
     mail.send(msg)
 
-class AsyncEmail(Thread):
-    def __init__(self, to, subject, template):
-        Thread.__init__(self)
-        self.to = to
-        self.subject = subject
-        self.template = template
-
-    def run(self):
-        print("Inizio invio email: "+self.subject)
-        with app.app_context():
-            msg = Message(
-                self.subject,
-                recipients=[self.to],
-                html=self.template,
-                sender=app.config['MAIL_DEFAULT_SENDER']
-            )
-            mail.send(msg)
-            print("Email inviata.")
+class EmailQueue():
+    """Bounded pool of worker threads delivering queued messages.
+
+    Each worker keeps its SMTP connection open while there is work, sends
+    up to batch_size messages per wake up and closes the connection after
+    idle_timeout seconds without messages. When the queue is full, put()
+    either blocks for put_timeout seconds (overflow='block') or discards
+    the oldest queued message (overflow='drop_oldest')."""
+
+    def __init__(self, app = None, connect = None, workers = 2, maxsize = 1000, batch_size = 20, overflow = 'block', put_timeout = 5, idle_timeout = 30):
+        if overflow not in ('block', 'drop_oldest'):
+            raise ValueError('Invalid overflow policy: ' + overflow)
+        self.app = app
+        self.connect = connect
+        self.workers = workers
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.__threads = []
+        self.__pid = None
+        self.__lock = threading.Lock()
+        self.__count_lock = threading.Lock()
+        self.__put_lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize)
+
+    def start(self):
+        """Start the workers, again after a fork since threads do not survive it"""
+        with self.__lock:
+            if self.__pid == os.getpid() and all(t.is_alive() for t in self.__threads):
+                return
+            self.__pid = os.getpid()
+            self.__threads = [threading.Thread(target=self.__work, name='email-worker-{}'.format(i), daemon=True) for i in range(self.workers)]
+            for thread in self.__threads:
+                thread.start()
+
+    def put(self, msg):
+        """Queue a message, returns False if it was dropped"""
+        self.start()
+        if self.overflow == 'drop_oldest':
+            with self.__put_lock:
+                while True:
+                    try:
+                        self.__queue.put_nowait(msg)
+                        return True
+                    except queue.Full:
+                        if not self.__discard_oldest():
+                            break
+        else:
+            try:
+                self.__queue.put(msg, timeout=self.put_timeout)
+                return True
+            except queue.Full:
+                pass
+        self.__count('dropped')
+        self.app.logger.error('Email queue full, dropped: %s', msg.subject)
+        return False
+
+    def __discard_oldest(self):
+        """Drop the oldest message, returns False when the oldest entry is a
+        shutdown sentinel: it goes back to the queue so its worker still exits"""
+        try:
+            old = self.__queue.get_nowait()
+        except queue.Empty:
+            return True
+        self.__queue.task_done()
+        if old is None:
+            # Room was just made and every put holds __put_lock
+            self.__queue.put_nowait(None)
+            return False
+        self.__count('dropped')
+        self.app.logger.error('Email queue full, dropped: %s', old.subject)
+        return True
+
+    def flush(self, timeout = None):
+        """Wait until every queued message is handled, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__queue.all_tasks_done:
+            while self.__queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout = 10):
+        """Deliver what is queued, then stop the workers. Never waits more
+        than timeout seconds: workers that could not be sent their stop
+        sentinel stay registered and get it on the next shutdown."""
+        if self.__pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        self.flush(timeout)
+        signalled = 0
+        with self.__put_lock:
+            for thread in self.__threads:
+                try:
+                    self.__queue.put(None, timeout=max(0, deadline - time.monotonic()))
+                except queue.Full:
+                    self.app.logger.error('Email queue still full at shutdown, %s messages left', self.__queue.qsize())
+                    break
+                signalled += 1
+        for thread in self.__threads[:signalled]:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.__threads = self.__threads[signalled:]
+
+    def stats(self):
+        with self.__count_lock:
+            return {'queued': self.__queue.qsize(), 'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped}
+
+    def __count(self, name):
+        # Workers and producers update the counters concurrently
+        with self.__count_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __work(self):
+        with self.app.app_context():
+            connection = None
+            running = True
+            while running:
+                try:
+                    batch = [self.__queue.get(timeout=self.idle_timeout)]
+                except queue.Empty:
+                    connection = self.__close(connection)
+                    continue
+                while len(batch) < self.batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(self.__queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for msg in batch:
+                    if msg is None:
+                        running = False
+                    else:
+                        connection = self.__send(connection, msg)
+                    self.__queue.task_done()
+            self.__close(connection)
+
+    def __send(self, connection, msg):
+        for attempt in range(2):
+            try:
+                if connection is None:
+                    connection = self.connect()
+                    connection.__enter__()
+                connection.send(msg)
+                self.__count('sent')
+                return connection
+            except Exception as err:
+                # A stale connection gets one retry on a fresh one
+                connection = self.__close(connection)
+                error = err
+        self.__count('failed')
+        self.app.logger.error('Email delivery failed: %s (%s)', msg.subject, error)
+        return connection
+
+    def __close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+_queues = weakref.WeakSet()
+
+def init_app(app, connect):
+    """Give app its own EmailQueue, configured by the MAIL_* settings. The
+    workers start with the first message, in the process sending it."""
+    email_queue = EmailQueue(
+        app,
+        connect,
+        workers=app.config.get('MAIL_WORKERS', 2),
+        maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000),
+        batch_size=app.config.get('MAIL_BATCH_SIZE', 20),
+        overflow=app.config.get('MAIL_QUEUE_OVERFLOW', 'block'),
+        put_timeout=app.config.get('MAIL_QUEUE_TIMEOUT', 5),
+        idle_timeout=app.config.get('MAIL_IDLE_TIMEOUT', 30),
+    )
+    app.extensions['email_queue'] = email_queue
+    _queues.add(email_queue)
+    return email_queue
+
+def queue_stats():
+    return current_app.extensions['email_queue'].stats()
+
+@atexit.register
+def _shutdown_queues():
+    for email_queue in list(_queues):
+        email_queue.shutdown()
+
+def send_email_async(to, subject, template):
+    msg = Message(
+        subject,
+        recipients=[to],
+        html=template,
+        sender=current_app.config['MAIL_DEFAULT_SENDER']
+    )
+    return current_app.extensions['email_queue'].put(msg)
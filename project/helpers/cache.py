@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+class TTLCache():
+    """Bounded, thread safe LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize = 1024, ttl = 60, timer = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__timer = timer
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is not None and entry[0] > self.__timer():
+                self.__data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.__data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.__lock:
+            self.__data[key] = (self.__timer() + self.ttl, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def stats(self):
+        """Counters used to size the cache"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.__data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / total if total else None,
+        }
+
+class SharedCache():
+    """TTLCache lookalike storing JSON values in a Redis-like client (get,
+    setex, delete, scan_iter), so every worker shares the same entries.
+    Client errors count as misses: the cache never fails a request."""
+
+    def __init__(self, client, prefix = 'myexpense:', ttl = 60):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key, default = None):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception:
+            self.errors += 1
+            raw = None
+        if raw is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        try:
+            self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+        except Exception:
+            self.errors += 1
+
+    def invalidate(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            self.errors += 1
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(self.prefix + '*'))
+            if keys:
+                self.client.delete(*keys)
+        except Exception:
+            self.errors += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": float(self.hits) / total if total else None,
+        }
+
+def from_config(config, prefix, maxsize = 1024, ttl = 60):
+    """SharedCache on {prefix}_URL when set (needs the redis package),
+    a per process TTLCache of {prefix}_SIZE entries otherwise"""
+    ttl = config.get(prefix + '_TTL', ttl)
+    url = config.get(prefix + '_URL')
+    if url:
+        import redis
+        return SharedCache(redis.Redis.from_url(url), prefix='myexpense:{}:'.format(prefix.lower()), ttl=ttl)
+    return TTLCache(config.get(prefix + '_SIZE', maxsize), ttl)
+
+class ConfiguredCache():
+    """Module level cache that can be imported before any app exists.
+    init_app builds a backend from the config of each app and keeps it in
+    app.extensions, the calls go to the backend of the current app (to a
+    default TTLCache outside any app). Shared caches use from_config
+    ({prefix}_URL allowed), the others always stay in the process (for
+    values that are not JSON)."""
+
+    def __init__(self, prefix, maxsize = 1024, ttl = 60, shared = True):
+        self.prefix = prefix
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.extension = 'cache.' + prefix.lower()
+        self.default = TTLCache(maxsize, ttl)
+
+    def init_app(self, app):
+        if self.shared:
+            backend = from_config(app.config, self.prefix, self.maxsize, self.ttl)
+        else:
+            backend = TTLCache(app.config.get(self.prefix + '_SIZE', self.maxsize), app.config.get(self.prefix + '_TTL', self.ttl))
+        app.extensions[self.extension] = backend
+
+    def for_app(self, app):
+        """The backend of app, the default one if init_app was not called for it"""
+        return app.extensions.get(self.extension, self.default)
+
+    @property
+    def backend(self):
+        if has_app_context():
+            return self.for_app(current_app)
+        return self.default
+
+    def get(self, key, default = None):
+        return self.backend.get(key, default)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, key):
+        self.backend.invalidate(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
+
+    def __len__(self):
+        return len(self.backend)
+
+    def __getattr__(self, name):
+        # hits, misses, errors... of the current backend
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.backend, name)
@@ -1,5 +1,180 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import weakref
 from datetime import datetime
 
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ErrorLog():
+    """Append-only log written in batches by a background thread.
+
+    write() only queues the line, so request threads never touch the file.
+    Every batch is a single O_APPEND write, and rotation (by size and/or
+    every interval seconds) happens under an flock, so several gunicorn
+    workers can share the same file: a worker notices that another one
+    rotated the file and reopens it."""
+
+    def __init__(self, path = 'error.log', max_bytes = 10 * 1024 * 1024, backup_count = 5, interval = None, flush_interval = 1.0, batch_size = 200, maxsize = 10000, clock = time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.__clock = clock
+        self.__queue = queue.Queue(maxsize)
+        self.__fd = None
+        self.__thread = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def write(self, message):
+        """Queue a line, never blocks: lines are dropped if the writer falls behind"""
+        self.__start()
+        line = '\n{} {}'.format(datetime.fromtimestamp(self.__clock()).strftime('%d-%m-%Y %H:%M:%S'), message)
+        try:
+            self.__queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every queued line is on disk"""
+        if self.__thread is not None:
+            self.__queue.join()
+
+    def close(self):
+        if self.__thread is None or self.__pid != os.getpid():
+            return
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__thread = None
+
+    def __start(self):
+        if self.__pid == os.getpid() and self.__thread is not None:
+            return
+        with self.__lock:
+            if self.__pid == os.getpid() and self.__thread is not None:
+                return
+            self.__pid = os.getpid()
+            self.__fd = None
+            self.__thread = threading.Thread(target=self.__work, name='error-log-writer', daemon=True)
+            self.__thread.start()
+
+    def __work(self):
+        running = True
+        while running:
+            try:
+                batch = [self.__queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+            lines = [line for line in batch if line is not None]
+            try:
+                if lines:
+                    self.__append(''.join(lines).encode('utf-8'))
+            except OSError:
+                self.dropped += len(lines)
+            finally:
+                for _ in batch:
+                    self.__queue.task_done()
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __append(self, data):
+        lock = self.__acquire()
+        try:
+            self.__rotate_if_needed(len(data))
+            self.__reopen_if_moved()
+            os.write(self.__fd, data)
+        finally:
+            self.__release(lock)
+
+    def __acquire(self):
+        if fcntl is None:
+            return None
+        lock = os.open(self.path + '.lock', os.O_CREAT | os.O_WRONLY, 0o644)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def __release(self, lock):
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+
+    def __reopen_if_moved(self):
+        if self.__fd is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.__fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(self.__fd)
+        self.__fd = os.open(self.path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+
+    def __rotate_if_needed(self, incoming):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_size == 0:
+            return
+        too_big = self.max_bytes and stat.st_size + incoming > self.max_bytes
+        too_old = self.interval and int(stat.st_mtime // self.interval) != int(self.__clock() // self.interval)
+        if not (too_big or too_old):
+            return
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+_logs = weakref.WeakSet()
+
+def init_app(app):
+    """Give app its own ErrorLog, configured by the ERROR_LOG_* settings.
+    Its writer thread starts with the first line."""
+    config = app.config
+    log = ErrorLog(
+        config.get('ERROR_LOG_PATH', 'error.log'),
+        max_bytes=config.get('ERROR_LOG_MAX_BYTES', 10 * 1024 * 1024),
+        backup_count=config.get('ERROR_LOG_BACKUP_COUNT', 5),
+        interval=config.get('ERROR_LOG_ROTATE_INTERVAL'),
+    )
+    app.extensions['error_log'] = log
+    _logs.add(log)
+    return log
+
+def error_log():
+    """The ErrorLog of the current app"""
+    return current_app.extensions['error_log']
+
+@atexit.register
+def _close_logs():
+    for log in list(_logs):
+        log.close()
+
+def enabled(app):
+    """Error logging defaults to debug mode only, ERROR_LOG_ENABLED turns it on anywhere"""
+    return app.config.get('ERROR_LOG_ENABLED', app.debug is True)
+
 def write_log(message):
-    with open('error.log', 'a') as f:
-        f.write('\n{} {}'.format(datetime.now().strftime('%d-%m-%Y %H:%M:%S'), message))
\ No newline at end of file
+    error_log().write(message)
@@ -0,0 +1,29 @@
+import datetime
+import functools
+import hashlib
+
+from flask import make_response, request
+from flask_jwt import current_identity
+
+from ..models.version import DataVersion
+
+def conditional(view):
+    """Answer GET requests with 304 when If-None-Match carries the weak ETag
+    derived from the user's data version, before the view runs any query"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = current_identity.user_id
+        version = DataVersion.current(user_id)
+        # Today's date is part of the key as balances depend on it
+        args_key = '&'.join('{}={}'.format(k, v) for k, v in sorted(request.args.items(multi=True)))
+        digest = hashlib.sha1('{}|{}|{}|{}'.format(user_id, request.path, args_key, datetime.date.today()).encode('utf-8')).hexdigest()[:16]
+        etag = '{}-{}'.format(version, digest)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        return response
+    return wrapper
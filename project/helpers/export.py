@@ -0,0 +1,38 @@
+import csv
+import datetime
+import io
+import json
+
+def _plain(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+def iter_csv(rows, columns, buffer_rows = 500):
+    """Yield rows as CSV text, a header line first, in chunks of buffer_rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([_plain(v) for v in row])
+        if i % buffer_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def iter_ndjson(rows, columns, buffer_rows = 500):
+    """Yield rows as newline delimited JSON objects, in chunks of buffer_rows"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, [_plain(v) for v in row]))))
+        if len(lines) == buffer_rows:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
@@ -0,0 +1,133 @@
+import datetime
+import threading
+
+from sqlalchemy import bindparam
+
+from ..exceptions import InvalidRequest
+
+def parse_value(column, raw):
+    """Convert a query string value to the python type of column"""
+    python_type = column.type.python_type
+    if python_type is datetime.date:
+        return datetime.datetime.strptime(raw, '%Y-%m-%d').date()
+    if python_type is bool:
+        if raw.lower() not in ('true', '1', 'false', '0'):
+            raise ValueError('Invalid boolean: ' + raw)
+        return raw.lower() in ('true', '1')
+    return python_type(raw)
+
+class In():
+    """?name=a,b,c as column = :a or column IN :values"""
+
+    def __init__(self, column, name = None):
+        self.column = column
+        self.names = (name or column,)
+
+    def shape(self, args):
+        values = args.get(self.names[0])
+        if values is None:
+            return None
+        return 'many' if ',' in values else 'one'
+
+    def clauses(self, column, shape):
+        key = 'f_' + self.names[0]
+        if shape == 'many':
+            return [column.in_(bindparam(key, expanding=True))]
+        return [column == bindparam(key)]
+
+    def params(self, column, args):
+        values = [parse_value(column, v) for v in args.get(self.names[0]).split(',')]
+        key = 'f_' + self.names[0]
+        return {key: values if len(values) > 1 else values[0]}
+
+class Range():
+    """?low=x&high=y as column >= :low and column <= :high"""
+
+    def __init__(self, column, low, high):
+        self.column = column
+        self.names = (low, high)
+
+    def shape(self, args):
+        bounds = tuple(args.get(name) is not None for name in self.names)
+        return bounds if any(bounds) else None
+
+    def clauses(self, column, shape):
+        clauses = []
+        if shape[0]:
+            clauses.append(column >= bindparam('f_' + self.names[0]))
+        if shape[1]:
+            clauses.append(column <= bindparam('f_' + self.names[1]))
+        return clauses
+
+    def params(self, column, args):
+        return dict(('f_' + name, parse_value(column, args.get(name))) for name in self.names if args.get(name) is not None)
+
+class FilterSpec():
+    """Declarative query string filters of a model.
+
+    Filters map query params to typed, bound clauses and sort picks one of
+    the allowed orderings ('-' for descending), with the primary key as
+    tie breaker so the order matches the (..., id) indexes. The clauses
+    are compiled once per query string shape (which params are present,
+    one or many values, sort) and only the bound values change, so every
+    request of a shape sends the same SQL."""
+
+    def __init__(self, *filters, sort = ()):
+        self.filters = filters
+        self.sort = sort
+        self.__plans = {}
+        self.__lock = threading.Lock()
+
+    def __contains__(self, name):
+        return any(name in f.names for f in self.filters)
+
+    def __iter__(self):
+        return (name for f in self.filters for name in f.names)
+
+    def __shape(self, args):
+        shape = tuple(f.shape(args) for f in self.filters)
+        sort = args.get('sort') if self.sort else None
+        if sort is not None and sort.lstrip('-') not in self.sort:
+            raise InvalidRequest('Invalid sort: should be one of ' + ', '.join(self.sort), 400, type = 'SortError')
+        return shape, sort
+
+    def __compile(self, model, shape):
+        filter_shapes, sort = shape
+        criteria = []
+        for f, filter_shape in zip(self.filters, filter_shapes):
+            if filter_shape is not None:
+                criteria.extend(f.clauses(getattr(model, f.column), filter_shape))
+        order = []
+        if sort is not None:
+            descending = sort.startswith('-')
+            primary_key = model.__mapper__.primary_key[0]
+            for column in (getattr(model, sort.lstrip('-')), primary_key):
+                order.append(column.desc() if descending else column.asc())
+        return criteria, order
+
+    def plan(self, model, args):
+        """The cached (criteria, order_by) of the shape of args"""
+        shape = self.__shape(args)
+        key = (model, shape)
+        plan = self.__plans.get(key)
+        if plan is None:
+            with self.__lock:
+                plan = self.__plans.get(key)
+                if plan is None:
+                    plan = self.__plans[key] = self.__compile(model, shape)
+        return plan
+
+    def apply(self, model, query, args):
+        criteria, order = self.plan(model, args)
+        params = {}
+        try:
+            for f in self.filters:
+                if f.shape(args) is not None:
+                    params.update(f.params(getattr(model, f.column), args))
+        except ValueError as err:
+            raise InvalidRequest('Invalid query params!', 400, type = 'FilterError', payload = {'error': str(err)})
+        if criteria:
+            query = query.filter(*criteria).params(**params)
+        if order:
+            query = query.order_by(*order)
+        return query
@@ -0,0 +1,198 @@
+import functools
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (seconds) of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+class RequestMetrics():
+    """Counters of the request being served, kept on flask.g"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.phases = {}
+
+    def add(self, phase, elapsed):
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+
+def current():
+    if has_request_context():
+        return g.get('_metrics')
+    return None
+
+@contextmanager
+def timer(phase):
+    """Add the time spent in the block to the phase of the current request"""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(phase, time.perf_counter() - started)
+
+def timed(phase):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with timer('json'):
+            return super().encode(o)
+
+# The start time lives on the execution context, not on the pooled
+# connection, so a statement that raises (no after_cursor_execute) leaves
+# nothing behind
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    metrics = current()
+    if metrics is not None and started is not None:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - started
+
+class RouteHistogram():
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.phases = {}
+
+    def observe(self, elapsed, metrics):
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.duration += elapsed
+        self.queries += metrics.queries
+        self.db_time += metrics.db_time
+        for phase, value in metrics.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + value
+
+class Registry():
+    """Per route aggregates of this worker process"""
+
+    def __init__(self):
+        self.routes = {}
+        self.gauges = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, method, endpoint, status, elapsed, metrics):
+        key = (method, endpoint, status)
+        with self.__lock:
+            histogram = self.routes.get(key)
+            if histogram is None:
+                histogram = self.routes[key] = RouteHistogram()
+            histogram.observe(elapsed, metrics)
+
+    def gauge(self, name, func):
+        """Register a function returning a {label: value} dict exported as name"""
+        self.gauges[name] = func
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        with self.__lock:
+            routes = sorted(self.routes.items())
+            lines.append('# TYPE myexpense_request_duration_seconds histogram')
+            for (method, endpoint, status), h in routes:
+                labels = 'method="{}",endpoint="{}",status="{}"'.format(method, endpoint, status)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('myexpense_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+                lines.append('myexpense_request_duration_seconds_sum{{{}}} {:.6f}'.format(labels, h.duration))
+                lines.append('myexpense_request_duration_seconds_count{{{}}} {}'.format(labels, h.count))
+            lines.append('# TYPE myexpense_db_queries_total counter')
+            for (method, endpoint, status), h in routes:
+                lines.append('myexpense_db_queries_total{{method="{}",endpoint="{}",status="{}"}} {}'.format(method, endpoint, status, h.queries))
+            lines.append('# TYPE myexpense_db_duration_seconds_total counter')
+            for (method, endpoint, status), h in routes:
+                lines.append('myexpense_db_duration_seconds_total{{method="{}",endpoint="{}",status="{}"}} {:.6f}'.format(method, endpoint, status, h.db_time))
+            lines.append('# TYPE myexpense_phase_duration_seconds_total counter')
+            for (method, endpoint, status), h in routes:
+                for phase, value in sorted(h.phases.items()):
+                    lines.append('myexpense_phase_duration_seconds_total{{method="{}",endpoint="{}",status="{}",phase="{}"}} {:.6f}'.format(method, endpoint, status, phase, value))
+        for name, func in sorted(self.gauges.items()):
+            lines.append('# TYPE myexpense_{} gauge'.format(name))
+            for label, value in sorted(func().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('myexpense_{}{{stat="{}"}} {}'.format(name, label, value))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def server_timing(metrics, total):
+    parts = ['db;dur={:.2f};desc="{} queries"'.format(metrics.db_time * 1000, metrics.queries)]
+    for phase, value in sorted(metrics.phases.items()):
+        parts.append('{};dur={:.2f}'.format(phase, value * 1000))
+    parts.append('total;dur={:.2f}'.format(total * 1000))
+    return ', '.join(parts)
+
+def allowed(config):
+    """/metrics is opt-in: served to the addresses of METRICS_ALLOWED_IPS and
+    to requests with an "Authorization: Bearer <METRICS_TOKEN>" header"""
+    token = config.get('METRICS_TOKEN')
+    allowed_ips = config.get('METRICS_ALLOWED_IPS') or ()
+    if not token and not allowed_ips:
+        abort(404)
+    if request.remote_addr in allowed_ips:
+        return True
+    header = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(header.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8'))
+
+def init_app(app):
+    """Time every request, add a Server-Timing header and serve /metrics.
+    METRICS_ENABLED and SERVER_TIMING (both on by default) turn them off,
+    /metrics also needs METRICS_TOKEN or METRICS_ALLOWED_IPS."""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_request_metrics():
+        g._metrics = RequestMetrics()
+
+    @app.after_request
+    def record_request_metrics(response):
+        metrics = g.get('_metrics')
+        if metrics is None:
+            return response
+        total = time.perf_counter() - metrics.started
+        if app.config.get('SERVER_TIMING', True):
+            response.headers['Server-Timing'] = server_timing(metrics, total)
+        registry.observe(request.method, request.endpoint or 'unmatched', response.status_code, total, metrics)
+        return response
+
+    def metrics_view():
+        if not allowed(app.config):
+            abort(403)
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
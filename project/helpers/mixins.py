@@ -1,11 +1,11 @@
 from .. import db
-from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from ..exceptions import InvalidRequest, ValidationApiError
+from .filters import FilterSpec
 from marshmallow.exceptions import ValidationError
 
 class ModelMixin(object):
-    filters = []
+    filters = FilterSpec()
 
     @classmethod
     def create(cls, **kw):
@@ -39,14 +39,4 @@ class ModelMixin(object):
     def filter(cls, args, query = None):
         if query is None:
             query = cls.query
-        for filter in cls.filters:
-            if(args.get(filter) is not None):
-                values = args.get(filter).split(',')
-                f = []
-                if len(values) > 1:
-                    for v in values:
-                        f.append(cls.__dict__[filter] == v)
-                    query = query.filter(or_(*f))
-                else:
-                    query = query.filter_by(**{filter:values[0]})
-        return query
\ No newline at end of file
+        return cls.filters.apply(cls, query, args)
@@ -1,15 +1,56 @@
+import base64
+import datetime
+import json
 from math import ceil
 
+from sqlalchemy import and_, func, or_
+
+from ..exceptions import InvalidRequest
+from .cache import ConfiguredCache
+from .metrics import timed
+
+# Short lived cache of the per-user totals used by include_total=cached
+count_cache = ConfiguredCache('PAGINATION_COUNT_CACHE', maxsize=4096, ttl=30, shared=False)
+
+def encode_cursor(values):
+    """Encode the seek values of a row into an opaque cursor"""
+    values = [v.isoformat() if isinstance(v, datetime.date) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, columns):
+    """Decode an opaque cursor into typed seek values for the given columns"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('Cursor length mismatch')
+        decoded = []
+        for column, value in zip(columns, values):
+            python_type = column.type.python_type
+            if python_type is datetime.date:
+                value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            else:
+                value = python_type(value)
+            decoded.append(value)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise InvalidRequest('Invalid cursor!', 400, type = 'CursorError')
+    return decoded
+
 class Pagination():
     page = None
     per_page = None
     label = None
     data = None
     total = None
+    cursor = None
+    next_cursor = None
 
     __request = None
+    __more = False
 
-    def __init__(self, query, request, label = "data"):
+    @timed('pagination')
+    def __init__(self, query, request, label = "data", cursor_columns = None, owner = None):
         if(request.args.get('page')):
             try:
                 page = int(request.args.get('page'))
@@ -24,16 +65,69 @@ class Pagination():
                 per_page = 20
         else:
             per_page = 20
+        if per_page < 1:
+            raise InvalidRequest('Invalid query params: per_page should be at least 1', 400, type = 'PaginationError')
         self.page = page
         self.per_page = per_page
         self.label = label
-        self.total = query.count()
-        self.data = query.limit(per_page).offset((page - 1) * per_page).all()
         self.__request = request
+        if cursor_columns is not None and request.args.get('after') is not None:
+            self.__seek(query, cursor_columns, request.args.get('after'))
+        else:
+            self.__offset(query, request.args.get('include_total', 'true').lower(), owner)
+
+    def __offset(self, query, include_total, owner):
+        """Offset pagination, include_total picks how (and if) the total is counted"""
+        offset = (self.page - 1) * self.per_page
+        if include_total in ('false', '0', 'no'):
+            rows = query.limit(self.per_page + 1).offset(offset).all()
+            self.data = rows[:self.per_page]
+            self.__more = len(rows) > self.per_page
+        elif include_total == 'window':
+            rows = query.add_columns(func.count().over()).limit(self.per_page).offset(offset).all()
+            self.data = [row[0] for row in rows]
+            if rows:
+                self.total = rows[0][-1]
+            else:
+                self.total = 0 if self.page == 1 else query.count()
+        else:
+            if include_total == 'cached' and owner is not None:
+                key = (owner, self.__request.path, tuple(sorted((k, v) for k, v in self.__request.args.items(multi=True) if k not in ('page', 'per_page', 'include_total'))))
+                self.total = count_cache.get(key)
+                if self.total is None:
+                    self.total = query.count()
+                    count_cache.set(key, self.total)
+            else:
+                self.total = query.count()
+            self.data = query.limit(self.per_page).offset(offset).all()
+
+    def __seek(self, query, columns, cursor):
+        """Keyset pagination: newest first, seeking past the cursor on an index"""
+        self.page = None
+        self.cursor = cursor
+        if cursor:
+            values = decode_cursor(cursor, columns)
+            seek = []
+            for i, column in enumerate(columns):
+                seek.append(and_(*[c == v for c, v in zip(columns[:i], values[:i])], column < values[i]))
+            query = query.filter(columns[0] <= values[0], or_(*seek))
+        query = query.order_by(None).order_by(*[c.desc() for c in columns])
+        rows = query.limit(self.per_page + 1).all()
+        self.data = rows[:self.per_page]
+        if len(rows) > self.per_page:
+            last = self.data[-1]
+            self.next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+
+    @property
+    def is_cursor(self):
+        """True if the page was fetched in keyset (cursor) mode"""
+        return self.cursor is not None
 
     @property
     def pages(self):
         """The total number of pages"""
+        if self.total is None:
+            return None
         if self.per_page == 0:
             pages = 0
         else:
@@ -43,6 +137,8 @@ class Pagination():
     @property
     def has_prev(self):
         """True if a previous page exists"""
+        if self.is_cursor:
+            return False
         return self.page > 1
 
     @property
@@ -55,6 +151,10 @@ class Pagination():
     @property
     def has_next(self):
         """True if a next page exists"""
+        if self.is_cursor:
+            return self.next_cursor is not None
+        if self.total is None:
+            return self.__more
         return self.page < self.pages
 
     @property
@@ -66,6 +166,18 @@ class Pagination():
 
     def paginated_json(self, data):
         json_response = {}
+        if self.is_cursor:
+            return {
+                self.label: data,
+                "pagination_metadata": {
+                    "_links" : {
+                        "next" : self.next_url,
+                        "prevoius" : None,
+                    },
+                    "per_page": self.per_page,
+                    "next": self.next_cursor
+                }
+            }
         json_response = {
             self.label: data,
             "pagination_metadata": {
@@ -85,6 +197,8 @@ class Pagination():
         args = self.__request.args.copy()
         if not self.has_next:
             return None
+        if self.is_cursor:
+            return self.__request.path + '?' + ''.join(['&%s=%s' % (key, value) for (key, value) in args.items() if key != "after" and key != "per_page"]) + '&after=' + self.next_cursor + '&per_page=' + str(self.per_page)
         return self.__request.path + '?' + ''.join(['&%s=%s' % (key, value) for (key, value) in args.items() if key != "page" and key != "per_page"]) + '&page=' + str(self.next_num) + '&per_page=' + str(self.per_page)
 
     def get_previous_url(self):
@@ -0,0 +1,47 @@
+import time
+
+from flask import current_app
+
+from .. import bcrypt
+
+def _time_hash(rounds, repeat = 1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        bcrypt.generate_password_hash('calibration', rounds)
+    return (time.perf_counter() - started) / repeat
+
+def calibrate(target_ms, min_rounds = 4, max_rounds = 16, time_hash = _time_hash):
+    """Largest bcrypt cost whose hash takes at most target_ms on this machine,
+    time_hash(rounds, repeat) gives the seconds of one hash"""
+    target = target_ms / 1000.0
+    rounds = min_rounds
+    elapsed = time_hash(rounds, 3)
+    # Every extra round doubles the work
+    while rounds < max_rounds and elapsed * 2 <= target:
+        rounds += 1
+        elapsed *= 2
+    measured = time_hash(rounds, 1)
+    while rounds > min_rounds and measured > target:
+        rounds -= 1
+        measured /= 2
+    return rounds
+
+def target_rounds():
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
+def hash_cost(pw_hash):
+    """Cost stored in a $2b$NN$... bcrypt hash"""
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode('utf-8')
+    return int(pw_hash.split('$')[2])
+
+def hash_password(password):
+    return bcrypt.generate_password_hash(password, target_rounds())
+
+def verify_password(user, password):
+    """Check the password of user, rehashing it with the current cost when it differs"""
+    if not bcrypt.check_password_hash(user.password, password):
+        return False
+    if hash_cost(user.password) != target_rounds():
+        user.update({'password': hash_password(password)})
+    return True
@@ -0,0 +1,60 @@
+from flask import _request_ctx_stack, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import cache
+
+# Requests that cannot write, their reads may go to the replica
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Users who wrote in the last REPLICA_STICKY_TTL seconds (5 by default),
+# shared by every worker when REPLICA_STICKY_URL is set
+sticky_writers = cache.ConfiguredCache('REPLICA_STICKY', maxsize=10000, ttl=5)
+
+def recent_writers(app):
+    return sticky_writers.for_app(app)
+
+def replica_bind(app):
+    """Bind key of the read replica, None unless it is in SQLALCHEMY_BINDS"""
+    key = app.config.get('SQLALCHEMY_READ_REPLICA', 'replica')
+    return key if key in (app.config.get('SQLALCHEMY_BINDS') or {}) else None
+
+def request_user_id():
+    top = _request_ctx_stack.top
+    principal = getattr(top, 'current_identity', None) or getattr(top, 'user', None)
+    return getattr(principal, 'user_id', None)
+
+def reads_from_replica(session):
+    """Reads go to the replica during read-only requests or db.replica()
+    blocks, unless the session already wrote or the user of the request
+    wrote within the sticky window (read your own writes)"""
+    if session.info.get('wrote'):
+        return False
+    in_request = has_request_context()
+    if not session.info.get('replica') and not (in_request and request.method in SAFE_METHODS):
+        return False
+    if in_request:
+        user_id = request_user_id()
+        if user_id is not None and recent_writers(session.app).get(str(user_id)):
+            return False
+    return True
+
+@event.listens_for(Session, 'after_flush')
+def stick_session_to_primary(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def stick_session_to_primary_after_bulk(context):
+    context.session.info['wrote'] = True
+
+# Inserted first so it runs before the bumped versions are forgotten
+@event.listens_for(Session, 'after_commit', insert=True)
+def stick_writers_to_primary(session):
+    """Keep the users whose data version was bumped on the primary for a while"""
+    app = getattr(session, 'app', None)
+    if app is None or replica_bind(app) is None:
+        return
+    writers = recent_writers(app)
+    for user_id in session.info.get('bumped_versions', ()):
+        writers.set(str(user_id), True)
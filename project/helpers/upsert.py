@@ -0,0 +1,26 @@
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+def increment(session, table, key, column, delta, **values):
+    """Add delta to column of the row of table matching key (a dict of
+    primary key values), inserting the row with key, values and
+    column = delta when it does not exist.
+
+    Two transactions can both miss the row and insert it: the INSERT runs
+    in a savepoint, and the one that loses the race on the primary key
+    rolls the savepoint back and adds its delta with the UPDATE instead."""
+    where = and_(*[table.c[name] == value for name, value in key.items()])
+    update = table.update().where(where).values({column: table.c[column] + delta})
+    if session.execute(update).rowcount:
+        return
+    row = dict(key, **values)
+    row[column] = delta
+    connection = session.connection()
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(row))
+    except IntegrityError:
+        savepoint.rollback()
+        session.execute(update)
+    else:
+        savepoint.commit()
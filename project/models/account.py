@@ -1,14 +1,17 @@
 import datetime
 
-from marshmallow import fields
+from marshmallow import fields, validate
 
 from .. import db
 from .. import ma
+from ..helpers.filters import FilterSpec, In
 from ..helpers.mixins import ModelMixin
+# Mapped before AccountSchema configures the mappers, for the expenses relationship
+from ..models.expense import Expense
 
 class Account(ModelMixin, db.Model):
 
-    filters = ['name']
+    filters = FilterSpec(In('name'), sort = ('name',))
 
     __tablename__ = 'accounts'
 
@@ -18,6 +21,8 @@ class Account(ModelMixin, db.Model):
     has_plafond = db.Column(db.Boolean, nullable=False, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
     initial_balance = db.Column(db.Integer, nullable=True)
+    # Day of the month a plafond statement cycle starts, PLAFOND_STATEMENT_DAY when null
+    statement_day = db.Column(db.Integer, nullable=True)
     expenses = db.relationship('Expense', backref="account", lazy='dynamic')
 
     def __repr__(self):
@@ -25,6 +30,7 @@ class Account(ModelMixin, db.Model):
 
 class AccountSchema(ma.ModelSchema):
     expenses = fields.Nested('ExpenseSchema', many=True, exclude=('account', ))
+    statement_day = fields.Int(allow_none=True, validate=validate.Range(min=1, max=28))
     _links = ma.Hyperlinks(
         {"self": ma.URLFor("api.api_accounts_get_item", account_id="<account_id>"), 
         "collection": ma.URLFor("api.api_accounts_get_items")
@@ -0,0 +1,165 @@
+import datetime
+
+import numpy as np
+from sqlalchemy import select
+
+from .. import db
+from ..exceptions import InvalidRequest
+from ..helpers import cache
+from ..helpers.metrics import timed
+from ..models.account import Account
+from ..models.expense import Expense
+from ..models.snapshot import month_of
+from ..models.version import DataVersion
+
+# Keyed on the data version of the user like the balance cache, so every
+# ModelMixin write (and the batch endpoints) makes the next read reload.
+# Arrays are not JSON, the cache is always local to the process.
+columns_cache = cache.ConfiguredCache('ANALYTICS_CACHE', maxsize=64, ttl=300, shared=False)
+
+PERCENTILES = (50, 90)
+
+class Columns:
+    """The expenses of a user as NumPy columns sorted by date: day ordinals,
+    int64 amounts, and categories and accounts as int32 codes into
+    category_names and account_ids"""
+
+    def __init__(self, days, amounts, categories, category_names, accounts, account_ids, has_plafond, initial):
+        self.days = days
+        self.amounts = amounts
+        self.categories = categories
+        self.category_names = category_names
+        self.accounts = accounts
+        self.account_ids = account_ids
+        self.has_plafond = has_plafond
+        self.initial = initial
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    @timed('analytics_load')
+    @db.replica()
+    def load(cls, user_id):
+        table = Expense.__table__
+        rows = db.session.execute(select([table.c.date, table.c.amount, table.c.category, table.c.account_id]).where(table.c.user_id == user_id).order_by(table.c.date, table.c.expense_id)).fetchall()
+        accounts = db.session.query(Account.account_id, Account.has_plafond, Account.plafond, Account.initial_balance).filter(Account.user_id == user_id).order_by(Account.account_id).all()
+        account_ids = np.array([a.account_id for a in accounts], dtype=np.int64)
+        has_plafond = np.array([bool(a.has_plafond) for a in accounts], dtype=bool)
+        initial = np.array([(a.plafond if a.has_plafond else a.initial_balance) or 0 for a in accounts], dtype=np.int64)
+        if not rows:
+            empty = np.zeros(0, dtype=np.int32)
+            return cls(empty, np.zeros(0, dtype=np.int64), empty, [], empty, account_ids, has_plafond, initial)
+        dates, amounts, categories, expense_accounts = zip(*rows)
+        days = np.fromiter((d.toordinal() for d in dates), dtype=np.int32, count=len(rows))
+        category_names, category_codes = np.unique(np.array(categories, dtype=object), return_inverse=True)
+        account_codes = np.searchsorted(account_ids, np.array(expense_accounts, dtype=np.int64))
+        return cls(days, np.array(amounts, dtype=np.int64), category_codes.astype(np.int32), list(category_names), account_codes.astype(np.int32), account_ids, has_plafond, initial)
+
+    @classmethod
+    def cached(cls, user_id):
+        """Columns.load(user_id) served from columns_cache while the user's data is unchanged"""
+        if DataVersion.uncommitted(user_id):
+            return cls.load(user_id)
+        key = (user_id, DataVersion.current(user_id))
+        columns = columns_cache.get(key)
+        if columns is None:
+            columns = cls.load(user_id)
+            columns_cache.set(key, columns)
+        return columns
+
+    def account_mask(self, accounts=None):
+        """Selected account codes, the accounts without plafond by default like Balance"""
+        if accounts is None:
+            return ~self.has_plafond
+        return np.isin(self.account_ids, np.array(accounts, dtype=np.int64))
+
+    def expense_mask(self, accounts=None, categories=None, from_date=None, to_date=None):
+        """Selected expenses, of the accounts without plafond by default like account_mask"""
+        mask = self.account_mask(accounts)[self.accounts]
+        if categories is not None:
+            codes = [self.category_names.index(c) for c in categories if c in self.category_names]
+            mask &= np.isin(self.categories, np.array(codes, dtype=np.int32))
+        if from_date is not None:
+            mask &= self.days >= from_date.toordinal()
+        if to_date is not None:
+            mask &= self.days <= to_date.toordinal()
+        return mask
+
+def balance_at(columns, dates, accounts=None):
+    """Balance at the end of each of dates, as BalanceSeries computes it:
+    accounts from their initial_balance plus every expense up to the date,
+    plafond accounts from their plafond plus the expenses of the month of
+    the date up to the date"""
+    targets = np.array([d.toordinal() for d in dates], dtype=np.int32)
+    selected = columns.account_mask(accounts)
+    result = np.full(len(targets), columns.initial[selected].sum(), dtype=np.int64)
+    if not len(columns):
+        return result.tolist()
+    in_scope = selected[columns.accounts]
+    for plafond in (False, True):
+        mask = in_scope & (columns.has_plafond[columns.accounts] == plafond)
+        days = columns.days[mask]
+        running = np.concatenate(([0], np.cumsum(columns.amounts[mask])))
+        ends = np.searchsorted(days, targets, side='right')
+        if plafond:
+            month_starts = np.array([month_of(d).toordinal() for d in dates], dtype=np.int32)
+            result += running[ends] - running[np.searchsorted(days, month_starts, side='left')]
+        else:
+            result += running[ends]
+    return result.tolist()
+
+def category_stats(columns, from_date=None, to_date=None, accounts=None):
+    """Count, total, mean, min, max and percentiles of the amounts of each
+    category, and its share of the outflows (the category mix)"""
+    mask = columns.expense_mask(accounts, None, from_date, to_date)
+    codes = columns.categories[mask]
+    amounts = columns.amounts[mask]
+    if not len(amounts):
+        return []
+    # Sorting by category then amount puts every group in a contiguous,
+    # ordered run, so the percentiles are index arithmetic on the runs
+    order = np.lexsort((amounts, codes))
+    codes, amounts = codes[order], amounts[order]
+    present, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+    totals = np.add.reduceat(amounts, starts)
+    outflows = np.add.reduceat(np.minimum(amounts, 0), starts)
+    all_outflows = outflows.sum()
+    stats = {
+        'count': counts,
+        'total': totals,
+        'mean': totals / counts,
+        'min': amounts[starts],
+        'max': amounts[starts + counts - 1],
+        'share': outflows / all_outflows if all_outflows else np.zeros(len(present)),
+    }
+    for p in PERCENTILES:
+        position = starts + (counts - 1) * p / 100.0
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        stats['p{}'.format(p)] = amounts[low] + (amounts[high] - amounts[low]) * (position - low)
+    result = []
+    for i, code in enumerate(present):
+        item = {'category': columns.category_names[code]}
+        for name, values in stats.items():
+            value = values[i]
+            item[name] = int(value) if name in ('count', 'total', 'min', 'max') else round(float(value), 4 if name == 'share' else 2)
+        result.append(item)
+    return result
+
+def moving_average(columns, from_date, to_date, window=30, accounts=None, categories=None):
+    """Daily total of the expenses between from_date and to_date and its
+    average over the window days ending on each day"""
+    if window < 1:
+        raise InvalidRequest('Invalid query params: window should be at least 1', 400, type = 'WindowError')
+    first = from_date.toordinal() - window + 1
+    last = to_date.toordinal()
+    mask = columns.expense_mask(accounts, categories, datetime.date.fromordinal(first), to_date)
+    totals = np.bincount(columns.days[mask] - first, weights=columns.amounts[mask], minlength=last - first + 1).astype(np.int64)
+    running = np.concatenate(([0], np.cumsum(totals)))
+    averages = (running[window:] - running[:-window]) / float(window)
+    totals = totals[window - 1:]
+    return [
+        {'date': datetime.date.fromordinal(from_date.toordinal() + i), 'total': int(total), 'average': round(float(average), 2)}
+        for i, (total, average) in enumerate(zip(totals, averages))
+    ]
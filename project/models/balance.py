@@ -1,15 +1,61 @@
 import datetime
+from itertools import groupby
 from dateutil.relativedelta import *
 
+from flask import current_app
 from marshmallow import fields
+from sqlalchemy import case, extract, literal, union_all
 from sqlalchemy.sql import func
 
 from .. import db
 from .. import ma
 from ..exceptions import InvalidRequest
+from ..helpers import cache
+from ..helpers.metrics import timed
 from ..models.account import Account
 from ..models.expense import Expense
+from ..models.snapshot import MonthlySnapshot, month_of
+from ..models.version import DataVersion
 
+# Keys carry the data version of the user, which every Expense or Account
+# write bumps, so an entry can only be served for the data it was computed
+# from. Superseded entries are never read again and age out of the LRU.
+balance_cache = cache.ConfiguredCache('BALANCE_CACHE', maxsize=1024, ttl=300)
+
+SERIES_STEPS = ('day', 'week', 'month')
+
+def _day(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+def series_length(from_date, to_date, step):
+    """Number of points series_dates returns, computed without building them"""
+    if from_date > to_date:
+        return 0
+    if step == 'week':
+        return ((to_date - datetime.timedelta(days=to_date.weekday())) - (from_date - datetime.timedelta(days=from_date.weekday()))).days // 7 + 1
+    if step == 'month':
+        return (to_date.year - from_date.year) * 12 + to_date.month - from_date.month + 1
+    return (to_date - from_date).days + 1
+
+def series_dates(from_date, to_date, step, max_points=None):
+    """The last day of every step between from_date and to_date, the last one
+    clamped to to_date. Raises SeriesTooLong beyond max_points, before
+    building any date."""
+    if max_points is not None and series_length(from_date, to_date, step) > max_points:
+        raise InvalidRequest('Invalid query params: the series is limited to {} points, use a longer step or a shorter period'.format(max_points), 400, type = 'SeriesTooLong')
+    dates = []
+    day = from_date
+    while day <= to_date:
+        if step == 'week':
+            end = day + datetime.timedelta(days=6 - day.weekday())
+        elif step == 'month':
+            end = month_of(day) + relativedelta(months=1, days=-1)
+        else:
+            end = day
+        end = min(end, to_date)
+        dates.append(end)
+        day = end + datetime.timedelta(days=1)
+    return dates
 
 
 class Balance:
@@ -18,45 +64,261 @@ class Balance:
     end_period_balance = None
     account = None
 
-    def __init__(self, user_id, account=None, from_date=None, to_date=None, m_date=None):
+    @timed('balance')
+    @db.replica()
+    def __init__(self, user_id, account=None, from_date=None, to_date=None, m_date=None, accounts=None):
         self.account = account
-        query = db.session.query(func.sum(Expense.amount))
+        today = datetime.date.today()
+        from_date = from_date if from_date is not None else datetime.date.min
+        to_date = to_date if to_date is not None else today
+        m_date = m_date if m_date is not None else datetime.date(today.year, today.month, 1)
 
+        account_filter = [Account.user_id == user_id]
         if account is not None:
-            query = query.filter(Expense.account_id == account.account_id)
-            initial_balance = account.initial_balance
-            if account.has_plafond == True:
-                initial_balance = account.plafond
-        else:
-            accounts = db.session.query(Account.account_id, Account.initial_balance).filter(Account.user_id==user_id, Account.has_plafond==False).all()
-            query = query.filter(Expense.account_id.in_((x[0] for x in accounts)))
-            initial_balance = sum(x[1] for x in accounts)
-
-        if account is not None and account.has_plafond == True:
-            current_balance = query.filter(Expense.date <= datetime.date.today(), Expense.date >= datetime.date(datetime.date.today().year, datetime.date.today().month, 1)).scalar()
-            start_period_balance = 0
-            end_period_balance = query.filter(Expense.date <= m_date + relativedelta(months=1) - relativedelta(days=-1), Expense.date >= m_date).scalar()
+            account_filter.append(Account.account_id == account.account_id)
+        elif accounts is not None:
+            account_ids = [getattr(a, 'account_id', a) for a in accounts]
+            account_filter.append(Account.account_id.in_(account_ids))
         else:
-            current_balance = query.filter(Expense.date <= datetime.date.today()).scalar()
-            start_period_balance = query.filter(Expense.date < from_date).scalar()
-            end_period_balance = query.filter(Expense.date <= to_date).scalar()
-        
-        initial_balance = initial_balance if initial_balance is not None else 0
+            account_filter.append(Account.has_plafond == False)
+
+        # Whole months come from the snapshots, only the partial month of each
+        # boundary is summed from the raw expenses
+        current_month = month_of(today)
+        from_month = month_of(from_date)
+        to_month = month_of(to_date)
+        month_end = m_date + relativedelta(months=1) - relativedelta(days=-1)
+
+        def snapshot_when(*conditions):
+            return func.sum(case([(db.and_(*conditions), MonthlySnapshot.amount)], else_=0))
+
+        def amount_when(*conditions):
+            return func.sum(case([(db.and_(*conditions), Expense.amount)], else_=0))
+
+        snapshots = db.session.query(
+            MonthlySnapshot.account_id.label('account_id'),
+            snapshot_when(MonthlySnapshot.month < current_month).label('current'),
+            literal(0).label('current_month'),
+            snapshot_when(MonthlySnapshot.month < from_month).label('start_period'),
+            snapshot_when(MonthlySnapshot.month < to_month).label('end_period'),
+            literal(0).label('month'),
+        ).join(Account, Account.account_id == MonthlySnapshot.account_id).filter(MonthlySnapshot.user_id == user_id, *account_filter).group_by(MonthlySnapshot.account_id)
+
+        partial = db.session.query(
+            Expense.account_id.label('account_id'),
+            amount_when(Expense.date >= current_month, Expense.date <= today).label('current'),
+            amount_when(Expense.date >= current_month, Expense.date <= today).label('current_month'),
+            amount_when(Expense.date >= from_month, Expense.date < from_date).label('start_period'),
+            amount_when(Expense.date >= to_month, Expense.date <= to_date).label('end_period'),
+            amount_when(Expense.date <= month_end, Expense.date >= m_date).label('month'),
+        ).join(Account, Account.account_id == Expense.account_id).filter(Expense.user_id == user_id, *account_filter).filter(db.or_(
+            Expense.date.between(current_month, today),
+            db.and_(Expense.date >= from_month, Expense.date < from_date),
+            Expense.date.between(to_month, to_date),
+            Expense.date.between(m_date, month_end),
+        )).group_by(Expense.account_id)
+
+        rows = union_all(snapshots, partial).alias('balance_rows')
+        sums = db.session.query(
+            rows.c.account_id.label('account_id'),
+            func.sum(rows.c.current).label('current'),
+            func.sum(rows.c.current_month).label('current_month'),
+            func.sum(rows.c.start_period).label('start_period'),
+            func.sum(rows.c.end_period).label('end_period'),
+            func.sum(rows.c.month).label('month'),
+        ).group_by(rows.c.account_id).subquery()
 
-        current_balance = current_balance if current_balance is not None else 0
-        self.current_balance = current_balance + initial_balance
+        def per_account(plafond_value, value):
+            return func.sum(case([(Account.has_plafond == True, plafond_value)], else_=func.coalesce(value, 0)))
 
-        start_period_balance = start_period_balance if start_period_balance is not None else 0
-        self.start_period_balance = start_period_balance + initial_balance
+        row = db.session.query(
+            per_account(func.coalesce(Account.plafond, 0), Account.initial_balance).label('initial'),
+            per_account(func.coalesce(sums.c.current_month, 0), sums.c.current).label('current'),
+            per_account(0, sums.c.start_period).label('start_period'),
+            per_account(func.coalesce(sums.c.month, 0), sums.c.end_period).label('end_period'),
+        ).select_from(Account).outerjoin(sums, sums.c.account_id == Account.account_id).filter(*account_filter).one()
+
+        initial_balance = row.initial if row.initial is not None else 0
+        self.current_balance = (row.current or 0) + initial_balance
+        self.start_period_balance = (row.start_period or 0) + initial_balance
+        self.end_period_balance = (row.end_period or 0) + initial_balance
+
+    @classmethod
+    def cached(cls, user_id, account=None, from_date=None, to_date=None, m_date=None, accounts=None):
+        """Balance(...) served from balance_cache while the user's data is unchanged"""
+        if not current_app.config.get('BALANCE_CACHE_ENABLED', True) or DataVersion.uncommitted(user_id):
+            return cls(user_id, account, from_date, to_date, m_date, accounts)
+        today = datetime.date.today()
+        if account is not None:
+            scope = str(account.account_id)
+        elif accounts is not None:
+            scope = ','.join(str(i) for i in sorted(set(getattr(a, 'account_id', a) for a in accounts)))
+        else:
+            scope = '*'
+        key = 'balance:{}:{}:{}:{}:{}:{}:{}'.format(user_id, DataVersion.current(user_id), scope, _day(from_date), _day(to_date), _day(m_date), today)
+        values = balance_cache.get(key)
+        if values is None:
+            balance = cls(user_id, account, from_date, to_date, m_date, accounts)
+            balance_cache.set(key, [balance.current_balance, balance.start_period_balance, balance.end_period_balance])
+            return balance
+        balance = cls.__new__(cls)
+        balance.account = account
+        balance.current_balance, balance.start_period_balance, balance.end_period_balance = values
+        return balance
 
-        end_period_balance = end_period_balance if end_period_balance is not None else 0
-        self.end_period_balance = end_period_balance + initial_balance
-    
     def __repr__(self):
         return "<Balance: current_balance {0} - start_period_balance {1} - end_period_balance {2}>".format(self.current_balance, self.start_period_balance, self.end_period_balance)
 
+class BalanceSeries:
+    """Balance at the end of every day, week or month of a period.
+
+    Accounts start from their initial_balance and plafond accounts from
+    their plafond, like Balance. A plafond account counts only the
+    expenses of the month of each date, so its running sum restarts every
+    month. One query: the snapshots of the whole months before from_date
+    seed the running sums, SUM() OVER (ORDER BY day) adds up the daily
+    totals of the period and the dates without expenses carry the last
+    value forward."""
+
+    account = None
+
+    @timed('balance_series')
+    @db.replica()
+    def __init__(self, user_id, from_date, to_date, step='day', account=None, accounts=None):
+        self.account = account
+        self.step = step
+        self.from_date = from_date
+        self.to_date = to_date
+        dates = series_dates(from_date, to_date, step, current_app.config.get('BALANCE_SERIES_MAX_POINTS', 1000))
+
+        account_filter = [Account.user_id == user_id]
+        if account is not None:
+            account_filter.append(Account.account_id == account.account_id)
+        elif accounts is not None:
+            account_ids = [getattr(a, 'account_id', a) for a in accounts]
+            account_filter.append(Account.account_id.in_(account_ids))
+        else:
+            account_filter.append(Account.has_plafond == False)
+
+        from_month = month_of(from_date)
+        seed_day = from_date - datetime.timedelta(days=1)
+        period = case([(Account.has_plafond == True, extract('year', Expense.date) * 100 + extract('month', Expense.date))], else_=0)
+
+        snapshots = db.session.query(
+            MonthlySnapshot.account_id.label('account_id'),
+            literal(0).label('period'),
+            literal(seed_day).label('day'),
+            MonthlySnapshot.amount.label('amount'),
+        ).join(Account, Account.account_id == MonthlySnapshot.account_id).filter(MonthlySnapshot.user_id == user_id, MonthlySnapshot.month < from_month, Account.has_plafond == False, *account_filter)
+
+        expenses = db.session.query(
+            Expense.account_id.label('account_id'),
+            period.label('period'),
+            case([(Expense.date < from_date, seed_day)], else_=Expense.date).label('day'),
+            Expense.amount.label('amount'),
+        ).join(Account, Account.account_id == Expense.account_id).filter(Expense.user_id == user_id, Expense.date.between(from_month, to_date), *account_filter)
+
+        rows = union_all(snapshots, expenses).alias('series_rows')
+        running = db.session.query(
+            rows.c.account_id.label('account_id'),
+            rows.c.day.label('day'),
+            func.sum(func.sum(rows.c.amount)).over(partition_by=(rows.c.account_id, rows.c.period), order_by=rows.c.day).label('running'),
+        ).group_by(rows.c.account_id, rows.c.period, rows.c.day).subquery()
+
+        result = db.session.query(
+            Account.account_id, Account.has_plafond, Account.plafond, Account.initial_balance, running.c.day, running.c.running,
+        ).outerjoin(running, running.c.account_id == Account.account_id).filter(*account_filter).order_by(Account.account_id, running.c.day)
+
+        balances = [0] * len(dates)
+        for account_id, account_rows in groupby(result, key=lambda row: row.account_id):
+            account_rows = list(account_rows)
+            has_plafond = account_rows[0].has_plafond
+            initial = (account_rows[0].plafond if has_plafond else account_rows[0].initial_balance) or 0
+            days = [(_day(row.day), row.running) for row in account_rows if row.day is not None]
+            i, last = 0, None
+            for n, date in enumerate(dates):
+                while i < len(days) and days[i][0] <= date:
+                    last = days[i]
+                    i += 1
+                value = last[1] if last is not None and (not has_plafond or month_of(last[0]) == month_of(date)) else 0
+                balances[n] += initial + value
+        self.series = [{'date': date, 'balance': balance} for date, balance in zip(dates, balances)]
+
+    def __repr__(self):
+        return "<BalanceSeries: {0} {1} points from {2} to {3}>".format(self.step, len(self.series), self.from_date, self.to_date)
+
+def statement_start(date, day):
+    """First day of the statement cycle starting on day of the month that contains date"""
+    start = datetime.date(date.year, date.month, day)
+    return start if date >= start else start - relativedelta(months=1)
+
+class PlafondHistory:
+    """Used and remaining plafond of an account in each of its last
+    statement cycles, oldest first.
+
+    A cycle runs from statement_day of a month to the day before it in the
+    next month, so a statement_day of 1 gives calendar months. The
+    expenses are grouped by cycle in one query over the whole period."""
+
+    @timed('plafond_history')
+    @db.replica()
+    def __init__(self, account, months=12, statement_day=None, to_date=None):
+        if not account.has_plafond:
+            raise InvalidRequest('Invalid request: the account has no plafond', 400, type = 'NoPlafondError')
+        self.account = account
+        self.plafond = account.plafond or 0
+        self.statement_day = statement_day or account.statement_day or current_app.config.get('PLAFOND_STATEMENT_DAY', 1)
+        last = statement_start(to_date or datetime.date.today(), self.statement_day)
+        starts = [last - relativedelta(months=n) for n in reversed(range(months))]
+
+        # Months since year 0 of the cycle start: the month of the date, or
+        # the one before when the date falls before the statement day
+        cycle = extract('year', Expense.date) * 12 + extract('month', Expense.date) - 1 - case([(extract('day', Expense.date) < self.statement_day, 1)], else_=0)
+        used = dict(db.session.query(cycle, func.sum(Expense.amount)).filter(
+            Expense.user_id == account.user_id,
+            Expense.account_id == account.account_id,
+            Expense.date >= starts[0],
+            Expense.date < last + relativedelta(months=1),
+        ).group_by(cycle))
+
+        self.months = []
+        for start in starts:
+            amount = -(used.get(start.year * 12 + start.month - 1) or 0)
+            self.months.append({
+                'start': start,
+                'end': start + relativedelta(months=1, days=-1),
+                'used': amount,
+                'remaining': self.plafond - amount,
+            })
+
+    def __repr__(self):
+        return "<PlafondHistory: account {0} {1} cycles from day {2}>".format(self.account.account_id, len(self.months), self.statement_day)
+
 class BalanceSchema(ma.Schema):
     current_balance = fields.Int()
     start_period_balance = fields.Int()
     end_period_balance = fields.Int()
-    account = fields.Nested("AccountSchema", exclude=('expenses',))
\ No newline at end of file
+    account = fields.Nested("AccountSchema", exclude=('expenses',))
+
+class BalancePointSchema(ma.Schema):
+    date = fields.Date()
+    balance = fields.Int()
+
+class BalanceSeriesSchema(ma.Schema):
+    step = fields.Str()
+    from_date = fields.Date(dump_to='from')
+    to_date = fields.Date(dump_to='to')
+    series = fields.Nested(BalancePointSchema, many=True)
+    account = fields.Nested("AccountSchema", exclude=('expenses',))
+
+class PlafondMonthSchema(ma.Schema):
+    start = fields.Date()
+    end = fields.Date()
+    used = fields.Int()
+    remaining = fields.Int()
+
+class PlafondHistorySchema(ma.Schema):
+    plafond = fields.Int()
+    statement_day = fields.Int()
+    months = fields.Nested(PlafondMonthSchema, many=True)
+    account = fields.Nested("AccountSchema", exclude=('expenses',))
@@ -1,16 +1,31 @@
 import datetime
+from collections import defaultdict
 
 from marshmallow import fields
+from sqlalchemy import extract
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from sqlalchemy.sql import func
 
 from .. import db
 from .. import ma
+from ..exceptions import InvalidRequest, ValidationApiError
+from ..helpers.filters import FilterSpec, In, Range
 from ..helpers.mixins import ModelMixin
 
 class Expense(ModelMixin, db.Model):
 
-    filters = ['category', 'account_id', 'from', 'to']
+    filters = FilterSpec(
+        In('category'),
+        In('account_id'),
+        Range('date', 'from', 'to'),
+        Range('amount', 'amount_min', 'amount_max'),
+        sort = ('date', 'amount', 'category'),
+    )
 
     __tablename__ = 'expenses'
+    __table_args__ = (
+        db.Index('ix_expenses_user_date_id', 'user_id', 'date', 'expense_id'),
+    )
     
     expense_id = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Integer, nullable=False)
@@ -34,19 +49,193 @@ class Expense(ModelMixin, db.Model):
         return '<Expense: {0} {1} {2} {3}, {4}>'.format(self.date, self.category, self.amount, self.account_id, self.user_id)
 
     @classmethod
-    def filter(self, args):
-        args = args.copy()
-        query = self.query
-        if(args.get('from') is not None): 
-            from_date = datetime.datetime.strptime(args.get('from'), "%Y-%m-%d")
-            query = query.filter(Expense.date >= from_date)
-            del args['from']
-        if(args.get('to') is not None):
-            to_date = datetime.datetime.strptime(args.get('to'), '%Y-%m-%d')
-            query = query.filter(Expense.date <= to_date)
-            del args['to']
-        query = super().filter(args, query)
-        return query
+    def eager(cls, query, many = True, exclude = ()):
+        """Load up front what ExpenseSchema dumps for the requested shape: the
+        nested account columns come from one selectin query for lists and
+        from a join for a single expense"""
+        if 'account' in exclude:
+            return query.options(raiseload(cls.account))
+        strategy = selectinload if many else joinedload
+        return query.options(strategy(cls.account).load_only('name'))
+
+    @classmethod
+    def bulk_create(cls, rows, user_id, schema, chunk_size = 500):
+        """Validate and insert many expenses of a user in a single transaction.
+        Returns the created ids and the errors, both keyed by row index."""
+        from .account import Account
+        for row in rows:
+            if isinstance(row, dict):
+                row['user_id'] = user_id
+        validation = schema(many=True).validate(rows)
+        def valid_account(row):
+            account_id = row.get('account_id')
+            return isinstance(account_id, int) and not isinstance(account_id, bool)
+        account_ids = set(row['account_id'] for i, row in enumerate(rows) if isinstance(row, dict) and i not in validation and valid_account(row))
+        owned = set(a for (a,) in db.session.query(Account.account_id).filter(Account.user_id == user_id, Account.account_id.in_(account_ids))) if account_ids else set()
+        errors = []
+        expenses = []
+        for i, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append({'index': i, 'errors': [{'field': '_schema', 'message': ['Row must be an object.']}]})
+            elif i in validation:
+                errors.append({'index': i, 'errors': [{'field': k, 'message': v} for k, v in validation[i].items()]})
+            elif not valid_account(row):
+                errors.append({'index': i, 'errors': [{'field': 'account_id', 'message': ['Not a valid integer.']}]})
+            elif row['account_id'] not in owned:
+                errors.append({'index': i, 'errors': [{'field': 'account_id', 'message': ['Unknown account.']}]})
+            else:
+                try:
+                    expenses.append((i, cls(**row)))
+                except (TypeError, ValueError) as err:
+                    errors.append({'index': i, 'errors': [{'field': '_schema', 'message': [str(err)]}]})
+        created = []
+        try:
+            for start in range(0, len(expenses), chunk_size):
+                chunk = expenses[start:start + chunk_size]
+                db.session.add_all([expense for i, expense in chunk])
+                db.session.flush()
+                created.extend({'index': i, 'expense_id': expense.expense_id} for i, expense in chunk)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        return created, errors
+
+    # Columns a batch update may change
+    batch_fields = ('amount', 'category', 'date', 'note', 'account_id')
+
+    @classmethod
+    def batch_rows(cls, user_id, ids = None, args = None, limit = None, chunk_size = 500):
+        """Lock the rows of user_id selected by an id list or by the args
+        filter. Returns them with the errors of the ids that are missing
+        (404) or belong to another user (403)."""
+        columns = (cls.expense_id, cls.user_id, cls.account_id, cls.date, cls.amount)
+        if ids is None:
+            if not args:
+                raise InvalidRequest('Either ids or a filter is required', 400, type = 'BatchError')
+            unknown = [k for k in args if k not in cls.filters]
+            if unknown:
+                raise InvalidRequest('Invalid filter: ' + ', '.join(sorted(unknown)), 400, type = 'BatchError')
+            query = cls.filter(args).filter(cls.user_id == user_id).with_entities(*columns).order_by(cls.expense_id).with_for_update()
+            rows = query.limit(limit + 1).all() if limit else query.all()
+            if limit and len(rows) > limit:
+                raise InvalidRequest('Too many expenses', 413, type = 'BatchError')
+            return rows, []
+        ids = list(dict.fromkeys(ids))
+        rows = []
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            rows.extend(db.session.query(*columns).filter(cls.expense_id.in_(chunk), cls.user_id == user_id).order_by(cls.expense_id).with_for_update())
+        owned = set(row.expense_id for row in rows)
+        missing = [i for i in ids if i not in owned]
+        foreign = set()
+        for start in range(0, len(missing), chunk_size):
+            foreign.update(i for (i,) in db.session.query(cls.expense_id).filter(cls.expense_id.in_(missing[start:start + chunk_size])))
+        errors = [{'expense_id': i, 'status': 403 if i in foreign else 404} for i in missing]
+        return rows, errors
+
+    @classmethod
+    def batch_update(cls, user_id, changes, schema, ids = None, args = None, limit = None, chunk_size = 500):
+        """Apply the same changes to many expenses of a user with set-based
+        UPDATEs in a single transaction. Returns the updated ids and the
+        per id errors."""
+        from .account import Account
+        from .snapshot import MonthlySnapshot, month_of
+        from .version import DataVersion
+        if not isinstance(changes, dict) or not changes:
+            raise ValidationApiError('Invalid data', 422, type = 'BatchError', payload = {'changes': ['Missing data.']})
+        unknown = [k for k in changes if k not in cls.batch_fields]
+        if unknown:
+            raise ValidationApiError('Invalid data', 422, type = 'BatchError', payload = dict((k, ['Unknown field.']) for k in unknown))
+        validation = schema(partial=True).validate(changes)
+        if validation:
+            raise ValidationApiError('Invalid data', 422, type = 'ValidationError', payload = validation)
+        changes = dict(changes)
+        if 'date' in changes:
+            changes['date'] = datetime.datetime.strptime(changes['date'], '%Y-%m-%d').date()
+        if 'account_id' in changes and db.session.query(Account.account_id).filter(Account.account_id == changes['account_id'], Account.user_id == user_id).first() is None:
+            raise ValidationApiError('Invalid data', 422, type = 'ValidationError', payload = {'account_id': ['Unknown account.']})
+        try:
+            rows, errors = cls.batch_rows(user_id, ids, args, limit, chunk_size)
+            updated = [row.expense_id for row in rows]
+            if updated:
+                deltas = defaultdict(int)
+                for row in rows:
+                    deltas[(row.account_id, user_id, month_of(row.date))] -= row.amount
+                    account_id = changes.get('account_id', row.account_id)
+                    deltas[(account_id, user_id, month_of(changes.get('date', row.date)))] += int(changes.get('amount', row.amount))
+                for start in range(0, len(updated), chunk_size):
+                    db.session.query(cls).filter(cls.expense_id.in_(updated[start:start + chunk_size])).update(changes, synchronize_session=False)
+                MonthlySnapshot.apply(db.session, deltas)
+                DataVersion.bump(user_id)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        return updated, errors
+
+    @classmethod
+    def batch_delete(cls, user_id, ids = None, args = None, limit = None, chunk_size = 500):
+        """Delete many expenses of a user with set-based DELETEs in a single
+        transaction. Returns the deleted ids and the per id errors."""
+        from .snapshot import MonthlySnapshot, month_of
+        from .version import DataVersion
+        try:
+            rows, errors = cls.batch_rows(user_id, ids, args, limit, chunk_size)
+            deleted = [row.expense_id for row in rows]
+            if deleted:
+                deltas = defaultdict(int)
+                for row in rows:
+                    deltas[(row.account_id, user_id, month_of(row.date))] -= row.amount
+                for start in range(0, len(deleted), chunk_size):
+                    db.session.query(cls).filter(cls.expense_id.in_(deleted[start:start + chunk_size])).delete(synchronize_session=False)
+                MonthlySnapshot.apply(db.session, deltas)
+                DataVersion.bump(user_id)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        return deleted, errors
+
+    @classmethod
+    def summary(cls, query, group_by):
+        """Total and count of the expenses in query, grouped in SQL by the
+        group_by keys (account_id, category, year, month)"""
+        year = extract('year', cls.date)
+        month = extract('month', cls.date)
+        groups = {
+            'account_id': ([cls.account_id], lambda account_id: account_id),
+            'category': ([cls.category], lambda category: category),
+            'year': ([year], lambda y: int(y)),
+            'month': ([year, month], lambda y, m: '{:04d}-{:02d}'.format(int(y), int(m))),
+        }
+        for key in group_by:
+            if key not in groups:
+                raise ValueError('Invalid group: ' + key)
+        columns = [c for key in group_by for c in groups[key][0]]
+        rows = query.with_entities(*(columns + [func.sum(cls.amount), func.count(cls.expense_id)])).group_by(*columns).order_by(None).order_by(*columns).all()
+        summary = []
+        for row in rows:
+            item = {}
+            i = 0
+            for key in group_by:
+                width = len(groups[key][0])
+                item[key] = groups[key][1](*row[i:i + width])
+                i += width
+            item['total'] = int(row[i] or 0)
+            item['count'] = row[i + 1]
+            summary.append(item)
+        return summary
+
+    @classmethod
+    def export_columns(cls):
+        """Columns written by the expenses export, in order"""
+        return (cls.expense_id, cls.date, cls.amount, cls.category, cls.note, cls.account_id)
+
+    @classmethod
+    def cursor_columns(cls):
+        """Columns used to seek through expenses in cursor pagination"""
+        return (cls.date, cls.expense_id)
 
 class ExpenseSchema(ma.ModelSchema):
     account = fields.Nested("AccountSchema", only=('account_id','name', '_links'))
@@ -1,4 +1,82 @@
-from flask_sqlalchemy import SQLAlchemy
+import threading
+from contextlib import contextmanager
 
-db = SQLAlchemy()
+from flask import current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, BaseQuery, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.orm import raiseload
 
+from ..helpers import replica
+
+class GuardedQuery(BaseQuery):
+    """Query raising on lazy loads of relationships that were not loaded
+    explicitly, during requests when RAISE_ON_LAZY_LOAD is set (defaults
+    to testing mode)."""
+
+    _lazy_guard = False
+
+    def __iter__(self):
+        if not self._lazy_guard and has_request_context() and current_app.config.get('RAISE_ON_LAZY_LOAD', current_app.testing):
+            if any(isinstance(d['type'], type) for d in self.column_descriptions):
+                guarded = self.options(raiseload('*'))
+                guarded._lazy_guard = True
+                return guarded.__iter__()
+        return super().__iter__()
+
+class RoutingSession(SignallingSession):
+    """Session sending reads to the replica bind when replica.reads_from_replica()
+    allows it, flushes and everything else to the primary"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is None or not getattr(mapper.mapped_table, 'info', {}).get('bind_key'):
+            bind = replica.replica_bind(self.app)
+            if bind is not None and not self._flushing and replica.reads_from_replica(self):
+                return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with a read replica and per bind engine options:
+    SQLALCHEMY_ENGINE_OPTIONS for the primary, SQLALCHEMY_BIND_OPTIONS[bind]
+    for the binds (pool_size, pool_pre_ping, ...)"""
+
+    def __init__(self, *args, **kwargs):
+        self.__configuring = threading.local()
+        self._inherited_engines = []
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        self.__configuring.bind = bind
+        return super().get_engine(app, bind)
+
+    def reset_engines(self, app):
+        """Give app new engines after a fork. The old pools hold the
+        connections of the parent: they are kept referenced, never used,
+        disposed or garbage collected here, since closing a DBAPI connection
+        in the child (engine.dispose() does on SQLAlchemy 1.3, it has no
+        close=False) would end the session the parent is still using."""
+        state = get_state(app)
+        self._inherited_engines.extend(connector._engine for connector in state.connectors.values() if connector._engine is not None)
+        state.connectors.clear()
+
+    def apply_pool_defaults(self, app, options):
+        super().apply_pool_defaults(app, options)
+        bind = getattr(self.__configuring, 'bind', None)
+        if bind is None:
+            options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        else:
+            options.update((app.config.get('SQLALCHEMY_BIND_OPTIONS') or {}).get(bind, {}))
+
+    @contextmanager
+    def replica(self):
+        """Let the reads of the block go to the replica outside read-only requests too"""
+        info = self.session.info
+        info['replica'] = info.get('replica', 0) + 1
+        try:
+            yield
+        finally:
+            info['replica'] -= 1
+
+db = RoutingSQLAlchemy(query_class=GuardedQuery)
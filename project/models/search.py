@@ -0,0 +1,90 @@
+import re
+import weakref
+
+from sqlalchemy import DDL, and_, bindparam, event, literal_column, or_, select, text
+from sqlalchemy.sql import column, table
+
+from .. import db
+from ..exceptions import InvalidRequest
+from ..models.expense import Expense
+
+# Only the words of a search are kept, so quotes and operators typed by
+# the user cannot break the MATCH syntax
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+# External content FTS5 index over expenses.note and expenses.category, the
+# rowid is the expense_id. Triggers keep it in step with every write,
+# ORM flushes and set-based UPDATE/DELETE alike.
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(note, category, content='expenses', content_rowid='expense_id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN "
+    "INSERT INTO expenses_fts(rowid, note, category) VALUES (new.expense_id, new.note, new.category); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, note, category) VALUES ('delete', old.expense_id, old.note, old.category); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF note, category ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, note, category) VALUES ('delete', old.expense_id, old.note, old.category); "
+    "INSERT INTO expenses_fts(rowid, note, category) VALUES (new.expense_id, new.note, new.category); END",
+)
+SQLITE_REBUILD = "INSERT INTO expenses_fts(expenses_fts) VALUES ('rebuild')"
+
+# InnoDB maintains FULLTEXT indexes on its own
+MYSQL_DDL = "CREATE FULLTEXT INDEX ft_expenses_note_category ON expenses (note, category)"
+
+fts = table('expenses_fts', column('rowid'))
+
+_modes = weakref.WeakKeyDictionary()
+
+def mode(bind):
+    """How the engine searches: 'fts5', 'mysql' or 'like' when there is no full-text index"""
+    engine = getattr(bind, 'engine', bind)
+    if engine not in _modes:
+        if engine.dialect.name == 'mysql':
+            _modes[engine] = 'mysql'
+        elif engine.dialect.name == 'sqlite' and any(row[0] == 'ENABLE_FTS5' for row in engine.execute('PRAGMA compile_options')):
+            _modes[engine] = 'fts5'
+        else:
+            _modes[engine] = 'like'
+    return _modes[engine]
+
+def _uses_fts5(ddl, target, bind, **kw):
+    return mode(bind) == 'fts5'
+
+for statement in SQLITE_DDL:
+    event.listen(Expense.__table__, 'after_create', DDL(statement).execute_if(callable_=_uses_fts5))
+event.listen(Expense.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS expenses_fts').execute_if(callable_=_uses_fts5))
+event.listen(Expense.__table__, 'after_create', DDL(MYSQL_DDL).execute_if(dialect='mysql'))
+
+def match(query, q):
+    """Restrict an Expense query to the rows matching every word of q (as
+    prefixes), newest first"""
+    words = _WORD.findall(q or '')
+    if not words:
+        raise InvalidRequest('Invalid search: q should contain at least one word', 400, type = 'SearchError')
+    search_mode = mode(db.session.get_bind(Expense.__mapper__))
+    if search_mode == 'fts5':
+        # IN (subquery) makes SQLite read the matches from the index first,
+        # a join lets it scan the user's rows and probe the index per row
+        terms = ' '.join('"{}"*'.format(word) for word in words)
+        matches = select([fts.c.rowid]).where(literal_column('expenses_fts').op('MATCH')(bindparam('search_terms', terms)))
+        query = query.filter(Expense.expense_id.in_(matches))
+    elif search_mode == 'mysql':
+        terms = ' '.join('+{}*'.format(word) for word in words)
+        query = query.filter(text('MATCH (expenses.note, expenses.category) AGAINST (:search_terms IN BOOLEAN MODE)').bindparams(search_terms=terms))
+    else:
+        query = query.filter(and_(*[or_(Expense.note.ilike('%' + word + '%'), Expense.category.ilike('%' + word + '%')) for word in words]))
+    return query.order_by(Expense.date.desc(), Expense.expense_id.desc())
+
+def rebuild():
+    """Recreate the full-text index of the existing expenses"""
+    bind = db.session.get_bind(Expense.__mapper__)
+    search_mode = mode(bind)
+    if search_mode == 'fts5':
+        for statement in SQLITE_DDL:
+            db.session.execute(statement)
+        db.session.execute(SQLITE_REBUILD)
+    elif search_mode == 'mysql':
+        indexes = db.session.execute("SHOW INDEX FROM expenses WHERE Key_name = 'ft_expenses_note_category'").fetchall()
+        if not indexes:
+            db.session.execute(MYSQL_DDL)
+    db.session.commit()
+    return search_mode
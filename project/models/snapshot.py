@@ -0,0 +1,101 @@
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import event, extract, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from .. import db
+from ..helpers import upsert
+from ..models.expense import Expense
+from ..models.account import Account
+
+def month_of(date):
+    """First day of the month containing date"""
+    return datetime.date(date.year, date.month, 1)
+
+class MonthlySnapshot(db.Model):
+    """Total amount of the expenses of an account in a calendar month"""
+
+    __tablename__ = 'monthly_snapshots'
+
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.account_id'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<MonthlySnapshot: {0} {1} {2}>'.format(self.account_id, self.month, self.amount)
+
+    @classmethod
+    def apply(cls, session, deltas):
+        """Add the {(account_id, user_id, month): amount} deltas to the snapshots"""
+        for (account_id, user_id, month), delta in sorted(deltas.items()):
+            if delta == 0:
+                continue
+            upsert.increment(session, cls.__table__, {'account_id': account_id, 'month': month}, 'amount', delta, user_id=user_id)
+
+    @classmethod
+    def aggregate(cls, user_id=None):
+        """Monthly totals computed from the raw expenses"""
+        year = extract('year', Expense.date)
+        month = extract('month', Expense.date)
+        query = db.session.query(Expense.account_id, Expense.user_id, year, month, func.sum(Expense.amount)).group_by(Expense.account_id, Expense.user_id, year, month)
+        if user_id is not None:
+            query = query.filter(Expense.user_id == user_id)
+        return {(a, u, datetime.date(int(y), int(m), 1)): total for a, u, y, m, total in query}
+
+    @classmethod
+    def rebuild(cls, user_id=None):
+        """Recompute the snapshots from scratch, returns the number of rows written"""
+        totals = cls.aggregate(user_id)
+        query = cls.query
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        query.delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(cls, [
+            {'account_id': a, 'user_id': u, 'month': m, 'amount': total} for (a, u, m), total in totals.items()
+        ])
+        db.session.commit()
+        return len(totals)
+
+    @classmethod
+    def verify(cls, user_id=None):
+        """List the (account_id, month, expected, stored) snapshots that drifted from the expenses"""
+        expected = {(a, m): total for (a, u, m), total in cls.aggregate(user_id).items()}
+        query = db.session.query(cls.account_id, cls.month, cls.amount)
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        stored = {(a, m): amount for a, m, amount in query}
+        mismatches = []
+        for key in sorted(set(expected) | set(stored)):
+            if expected.get(key, 0) != stored.get(key, 0):
+                mismatches.append((key[0], key[1], expected.get(key, 0), stored.get(key, 0)))
+        return mismatches
+
+def _expense_key(account_id, user_id, date):
+    return (account_id, user_id, month_of(date))
+
+@event.listens_for(Session, 'before_flush')
+def track_expense_changes(session, flush_context, instances):
+    """Keep the monthly snapshots in step with expense writes, inside the same transaction"""
+    deltas = defaultdict(int)
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            deltas[_expense_key(obj.account_id, obj.user_id, obj.date)] += int(obj.amount)
+    for obj in session.deleted:
+        if isinstance(obj, Expense):
+            deltas[_expense_key(obj.account_id, obj.user_id, obj.date)] -= int(obj.amount)
+        elif isinstance(obj, Account):
+            session.query(MonthlySnapshot).filter(MonthlySnapshot.account_id == obj.account_id).delete(synchronize_session=False)
+    for obj in session.dirty:
+        if not isinstance(obj, Expense):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[name].history.has_changes() for name in ('amount', 'date', 'account_id', 'user_id')):
+            continue
+        previous = session.query(Expense.account_id, Expense.user_id, Expense.date, Expense.amount).filter(Expense.expense_id == obj.expense_id).first()
+        if previous is not None:
+            deltas[_expense_key(previous.account_id, previous.user_id, previous.date)] -= previous.amount
+        deltas[_expense_key(obj.account_id, obj.user_id, obj.date)] += int(obj.amount)
+    MonthlySnapshot.apply(session, deltas)
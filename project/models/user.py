@@ -5,7 +5,7 @@ from marshmallow import fields, validates, ValidationError
 
 from .. import db
 from .. import ma
-from .. import bcrypt
+from ..helpers.passwords import hash_password
 from ..helpers.mixins import ModelMixin
 
 class User(ModelMixin, db.Model):
@@ -22,7 +22,7 @@ class User(ModelMixin, db.Model):
     def __init__(self, email, name, password, confirmed=False):
         self.email = email
         self.name = name
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = hash_password(password)
         self.confirmed = confirmed
 
     def __repr__(self):
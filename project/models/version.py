@@ -0,0 +1,55 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .. import db
+from ..helpers import upsert
+from ..helpers.mixins import ModelMixin
+
+class DataVersion(db.Model):
+    """Monotonic counter bumped by every write to the data of a user"""
+
+    __tablename__ = 'data_versions'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DataVersion: {0} {1}>'.format(self.user_id, self.version)
+
+    @classmethod
+    def current(cls, user_id):
+        version = db.session.query(cls.version).filter(cls.user_id == user_id).scalar()
+        return version if version is not None else 0
+
+    @classmethod
+    def bump(cls, user_id, session = None):
+        """Increment the version of user_id inside the current transaction"""
+        session = session if session is not None else db.session
+        upsert.increment(session, cls.__table__, {'user_id': user_id}, 'version', 1)
+        session.info.setdefault('bumped_versions', set()).add(user_id)
+
+    @classmethod
+    def uncommitted(cls, user_id, session = None):
+        """True when the open transaction bumped the version of user_id: a
+        rollback would hand the same number to different data"""
+        session = session if session is not None else db.session
+        return user_id in session.info.get('bumped_versions', ())
+
+@event.listens_for(Session, 'before_flush')
+def bump_data_versions(session, flush_context, instances):
+    """ModelMixin.create/update/delete (and any other ORM write of a model)
+    bump the version of the owning user in the same transaction"""
+    user_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, ModelMixin) and getattr(obj, 'user_id', None) is not None:
+            user_ids.add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, ModelMixin) and getattr(obj, 'user_id', None) is not None and session.is_modified(obj):
+            user_ids.add(obj.user_id)
+    for user_id in sorted(user_ids):
+        DataVersion.bump(user_id, session)
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def forget_bumped_versions(session):
+    session.info.pop('bumped_versions', None)
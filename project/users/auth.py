@@ -1,13 +1,81 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
 from .. import db, email, bcrypt
+from ..helpers.cache import ConfiguredCache
+from ..helpers.metrics import timed
+from ..helpers.passwords import verify_password
 from ..models.user import User, UserSchema
 
+# Shared by the JWT identity handler and the Flask-Login user loader. Every
+# worker keeps its own copy, the TTL bounds how long another worker can
+# serve a stale principal after a change.
+user_cache = ConfiguredCache('USER_CACHE', maxsize=1024, ttl=60, shared=False)
+
+class UserPrincipal():
+    """Detached, read only copy of the User columns needed by request handlers"""
+
+    def __init__(self, user):
+        self.user_id = user.user_id
+        self.email = user.email
+        self.name = user.name
+        self.confirmed = user.confirmed
+        self.created_at = user.created_at
+
+    def __repr__(self):
+        return '<UserPrincipal: {0}>'.format(self.name)
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_active(self):
+        return self.confirmed
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return self.user_id
+
+def load_principal(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    principal = user_cache.get(user_id)
+    if principal is None:
+        user = User.query.filter_by(user_id=user_id).first()
+        if user is None:
+            return None
+        principal = UserPrincipal(user)
+        user_cache.set(user_id, principal)
+    return principal
+
+@timed('auth')
 def authenticate(username, password):
     user = User.query.filter_by(email=username).first()
-    if user and user.confirmed and bcrypt.check_password_hash(user.password, password):
+    if user and user.confirmed and verify_password(user, password):
         return user
 
+@timed('auth')
 def identity(payload):
-    user_id = payload['identity']
-    return User.query.filter_by(user_id=user_id).first()
+    return load_principal(payload['identity'])
+
+@event.listens_for(Session, 'before_flush')
+def track_user_changes(session, flush_context, instances):
+    changed = session.info.setdefault('changed_users', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.user_id)
 
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
 
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_changed_users(session, previous_transaction):
+    session.info.pop('changed_users', None)
@@ -4,6 +4,7 @@ from flask import Blueprint, make_response, jsonify, request, abort, render_temp
 from flask_login import login_user, logout_user, login_required, current_user
 
 from .. import db, email, bcrypt
+from ..helpers.passwords import verify_password
 from ..models.user import User, UserSchema
 from ..token import generate_confirmation_token, confirm_token
 from .forms import RegisterForm, LoginForm
@@ -30,7 +31,7 @@ def user_login():
     if request.method == 'POST':
         if form.validate_on_submit():
             user = User.query.filter_by(email = form.email.data).first()
-            if user is not None and bcrypt.check_password_hash(user.password, form.password.data):
+            if user is not None and verify_password(user, form.password.data):
                 login_user(user)
                 return redirect(url_for('users.home'))
             flash('Invalid credentials.', 'danger')
@@ -74,4 +75,4 @@ def _send_confirmation_email(user):
     expiration_date = '{:%d-%m-%Y %H:%M}'.format(datetime.datetime.utcnow() + datetime.timedelta(hours=1))
     html = render_template('users/email/confirm.html', confirm_url=confirm_url, user=user, expiration_date=expiration_date)
     subject = "Welcome to MyExpense, please confirm your email."
-    email.AsyncEmail(user.email, subject, html).start()
+    email.send_email_async(user.email, subject, html)
@@ -91,6 +91,17 @@ class AccountTests(MainTests, unittest.TestCase):
         response = self.app.get('/api/v1/accounts', headers={'Authorization':'JWT '+ access_token})
         self.assertNotIn(self.new_account_data['plafond'], response.get_json())
 
+    def test_a_new_account_statement_day_is_validated_via_api(self):
+        access_token = self.get_access_token()
+        data = dict(self.new_account_data, has_plafond = 1, plafond = 50000, statement_day = 31)
+        response = self.app.post('/api/v1/accounts', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 422)
+        data['statement_day'] = 15
+        response = self.app.post('/api/v1/accounts', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 201)
+        response = self.app.get('/api/v1/accounts', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(15, response.get_json()[0]['statement_day'])
+
     def test_an_account_can_be_deleted_by_owner_via_api(self):
         access_token = self.get_access_token()
         new_account = self.create_account(user_id=1)
@@ -0,0 +1,124 @@
+# tests/test_analytics.py
+
+import unittest
+import datetime
+
+from myexpense.project.models import analytics
+from myexpense.project.models.account import Account
+from myexpense.project.models.balance import BalanceSeries
+from myexpense.project.models.expense import Expense
+from myexpense.tests.test_main import MainTests
+
+class AnalyticsTests(MainTests, unittest.TestCase):
+
+    # Helpers
+    def create_account(self, plafond = None, has_plafond = 0, name = 'Conto', user_id = 1, initial_balance = 0):
+        new_account = Account(plafond = plafond, has_plafond = has_plafond, name = name, user_id = user_id, initial_balance = initial_balance)
+        self.db.session.add(new_account)
+        self.db.session.commit()
+        return new_account.account_id
+
+    def create_expense(self, amount, date, account_id, category = 'abc', user_id = 1):
+        Expense.create(amount = amount, category = category, date = date, note = 'efg', user_id = user_id, account_id = account_id)
+
+    def seed(self):
+        account_id = self.create_account(initial_balance = 10000)
+        card_id = self.create_account(plafond = 50000, has_plafond = 1, name = 'Carta')
+        self.create_expense(-1000, '2018-01-05', account_id, 'Food')
+        self.create_expense(-3000, '2018-01-05', account_id, 'Food')
+        self.create_expense(-2000, '2018-01-20', account_id, 'Home')
+        self.create_expense(5000, '2018-02-01', account_id, 'Salary')
+        self.create_expense(-700, '2018-01-10', card_id, 'Food')
+        self.create_expense(-300, '2018-02-10', card_id, 'Home')
+        return account_id, card_id
+
+    # Tests
+    def test_columns_are_dictionary_encoded_and_sorted_by_date(self):
+        account_id, card_id = self.seed()
+        columns = analytics.Columns.load(1)
+        self.assertEquals(6, len(columns))
+        self.assertEquals(['Food', 'Home', 'Salary'], columns.category_names)
+        self.assertEquals(sorted(columns.days.tolist()), columns.days.tolist())
+        self.assertEquals([account_id, card_id], columns.account_ids.tolist())
+        self.assertEquals('int64', str(columns.amounts.dtype))
+
+    def test_balance_at_matches_the_balance_series(self):
+        account_id, card_id = self.seed()
+        columns = analytics.Columns.load(1)
+        dates = [datetime.date(2017, 12, 31), datetime.date(2018, 1, 5), datetime.date(2018, 1, 31), datetime.date(2018, 2, 15)]
+        for accounts in (None, [account_id, card_id], [card_id]):
+            series = BalanceSeries(1, datetime.date(2017, 12, 1), datetime.date(2018, 2, 28), accounts=accounts).series
+            expected = [point['balance'] for point in series if point['date'] in dates]
+            self.assertEquals(expected, analytics.balance_at(columns, dates, accounts))
+
+    def test_category_stats_give_percentiles_and_mix(self):
+        account_id, card_id = self.seed()
+        stats = analytics.category_stats(analytics.Columns.load(1), from_date=datetime.date(2018, 1, 1), to_date=datetime.date(2018, 1, 31), accounts=[account_id, card_id])
+        self.assertEquals(['Food', 'Home'], [s['category'] for s in stats])
+        food = stats[0]
+        self.assertEquals(3, food['count'])
+        self.assertEquals(-4700, food['total'])
+        self.assertEquals(-3000, food['min'])
+        self.assertEquals(-700, food['max'])
+        self.assertEquals(-1000, food['p50'])
+        self.assertEquals(-760, food['p90'])
+        self.assertEquals(round(4700 / 6700.0, 4), food['share'])
+
+    def test_reports_leave_out_plafond_accounts_by_default(self):
+        account_id, card_id = self.seed()
+        columns = analytics.Columns.load(1)
+        food = analytics.category_stats(columns, from_date=datetime.date(2018, 1, 1), to_date=datetime.date(2018, 1, 31))[0]
+        self.assertEquals((2, -4000), (food['count'], food['total']))
+        points = analytics.moving_average(columns, datetime.date(2018, 1, 10), datetime.date(2018, 1, 10), window = 1)
+        self.assertEquals([0], [p['total'] for p in points])
+
+    def test_moving_average_includes_the_days_before_the_period(self):
+        account_id, card_id = self.seed()
+        points = analytics.moving_average(analytics.Columns.load(1), datetime.date(2018, 1, 6), datetime.date(2018, 1, 10), window = 3, accounts = [account_id, card_id])
+        self.assertEquals([0, 0, 0, 0, -700], [p['total'] for p in points])
+        self.assertEquals([-1333.33, -1333.33, 0.0, 0.0, -233.33], [p['average'] for p in points])
+
+    def test_columns_are_reloaded_after_a_write(self):
+        account_id, card_id = self.seed()
+        self.assertEquals(6, len(analytics.Columns.cached(1)))
+        self.assertIs(analytics.Columns.cached(1), analytics.Columns.cached(1))
+        self.create_expense(-100, '2018-03-01', account_id)
+        self.assertEquals(7, len(analytics.Columns.cached(1)))
+
+    def test_reports_can_be_retrieved_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        user_id = 1
+        account_id = self.create_account(initial_balance = 10000, user_id = user_id)
+        self.create_expense(-1000, '2018-01-05', account_id, 'Food', user_id)
+        self.create_expense(-500, '2018-01-07', account_id, 'Home', user_id)
+        headers = {'Authorization':'JWT '+ access_token}
+        response = self.app.get('/api/v1/reports/balance?dates=2018-01-04,2018-01-06,2018-01-31', headers=headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([10000, 9000, 8500], [b['balance'] for b in response.get_json()['balances']])
+        response = self.app.get('/api/v1/reports/balance?from=2018-01-01&to=2018-02-15&step=month', headers=headers)
+        self.assertEquals(['2018-01-31', '2018-02-15'], [b['date'] for b in response.get_json()['balances']])
+        response = self.app.get('/api/v1/reports/categories?from=2018-01-01', headers=headers)
+        self.assertEquals([('Food', -1000), ('Home', -500)], [(c['category'], c['total']) for c in response.get_json()['categories']])
+        response = self.app.get('/api/v1/reports/moving-average?from=2018-01-05&to=2018-01-07&window=2&category=Food', headers=headers)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals([-500.0, -500.0, 0.0], [p['average'] for p in response.get_json()['series']])
+        response = self.app.get('/api/v1/reports/moving-average?from=2018-01-05&to=2018-01-07&window=0', headers=headers)
+        self.assertEquals('WindowError', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/reports/balance?from=0001-01-02&to=9999-12-30', headers=headers)
+        self.assertEquals('SeriesTooLong', response.get_json()['error']['type'])
+
+    def test_moving_average_window_is_limited(self):
+        access_token = self.get_access_token()
+        headers = {'Authorization':'JWT '+ access_token}
+        self.projetc_app.config['ANALYTICS_MAX_WINDOW'] = 90
+        try:
+            response = self.app.get('/api/v1/reports/moving-average?from=2018-01-01&to=2018-01-05&window=91', headers=headers)
+            self.assertEquals(400, response.status_code)
+            self.assertEquals('WindowError', response.get_json()['error']['type'])
+            response = self.app.get('/api/v1/reports/moving-average?from=2018-01-01&to=2018-01-05&window=90', headers=headers)
+            self.assertEquals(200, response.status_code)
+        finally:
+            del self.projetc_app.config['ANALYTICS_MAX_WINDOW']
+        response = self.app.get('/api/v1/reports/moving-average?from=2018-01-01&to=2018-01-05&window=10000000', headers=headers)
+        self.assertEquals(400, response.status_code)
+        self.assertEquals('WindowError', response.get_json()['error']['type'])
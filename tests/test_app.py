@@ -0,0 +1,56 @@
+# tests/test_app.py
+
+import os
+import subprocess
+import sys
+import unittest
+
+from myexpense import project
+from myexpense.project.helpers import replica
+from myexpense.project.helpers.passwords import hash_cost
+from myexpense.project.models.user import User
+from myexpense.project.users.auth import user_cache
+from myexpense.tests.test_main import MainTests
+
+class AppTests(MainTests, unittest.TestCase):
+
+    def test_package_import_does_not_build_the_app(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(project.__file__)))
+        code = 'import sys, myexpense.project; print(sorted(m for m in ("myexpense.project.api.api", "flask_jwt", "flask_migrate", "numpy") if m in sys.modules)); print("app" in vars(myexpense.project))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd = os.path.dirname(root), env = dict(os.environ, PYTHONPATH = os.path.dirname(root)))
+        self.assertEquals(['[]', 'False'], output.decode('utf-8').split())
+
+    def test_apps_can_be_created_with_their_own_config(self):
+        other = project.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'BCRYPT_LOG_ROUNDS': 4})
+        self.assertIsNot(other, self.projetc_app)
+        self.assertEquals('sqlite://', other.config['SQLALCHEMY_DATABASE_URI'])
+        self.assertIn('jwt', other.extensions)
+        self.assertIn('api.api_get_balance', other.view_functions)
+        with other.app_context():
+            self.db.create_all()
+            self.db.session.add(User(email = 'other@example.com', name = 'Other', password = 'Secret12', confirmed = True))
+            self.db.session.commit()
+            self.assertEquals(4, hash_cost(User.query.one().password))
+            self.db.session.remove()
+        self.assertEquals(0, User.query.count())
+
+    def test_apps_keep_their_own_caches_and_email_queue(self):
+        email_queue = self.projetc_app.extensions['email_queue']
+        user_cache.set(1, 'cached')
+        other = project.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.assertIs(email_queue, self.projetc_app.extensions['email_queue'])
+        self.assertIsNot(email_queue, other.extensions['email_queue'])
+        for name in ('error_log', 'cache.pagination_count_cache', 'cache.replica_sticky'):
+            self.assertIsNot(self.projetc_app.extensions[name], other.extensions[name])
+        self.assertIsNot(replica.recent_writers(self.projetc_app), replica.recent_writers(other))
+        self.assertEquals('cached', user_cache.get(1))
+        with other.app_context():
+            self.assertIsNone(user_cache.get(1))
+
+    def test_engines_are_recreated_after_a_fork(self):
+        engine = self.db.get_engine(self.projetc_app)
+        self.assertIs(engine, self.db.get_engine(self.projetc_app))
+        self.db.reset_engines(self.projetc_app)
+        self.assertIsNot(engine, self.db.get_engine(self.projetc_app))
+        # The pool of the parent stays referenced, so its connections are never closed
+        self.assertIn(engine, self.db._inherited_engines)
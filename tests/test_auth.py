@@ -1,11 +1,15 @@
 # tests/test_user.py
 
 import os
+import shutil
+import tempfile
 import unittest
 import json
 
 from myexpense.tests.test_main import MainTests
 from myexpense.project.models.user import User
+from myexpense.project.users.auth import user_cache
+from myexpense.project.helpers.passwords import calibrate, hash_cost
 
 class AuthTests(MainTests, unittest.TestCase):
 
@@ -20,4 +24,69 @@ class AuthTests(MainTests, unittest.TestCase):
     def test_cannot_get_user_access_token_with_invalid_credentials(self):
         new_user = self.create_user(confirmed=True)
         response = self.app.post('/auth', data=json.dumps({'username':new_user.email, 'password':'Pippo'}), content_type='application/json')
-        self.assertNotIn("access_token", response.get_json())
\ No newline at end of file
+        self.assertNotIn("access_token", response.get_json())
+
+    def test_user_identity_is_served_from_cache(self):
+        access_token = self.get_access_token()
+        misses = user_cache.misses
+        response = self.app.get('/api/v1/user', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals("access@example.com", response.get_json()['email'])
+        self.assertNotIn('password', response.get_json())
+        hits = user_cache.hits
+        self.app.get('/api/v1/user', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(user_cache.hits, hits + 1)
+        self.assertEquals(user_cache.misses, misses + 1)
+
+    def test_cached_user_identity_is_invalidated_on_update(self):
+        access_token = self.get_access_token()
+        self.app.get('/api/v1/user', headers={'Authorization':'JWT '+ access_token})
+        user = User.query.filter_by(email="access@example.com").first()
+        user.update({"name": "Renamed"})
+        response = self.app.get('/api/v1/user', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals("Renamed", response.get_json()['name'])
+
+    def test_password_hash_cost_is_updated_on_login(self):
+        self.projetc_app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            new_user = self.create_user(confirmed=True)
+            self.assertEquals(4, hash_cost(new_user.password))
+            self.projetc_app.config['BCRYPT_LOG_ROUNDS'] = 5
+            response = self.app.post('/auth', data=json.dumps({'username':'janedoe@example.com', 'password':'Secret12'}), content_type='application/json')
+            self.assertIn("access_token", response.get_json())
+            user = User.query.filter_by(email="janedoe@example.com").first()
+            self.assertEquals(5, hash_cost(user.password))
+            response = self.app.post('/auth', data=json.dumps({'username':'janedoe@example.com', 'password':'Secret12'}), content_type='application/json')
+            self.assertIn("access_token", response.get_json())
+        finally:
+            del self.projetc_app.config['BCRYPT_LOG_ROUNDS']
+
+    def test_bcrypt_cost_can_be_calibrated(self):
+        # 1ms at cost 4, doubling with every round
+        timings = lambda rounds, repeat: 0.001 * 2 ** (rounds - 4)
+        self.assertEquals(4, calibrate(1, min_rounds=4, max_rounds=16, time_hash=timings))
+        self.assertEquals(7, calibrate(10, min_rounds=4, max_rounds=16, time_hash=timings))
+        self.assertEquals(6, calibrate(1000, min_rounds=4, max_rounds=6, time_hash=timings))
+        self.assertEquals(5, calibrate(0.1, min_rounds=5, max_rounds=16, time_hash=timings))
+
+    def test_bcrypt_cost_is_lowered_when_the_estimate_was_too_high(self):
+        # The single hash at the chosen cost is slower than the doubling estimate
+        timings = lambda rounds, repeat: (0.001 if repeat == 3 else 0.0015) * 2 ** (rounds - 4)
+        self.assertEquals(5, calibrate(4, min_rounds=4, max_rounds=16, time_hash=timings))
+
+    def test_bcrypt_cost_is_calibrated_once_into_the_config(self):
+        config_dir = tempfile.mkdtemp()
+        path = os.path.join(config_dir, 'production.py')
+        with open(path, 'w') as f:
+            f.write("SECRET_KEY = 'x'\nBCRYPT_LOG_ROUNDS = 12\n")
+        self.projetc_app.config.update(BCRYPT_MIN_ROUNDS=4, BCRYPT_MAX_ROUNDS=4)
+        try:
+            result = self.projetc_app.test_cli_runner().invoke(args=['bcrypt', 'calibrate', '--target-ms', '1', '--config', path])
+            self.assertEquals(0, result.exit_code)
+            with open(path) as f:
+                self.assertEquals("SECRET_KEY = 'x'\nBCRYPT_LOG_ROUNDS = 4\n", f.read())
+        finally:
+            del self.projetc_app.config['BCRYPT_MIN_ROUNDS']
+            del self.projetc_app.config['BCRYPT_MAX_ROUNDS']
+            shutil.rmtree(config_dir)
+        self.assertNotIn('BCRYPT_LOG_ROUNDS', self.projetc_app.config)
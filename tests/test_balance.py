@@ -6,10 +6,35 @@ import json
 import datetime
 import copy
 
+from sqlalchemy import event
+
 from myexpense.project.models.account import Account
 from myexpense.project.models.expense import Expense
+from myexpense.project.models import balance as balance_module
+from myexpense.project.models.balance import Balance, balance_cache
+from myexpense.project.helpers.cache import SharedCache
+from myexpense.project.models.snapshot import MonthlySnapshot
 from myexpense.tests.test_main import MainTests
 
+class FakeRedis():
+    """Local stand-in for the redis client used by SharedCache"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode('utf-8')
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.data if key.startswith(match.rstrip('*'))]
+
 class AccountTests(MainTests, unittest.TestCase):
 
     # Helpers
@@ -50,4 +75,255 @@ class AccountTests(MainTests, unittest.TestCase):
         amount = new_expense.amount
         response = self.app.get('/api/v1/accounts/'+ str(new_account.account_id) +'/balance', headers={'Authorization':'JWT '+ access_token})
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(amount, response.get_json()['current_balance'])
\ No newline at end of file
+        self.assertEquals(amount, response.get_json()['current_balance'])
+
+    def test_global_balance_sums_non_plafond_accounts_with_period_via_api(self):
+        access_token = self.get_access_token()
+        first_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        second_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        first_account.initial_balance = 10000
+        second_account.initial_balance = 5000
+        self.db.session.commit()
+        second_account_id = second_account.account_id
+        self.create_expense(user_id=1, account_id=first_account.account_id, amount=-1000, date='2018-01-01')
+        self.create_expense(user_id=1, account_id=second_account.account_id, amount=-500, date='2018-02-01')
+        self.create_expense(user_id=1, account_id=card.account_id, amount=-700, date='2018-02-01')
+        response = self.app.get('/api/v1/balance?from=2018-01-15&to=2018-01-31', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(13500, data['current_balance'])
+        self.assertEquals(14000, data['start_period_balance'])
+        self.assertEquals(14000, data['end_period_balance'])
+        response = self.app.get('/api/v1/balance?account_id=' + str(second_account_id), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(4500, response.get_json()['current_balance'])
+
+    def test_plafond_account_balance_uses_the_requested_month_via_api(self):
+        access_token = self.get_access_token()
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        self.create_expense(user_id=1, account_id=card.account_id, amount=-700, date='2018-02-10')
+        self.create_expense(user_id=1, account_id=card.account_id, amount=-300, date='2018-03-10')
+        response = self.app.get('/api/v1/accounts/'+ str(card.account_id) +'/balance?year=2018&month=2', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(50000, data['current_balance'])
+        self.assertEquals(50000, data['start_period_balance'])
+        self.assertEquals(49300, data['end_period_balance'])
+
+    def test_monthly_snapshots_follow_expense_writes(self):
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        expense = Expense.create(amount=-1000, category='abc', date='2018-01-10', user_id=1, account_id=account_id)
+        Expense.create(amount=-500, category='abc', date='2018-01-20', user_id=1, account_id=account_id)
+        self.assertEquals(-1500, MonthlySnapshot.query.get((account_id, datetime.date(2018, 1, 1))).amount)
+        expense.update({'date': datetime.datetime(2018, 2, 5), 'amount': -700})
+        self.assertEquals(-500, MonthlySnapshot.query.get((account_id, datetime.date(2018, 1, 1))).amount)
+        self.assertEquals(-700, MonthlySnapshot.query.get((account_id, datetime.date(2018, 2, 1))).amount)
+        Expense.delete(expense)
+        self.assertEquals(0, MonthlySnapshot.query.get((account_id, datetime.date(2018, 2, 1))).amount)
+        self.assertEquals([], MonthlySnapshot.verify())
+
+    def test_monthly_snapshot_created_concurrently_is_incremented(self):
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        concurrent = []
+
+        def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+            # Another transaction inserts the snapshot between our UPDATE and INSERT
+            if statement.startswith('UPDATE monthly_snapshots') and not concurrent:
+                concurrent.append(True)
+                conn.connection.cursor().execute('INSERT INTO monthly_snapshots (account_id, month, user_id, amount) VALUES (?, ?, ?, ?)', (account_id, '2018-01-01', 1, -300))
+
+        engine = self.db.get_engine()
+        event.listen(engine, 'after_cursor_execute', insert_concurrently)
+        try:
+            Expense.create(amount=-1000, category='abc', date='2018-01-10', user_id=1, account_id=account_id)
+        finally:
+            event.remove(engine, 'after_cursor_execute', insert_concurrently)
+        self.assertEquals([True], concurrent)
+        self.assertEquals(-1300, MonthlySnapshot.query.get((account_id, datetime.date(2018, 1, 1))).amount)
+        self.assertEquals(1, Expense.query.count())
+
+    def test_monthly_snapshots_can_be_verified_and_rebuilt(self):
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        self.create_expense(user_id=1, account_id=account_id, amount=-1000, date='2018-01-10')
+        MonthlySnapshot.query.delete()
+        self.db.session.commit()
+        self.assertEquals([(account_id, datetime.date(2018, 1, 1), -1000, 0)], MonthlySnapshot.verify())
+        self.assertEquals(1, MonthlySnapshot.rebuild())
+        self.assertEquals([], MonthlySnapshot.verify())
+        balance = Balance(1, to_date=datetime.date(2018, 1, 31))
+        self.assertEquals(-1000, balance.end_period_balance)
+
+    def test_balance_is_not_recomputed_until_expenses_change_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token})
+        etag = response.headers['ETag']
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token, 'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        Expense.create(amount=-1000, category='abc', date='2018-01-10', user_id=1, account_id=account_id)
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token, 'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(-1000, response.get_json()['current_balance'])
+
+    def test_balance_is_cached_until_an_expense_or_account_changes(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        self.create_expense(user_id=1, account_id=account_id, amount=-1000)
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token})
+        hits = balance_cache.hits
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(balance_cache.hits, hits + 1)
+        self.assertEquals(-1000, response.get_json()['current_balance'])
+        response = self.app.get('/api/v1/balance?from=2018-01-01&to=2018-12-31', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(balance_cache.hits, hits + 1)
+        self.create_expense(user_id=1, account_id=account_id, amount=-500)
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(-1500, response.get_json()['current_balance'])
+        account = Account.query.get(account_id)
+        account.initial_balance = 2000
+        self.db.session.commit()
+        response = self.app.get('/api/v1/accounts/' + str(account_id) + '/balance', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(500, response.get_json()['current_balance'])
+        response = self.app.get('/api/v1/balance', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(500, response.get_json()['current_balance'])
+
+    def test_balance_is_not_cached_inside_an_uncommitted_write(self):
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        self.db.session.add(Expense(amount=-1000, category='abc', date='2018-01-01', user_id=1, account_id=account_id))
+        self.db.session.flush()
+        self.assertEquals(-1000, Balance.cached(1).current_balance)
+        self.db.session.rollback()
+        self.assertEquals(0, len(balance_cache))
+        self.assertEquals(0, Balance.cached(1).current_balance)
+
+    def test_balance_cache_can_use_a_shared_backend(self):
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        account_id = new_account.account_id
+        self.create_expense(user_id=1, account_id=account_id, amount=-1000)
+        shared = SharedCache(FakeRedis(), prefix='test:')
+        local = balance_module.balance_cache
+        balance_module.balance_cache = shared
+        try:
+            self.assertEquals(-1000, Balance.cached(1, accounts=[account_id]).current_balance)
+            self.assertEquals(-1000, Balance.cached(1, accounts=[account_id]).current_balance)
+            self.assertEquals(1, shared.hits)
+            self.create_expense(user_id=1, account_id=account_id, amount=-500)
+            self.assertEquals(-1500, Balance.cached(1, accounts=[account_id]).current_balance)
+            shared.clear()
+            self.assertEquals({}, shared.client.data)
+        finally:
+            balance_module.balance_cache = local
+
+    def test_balance_series_runs_from_the_snapshots_before_the_period_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        new_account.initial_balance = 10000
+        self.db.session.commit()
+        account_id = new_account.account_id
+        self.create_expense(user_id=1, account_id=account_id, amount=-1000, date='2017-12-20')
+        self.create_expense(user_id=1, account_id=account_id, amount=-500, date='2018-01-10')
+        self.create_expense(user_id=1, account_id=account_id, amount=-200, date='2018-01-16')
+        self.create_expense(user_id=1, account_id=account_id, amount=-300, date='2018-01-16')
+        self.create_expense(user_id=1, account_id=account_id, amount=-100, date='2018-01-20')
+        response = self.app.get('/api/v1/accounts/'+ str(account_id) +'/balance/series?from=2018-01-15&to=2018-01-20', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals('day', data['step'])
+        self.assertEquals(['2018-01-15', '2018-01-16', '2018-01-17', '2018-01-18', '2018-01-19', '2018-01-20'], [point['date'] for point in data['series']])
+        self.assertEquals([8500, 8000, 8000, 8000, 8000, 7900], [point['balance'] for point in data['series']])
+        for point in data['series']:
+            balance = self.app.get('/api/v1/accounts/'+ str(account_id) +'/balance?from=2000-01-01&to=' + point['date'], headers={'Authorization':'JWT '+ access_token})
+            self.assertEquals(point['balance'], balance.get_json()['end_period_balance'])
+
+    def test_balance_series_restarts_plafond_accounts_every_month_via_api(self):
+        access_token = self.get_access_token()
+        account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        account_id, card_id = account.account_id, card.account_id
+        self.create_expense(user_id=1, account_id=account_id, amount=-1000, date='2018-01-05')
+        self.create_expense(user_id=1, account_id=card_id, amount=-700, date='2018-01-10')
+        self.create_expense(user_id=1, account_id=card_id, amount=-300, date='2018-02-10')
+        response = self.app.get('/api/v1/balance/series?from=2018-01-01&to=2018-03-15&step=month', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(['2018-01-31', '2018-02-28', '2018-03-15'], [point['date'] for point in data['series']])
+        self.assertEquals([-1000, -1000, -1000], [point['balance'] for point in data['series']])
+        response = self.app.get('/api/v1/balance/series?from=2018-01-01&to=2018-03-15&step=month&account_id={},{}'.format(account_id, card_id), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([48300, 48700, 49000], [point['balance'] for point in response.get_json()['series']])
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/balance/series?from=2018-01-03&to=2018-01-21&step=week', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(['2018-01-07', '2018-01-14', '2018-01-21'], [point['date'] for point in response.get_json()['series']])
+        self.assertEquals([50000, 49300, 49300], [point['balance'] for point in response.get_json()['series']])
+
+    def test_balance_series_rejects_invalid_params_via_api(self):
+        access_token = self.get_access_token()
+        response = self.app.get('/api/v1/balance/series?step=year', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('StepError', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/balance/series?from=2018-02-01&to=2018-01-01', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        response = self.app.get('/api/v1/balance/series?from=2000-01-01&to=2018-01-01', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('SeriesTooLong', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/balance/series?from=0001-01-02&to=9999-12-30', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals('SeriesTooLong', response.get_json()['error']['type'])
+
+    def test_balance_series_length_is_computed_without_the_dates(self):
+        for from_date, to_date in [('2018-01-01', '2018-01-01'), ('2018-01-03', '2018-03-04'), ('2017-12-31', '2019-02-01'), ('2018-02-01', '2018-01-01')]:
+            from_date = datetime.datetime.strptime(from_date, '%Y-%m-%d').date()
+            to_date = datetime.datetime.strptime(to_date, '%Y-%m-%d').date()
+            for step in balance_module.SERIES_STEPS:
+                self.assertEquals(len(balance_module.series_dates(from_date, to_date, step)), balance_module.series_length(from_date, to_date, step))
+        self.assertEquals(3652059, balance_module.series_length(datetime.date.min, datetime.date.max, 'day'))
+
+    def test_plafond_history_groups_expenses_by_statement_cycle_via_api(self):
+        access_token = self.get_access_token()
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        card_id = card.account_id
+        self.create_expense(user_id=1, account_id=card_id, amount=-700, date='2018-01-10')
+        self.create_expense(user_id=1, account_id=card_id, amount=-300, date='2018-01-20')
+        self.create_expense(user_id=1, account_id=card_id, amount=-1000, date='2018-03-14')
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/plafond?months=3&to=2018-03-20', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(1, data['statement_day'])
+        self.assertEquals(['2018-01-01', '2018-02-01', '2018-03-01'], [month['start'] for month in data['months']])
+        self.assertEquals([1000, 0, 1000], [month['used'] for month in data['months']])
+        self.assertEquals([49000, 50000, 49000], [month['remaining'] for month in data['months']])
+        month = self.app.get('/api/v1/accounts/'+ str(card_id) +'/balance?year=2018&month=1', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(month.get_json()['end_period_balance'], data['months'][0]['remaining'])
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/plafond?months=3&to=2018-03-20&statement_day=15', headers={'Authorization':'JWT '+ access_token})
+        data = response.get_json()
+        self.assertEquals(['2018-01-15', '2018-02-15', '2018-03-15'], [month['start'] for month in data['months']])
+        self.assertEquals(['2018-02-14', '2018-03-14', '2018-04-14'], [month['end'] for month in data['months']])
+        self.assertEquals([300, 1000, 0], [month['used'] for month in data['months']])
+
+    def test_plafond_history_uses_the_account_statement_day_via_api(self):
+        access_token = self.get_access_token()
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        card.statement_day = 20
+        self.db.session.commit()
+        card_id = card.account_id
+        self.create_expense(user_id=1, account_id=card_id, amount=-300, date='2018-01-20')
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/plafond?months=1&to=2018-02-10', headers={'Authorization':'JWT '+ access_token})
+        data = response.get_json()
+        self.assertEquals(20, data['statement_day'])
+        self.assertEquals([{'start': '2018-01-20', 'end': '2018-02-19', 'used': 300, 'remaining': 49700}], data['months'])
+
+    def test_plafond_history_rejects_accounts_without_plafond_and_invalid_params_via_api(self):
+        access_token = self.get_access_token()
+        account = self.create_account(user_id=1, has_plafond=0, plafond=None)
+        card = self.create_account(user_id=1, has_plafond=1, plafond=50000)
+        account_id, card_id = account.account_id, card.account_id
+        response = self.app.get('/api/v1/accounts/'+ str(account_id) +'/plafond', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('NoPlafondError', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/plafond?months=0', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals('MonthsError', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/accounts/'+ str(card_id) +'/plafond?statement_day=31', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals('StatementDayError', response.get_json()['error']['type'])
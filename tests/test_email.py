@@ -0,0 +1,146 @@
+# tests/test_email.py
+
+import unittest
+import threading
+import time
+
+from flask_mail import Message
+
+from myexpense.project.email import EmailQueue
+from myexpense.tests.test_main import MainTests
+
+class FakeConnection():
+    """Local stand-in for a flask_mail SMTP connection"""
+
+    def __init__(self, server):
+        self.server = server
+        self.sent = []
+
+    def __enter__(self):
+        self.server.opened += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.server.closed += 1
+
+    def send(self, msg):
+        self.server.gate.wait()
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            raise ConnectionError('Connection unexpectedly closed')
+        self.sent.append(msg.subject)
+        self.server.delivered.append(msg.subject)
+
+class FakeServer():
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.fail_next = 0
+        self.delivered = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def connect(self):
+        return FakeConnection(self)
+
+class EmailTests(MainTests, unittest.TestCase):
+
+    # Helpers
+    def message(self, subject):
+        return Message(subject, recipients=['janedoe@example.com'], html='<p></p>', sender='noreply@example.com')
+
+    def wait_until(self, condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'condition not met in {}s'.format(timeout))
+            time.sleep(0.001)
+
+    # Tests
+    def test_queued_emails_share_one_connection_per_worker(self):
+        server = FakeServer()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1, batch_size=10)
+        for i in range(25):
+            email_queue.put(self.message('mail {}'.format(i)))
+        self.assertTrue(email_queue.flush(5))
+        self.assertEquals(['mail {}'.format(i) for i in range(25)], server.delivered)
+        self.assertEquals(1, server.opened)
+        email_queue.shutdown()
+        self.assertEquals(1, server.closed)
+        self.assertEquals(25, email_queue.stats()['sent'])
+
+    def test_failed_connection_is_reopened_once(self):
+        server = FakeServer()
+        server.fail_next = 1
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1)
+        email_queue.put(self.message('retry'))
+        email_queue.shutdown()
+        self.assertEquals(['retry'], server.delivered)
+        self.assertEquals(2, server.opened)
+
+    def test_full_queue_drops_the_oldest_email(self):
+        server = FakeServer()
+        server.gate.clear()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1, maxsize=2, batch_size=1, overflow='drop_oldest')
+        email_queue.put(self.message('in flight'))
+        self.wait_until(lambda: not email_queue.stats()['queued'])
+        for subject in ('first', 'second', 'third'):
+            email_queue.put(self.message(subject))
+        server.gate.set()
+        email_queue.shutdown()
+        self.assertEquals(['in flight', 'second', 'third'], server.delivered)
+        self.assertEquals(1, email_queue.stats()['dropped'])
+
+    def test_full_queue_applies_backpressure(self):
+        server = FakeServer()
+        server.gate.clear()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1, maxsize=1, batch_size=1, put_timeout=0.05)
+        email_queue.put(self.message('in flight'))
+        self.wait_until(lambda: not email_queue.stats()['queued'])
+        self.assertTrue(email_queue.put(self.message('queued')))
+        self.assertFalse(email_queue.put(self.message('rejected')))
+        server.gate.set()
+        email_queue.shutdown()
+        self.assertEquals(['in flight', 'queued'], server.delivered)
+
+    def test_shutdown_does_not_block_on_a_full_queue(self):
+        server = FakeServer()
+        server.gate.clear()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1, maxsize=1, batch_size=1)
+        email_queue.put(self.message('in flight'))
+        self.wait_until(lambda: not email_queue.stats()['queued'])
+        email_queue.put(self.message('queued'))
+        started = time.monotonic()
+        email_queue.shutdown(timeout=0.1)
+        self.assertLess(time.monotonic() - started, 1)
+        server.gate.set()
+        email_queue.shutdown()
+        self.assertEquals(['in flight', 'queued'], server.delivered)
+        self.assertEquals(1, server.closed)
+
+    def test_dropping_the_oldest_email_keeps_the_shutdown_sentinel(self):
+        server = FakeServer()
+        server.gate.clear()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=1, maxsize=2, batch_size=1, overflow='drop_oldest')
+        before = set(threading.enumerate())
+        email_queue.put(self.message('in flight'))
+        workers = set(threading.enumerate()) - before
+        self.wait_until(lambda: not email_queue.stats()['queued'])
+        email_queue.put(self.message('first'))
+        email_queue.shutdown(timeout=0.05)
+        # 'second' evicts 'first', 'third' would evict the sentinel and is dropped
+        self.assertTrue(email_queue.put(self.message('second')))
+        self.assertFalse(email_queue.put(self.message('third')))
+        server.gate.set()
+        self.wait_until(lambda: not any(t.is_alive() for t in workers))
+        self.assertEquals(['in flight', 'second'], server.delivered)
+        self.assertEquals(2, email_queue.stats()['dropped'])
+
+    def test_counters_add_up_across_workers(self):
+        server = FakeServer()
+        email_queue = EmailQueue(self.projetc_app, server.connect, workers=8, maxsize=5000, batch_size=1)
+        for i in range(2000):
+            email_queue.put(self.message('mail {}'.format(i)))
+        email_queue.shutdown()
+        self.assertEquals(2000, len(server.delivered))
+        self.assertEquals(2000, email_queue.stats()['sent'])
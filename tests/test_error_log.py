@@ -0,0 +1,77 @@
+# tests/test_error_log.py
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from myexpense.project.helpers import error_log
+from myexpense.project.helpers.error_log import ErrorLog
+from myexpense.tests.test_main import MainTests
+
+class ErrorLogTests(MainTests, unittest.TestCase):
+
+    # Helpers
+    def setUp(self):
+        super().setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'error.log')
+        self.now = 1546300800.0
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        super().tearDown()
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    # Tests
+    def test_lines_are_written_in_background(self):
+        log = ErrorLog(self.path)
+        for i in range(50):
+            log.write('404 NotFound: /api/v1/expenses/{}'.format(i))
+        log.flush()
+        lines = self.read(self.path).splitlines()[1:]
+        self.assertEquals(50, len(lines))
+        self.assertTrue(lines[0].endswith('404 NotFound: /api/v1/expenses/0'))
+        log.close()
+
+    def test_log_is_rotated_by_size(self):
+        log = ErrorLog(self.path, max_bytes=200, backup_count=2)
+        for i in range(12):
+            log.write('500 InternalServerError: {}'.format(i))
+            log.flush()
+        log.close()
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        self.assertLessEqual(os.path.getsize(self.path), 200)
+        self.assertIn('500 InternalServerError: 11', self.read(self.path))
+
+    def test_log_is_rotated_by_time(self):
+        log = ErrorLog(self.path, max_bytes=None, interval=3600, clock=lambda: self.now)
+        log.write('first')
+        log.flush()
+        os.utime(self.path, (self.now, self.now))
+        self.now += 3600
+        log.write('second')
+        log.close()
+        self.assertIn('first', self.read(self.path + '.1'))
+        self.assertNotIn('first', self.read(self.path))
+        self.assertIn('second', self.read(self.path))
+
+    def test_errors_are_logged_when_enabled_outside_debug(self):
+        previous = self.projetc_app.extensions['error_log']
+        self.projetc_app.config['ERROR_LOG_ENABLED'] = True
+        self.projetc_app.config['ERROR_LOG_PATH'] = self.path
+        try:
+            log = error_log.init_app(self.projetc_app)
+            response = self.app.get('/api/v1/user/999')
+            log.close()
+        finally:
+            self.projetc_app.extensions['error_log'] = previous
+            del self.projetc_app.config['ERROR_LOG_ENABLED']
+            del self.projetc_app.config['ERROR_LOG_PATH']
+        self.assertEquals(response.status_code, 404)
+        self.assertIn('404 NotFound: http://localhost/api/v1/user/999', self.read(self.path))
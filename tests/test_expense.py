@@ -6,8 +6,14 @@ import json
 import datetime
 import copy
 
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+
 from myexpense.project.models.account import Account
 from myexpense.project.models.expense import Expense
+from myexpense.project.models import search
+from myexpense.project.models.snapshot import MonthlySnapshot
+from myexpense.project.models.version import DataVersion
 from myexpense.tests.test_main import MainTests
 
 class ExpenseTests(MainTests, unittest.TestCase):
@@ -199,4 +205,358 @@ class ExpenseTests(MainTests, unittest.TestCase):
         new_expense = self.create_expense(user_id=1, account_id=new_account.account_id)
         response = self.app.get('/api/v1/accounts/'+ str(new_account.account_id) +'/expenses/' + str(new_expense.expense_id), headers={'Authorization':'JWT '+ access_token})
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(new_expense.category, response.get_json()['category'])
\ No newline at end of file
+        self.assertEquals(new_expense.category, response.get_json()['category'])
+
+    def test_expenses_can_be_paginated_with_a_cursor_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        for day in range(1, 6):
+            self.create_expense(user_id=1, date='2018-01-0' + str(day), category='c' + str(day))
+        response = self.app.get('/api/v1/expenses?after=&per_page=2', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(['c5', 'c4'], [e['category'] for e in data['expenses']])
+        cursor = data['pagination_metadata']['next']
+        self.assertIsNotNone(cursor)
+        response = self.app.get('/api/v1/expenses?per_page=2&after=' + cursor, headers={'Authorization':'JWT '+ access_token})
+        data = response.get_json()
+        self.assertEquals(['c3', 'c2'], [e['category'] for e in data['expenses']])
+        response = self.app.get('/api/v1/expenses?per_page=2&after=' + data['pagination_metadata']['next'], headers={'Authorization':'JWT '+ access_token})
+        data = response.get_json()
+        self.assertEquals(['c1'], [e['category'] for e in data['expenses']])
+        self.assertIsNone(data['pagination_metadata']['next'])
+        self.assertIsNone(data['pagination_metadata']['_links']['next'])
+
+    def test_expenses_cannot_be_paginated_with_an_invalid_cursor_via_api(self):
+        access_token = self.get_access_token()
+        response = self.app.get('/api/v1/expenses?after=notacursor', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+
+    def test_expenses_cannot_be_paginated_with_a_cursor_and_an_invalid_per_page_via_api(self):
+        access_token = self.get_access_token()
+        self.create_expense(user_id=1)
+        for per_page in ('0', '-1'):
+            response = self.app.get('/api/v1/expenses?after=&per_page=' + per_page, headers={'Authorization':'JWT '+ access_token})
+            self.assertEquals(response.status_code, 400)
+            self.assertEquals('PaginationError', response.get_json()['error']['type'])
+
+    def test_expenses_can_be_posted_in_bulk_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        foreign_account = self.create_account(user_id=2)
+        rows = [
+            dict(amount = 100, category = 'Food', date = '2018-01-01', account_id = new_account.account_id),
+            dict(category = 'Food', date = '2018-01-02', account_id = new_account.account_id),
+            dict(amount = 300, category = 'Food', date = '2018-01-03', account_id = foreign_account.account_id),
+            dict(amount = 400, category = 'Home', date = '2018-01-04', account_id = new_account.account_id, note = 'Rent'),
+        ]
+        response = self.app.post('/api/v1/expenses/bulk', data = json.dumps({'expenses': rows}), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 207)
+        data = response.get_json()
+        self.assertEquals([0, 3], [row['index'] for row in data['created']])
+        self.assertEquals([1, 2], [row['index'] for row in data['errors']])
+        self.assertEquals('amount', data['errors'][0]['errors'][0]['field'])
+        expense = Expense.query.get(data['created'][1]['expense_id'])
+        self.assertEquals('Rent', expense.note)
+        self.assertEquals(1, expense.user_id)
+
+    def test_expenses_cannot_be_posted_in_bulk_without_a_list_via_api(self):
+        access_token = self.get_access_token()
+        response = self.app.post('/api/v1/expenses/bulk', data = json.dumps({'expenses': 'nope'}), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 422)
+
+    def test_expenses_cannot_be_posted_in_bulk_with_an_invalid_account_id_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        rows = [
+            dict(amount = 100, category = 'Food', date = '2018-01-01', account_id = [new_account.account_id]),
+            dict(amount = 200, category = 'Food', date = '2018-01-02', account_id = new_account.account_id),
+        ]
+        response = self.app.post('/api/v1/expenses/bulk', data = json.dumps({'expenses': rows}), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 207)
+        data = response.get_json()
+        self.assertEquals([1], [row['index'] for row in data['created']])
+        self.assertEquals([{'index': 0, 'errors': [{'field': 'account_id', 'message': ['Not a valid integer.']}]}], data['errors'])
+
+    def test_expenses_cannot_be_posted_in_bulk_with_non_object_rows_via_api(self):
+        access_token = self.get_access_token()
+        response = self.app.post('/api/v1/expenses/bulk', data = json.dumps({'expenses': [1, 'x']}), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 422)
+        errors = response.get_json()['errors']
+        self.assertEquals([0, 1], [row['index'] for row in errors])
+        for row in errors:
+            self.assertEquals([{'field': '_schema', 'message': ['Row must be an object.']}], row['errors'])
+
+    def test_expenses_can_be_exported_as_csv_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        self.create_expense(user_id=1, category='Food', date='2018-01-02')
+        self.create_expense(user_id=1, category='Home', date='2018-01-01', note='a, "quoted" note')
+        self.create_expense(user_id=2, category='Other')
+        response = self.app.get('/api/v1/expenses/export?format=csv', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals('text/csv', response.mimetype)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEquals('expense_id,date,amount,category,note,account_id', lines[0])
+        self.assertEquals(3, len(lines))
+        self.assertIn('2018-01-01,1000,Home,"a, ""quoted"" note"', lines[1])
+
+    def test_filtered_expenses_can_be_exported_as_ndjson_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        self.create_expense(user_id=1, category='Food')
+        self.create_expense(user_id=1, category='Home')
+        response = self.app.get('/api/v1/expenses/export?format=ndjson&category=Home', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEquals(1, len(rows))
+        self.assertEquals('Home', rows[0]['category'])
+        self.assertEquals('2018-01-01', rows[0]['date'])
+        response = self.app.get('/api/v1/expenses/export?format=xml', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+
+    def test_expenses_can_be_paginated_without_total_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        for day in range(1, 4):
+            self.create_expense(user_id=1, date='2018-01-0' + str(day))
+        response = self.app.get('/api/v1/expenses?include_total=false&per_page=2', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        data = response.get_json()
+        self.assertEquals(2, len(data['expenses']))
+        self.assertIsNone(data['pagination_metadata']['total'])
+        self.assertIsNone(data['pagination_metadata']['pages'])
+        self.assertIn('page=2', data['pagination_metadata']['_links']['next'])
+        response = self.app.get('/api/v1/expenses?include_total=false&per_page=2&page=2', headers={'Authorization':'JWT '+ access_token})
+        data = response.get_json()
+        self.assertEquals(1, len(data['expenses']))
+        self.assertIsNone(data['pagination_metadata']['_links']['next'])
+
+    def test_expenses_total_can_be_counted_with_a_window_or_cached_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        for day in range(1, 4):
+            self.create_expense(user_id=1, date='2018-01-0' + str(day))
+        for mode in ('window', 'cached', 'cached'):
+            response = self.app.get('/api/v1/expenses?per_page=2&include_total=' + mode, headers={'Authorization':'JWT '+ access_token})
+            self.assertEquals(response.status_code, 200)
+            data = response.get_json()
+            self.assertEquals(3, data['pagination_metadata']['total'])
+            self.assertEquals(2, data['pagination_metadata']['pages'])
+            self.assertEquals(2, len(data['expenses']))
+
+    def test_expenses_summary_can_be_retrieved_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        self.create_expense(user_id=1, category='Food', date='2018-01-05', amount=100)
+        self.create_expense(user_id=1, category='Food', date='2018-01-20', amount=200)
+        self.create_expense(user_id=1, category='Food', date='2018-02-01', amount=50)
+        self.create_expense(user_id=1, category='Home', date='2018-01-10', amount=700)
+        self.create_expense(user_id=2, category='Food', date='2018-01-10', amount=999)
+        response = self.app.get('/api/v1/reports/summary?group_by=category,month', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([
+            {'category': 'Food', 'month': '2018-01', 'total': 300, 'count': 2},
+            {'category': 'Food', 'month': '2018-02', 'total': 50, 'count': 1},
+            {'category': 'Home', 'month': '2018-01', 'total': 700, 'count': 1},
+        ], response.get_json()['summary'])
+        response = self.app.get('/api/v1/reports/summary?group_by=category&from=2018-01-15', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([{'category': 'Food', 'total': 250, 'count': 2}], response.get_json()['summary'])
+        response = self.app.get('/api/v1/reports/summary?group_by=weekday', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+
+    def test_expenses_list_loads_accounts_in_one_query_via_api(self):
+        access_token = self.get_access_token()
+        self.app.get('/api/v1/user', headers={'Authorization':'JWT '+ access_token})
+        queries = []
+        for count in (1, 3):
+            for i in range(count):
+                new_account = self.create_account(user_id=1)
+                self.create_expense(user_id=1, account_id=new_account.account_id)
+            response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals('Carta', response.get_json()['expenses'][0]['account']['name'])
+            queries.append(response.headers['Server-Timing'].split('desc="')[1].split(' ')[0])
+        self.assertEquals(queries[0], queries[1])
+
+    def test_unexpected_lazy_loads_raise_in_testing_mode(self):
+        new_account = self.create_account(user_id=1)
+        self.create_expense(user_id=1, account_id=new_account.account_id)
+        self.db.session.expunge_all()
+        with self.projetc_app.test_request_context('/api/v1/expenses'):
+            expense = Expense.query.first()
+            with self.assertRaises(InvalidRequestError) as raised:
+                expense.account
+            self.assertIn("is not available due to lazy='raise'", str(raised.exception))
+
+    def test_expenses_are_not_resent_until_they_change_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        account_id = new_account.account_id
+        self.create_expense(user_id=1, account_id=account_id)
+        response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token, 'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(b'', response.data)
+        response = self.app.get('/api/v1/expenses?category=abc', headers={'Authorization':'JWT '+ access_token, 'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        data = dict(amount = 5000, category = 'Personal', date = '2018-01-01', note = 'Gasoline', account_id = account_id)
+        response = self.app.post('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 201)
+        response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token, 'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(etag, response.headers['ETag'])
+
+    def test_expenses_can_be_retrieved_by_ids_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        own = self.create_expense(user_id=1, account_id=new_account.account_id).expense_id
+        foreign = self.create_expense(user_id=2).expense_id
+        response = self.app.get('/api/v1/expenses?ids={},{},999'.format(own, foreign), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 207)
+        data = response.get_json()
+        self.assertEquals([own], [e['expense_id'] for e in data['expenses']])
+        self.assertEquals([{'expense_id': foreign, 'status': 403}, {'expense_id': 999, 'status': 404}], data['errors'])
+        response = self.app.get('/api/v1/expenses?ids=a', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+
+    def test_data_version_created_concurrently_is_bumped(self):
+        new_account = self.create_account(user_id=3)
+        concurrent = []
+
+        def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+            # Another transaction creates the version between our UPDATE and INSERT
+            if statement.startswith('UPDATE data_versions') and not concurrent:
+                concurrent.append(True)
+                conn.connection.cursor().execute('INSERT INTO data_versions (user_id, version) VALUES (?, ?)', (1, 5))
+
+        engine = self.db.get_engine()
+        event.listen(engine, 'after_cursor_execute', insert_concurrently)
+        try:
+            self.create_expense(user_id=1, account_id=new_account.account_id)
+        finally:
+            event.remove(engine, 'after_cursor_execute', insert_concurrently)
+        self.assertEquals([True], concurrent)
+        self.assertEquals(6, DataVersion.current(1))
+
+    def test_expenses_can_be_updated_in_batch_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        first_account = self.create_account(user_id=1)
+        second_account = self.create_account(user_id=1)
+        second_account_id = second_account.account_id
+        ids = [self.create_expense(user_id=1, account_id=first_account.account_id, amount=100 * i).expense_id for i in range(1, 4)]
+        foreign = self.create_expense(user_id=2).expense_id
+        version = DataVersion.current(1)
+        data = {'ids': ids[:2] + [foreign], 'changes': {'category': 'Food', 'date': '2018-02-03', 'account_id': second_account_id}}
+        response = self.app.patch('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 207)
+        self.assertEquals(ids[:2], response.get_json()['updated'])
+        self.assertEquals([{'expense_id': foreign, 'status': 403}], response.get_json()['errors'])
+        self.assertEquals(['Food', 'Food', 'abc'], [Expense.query.get(i).category for i in ids])
+        self.assertEquals(datetime.date(2018, 2, 3), Expense.query.get(ids[0]).date)
+        self.assertEquals('abc', Expense.query.get(foreign).category)
+        self.assertEquals(300, MonthlySnapshot.query.get((second_account_id, datetime.date(2018, 2, 1))).amount)
+        self.assertEquals([], MonthlySnapshot.verify())
+        self.assertEquals(version + 1, DataVersion.current(1))
+        data = {'filter': {'category': 'Food'}, 'changes': {'amount': 50}}
+        response = self.app.patch('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(ids[:2], response.get_json()['updated'])
+        self.assertEquals(100, MonthlySnapshot.query.get((second_account_id, datetime.date(2018, 2, 1))).amount)
+        self.assertEquals([], MonthlySnapshot.verify())
+
+    def test_expenses_cannot_be_updated_in_batch_with_invalid_changes_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        foreign_account = self.create_account(user_id=2)
+        expense_id = self.create_expense(user_id=1, account_id=new_account.account_id).expense_id
+        for changes in ({'user_id': 2}, {'amount': 'abc'}, {'account_id': foreign_account.account_id}, {}):
+            data = {'ids': [expense_id], 'changes': changes}
+            response = self.app.patch('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+            self.assertEquals(response.status_code, 422)
+        data = {'filter': {'user_id': 2}, 'changes': {'category': 'Food'}}
+        response = self.app.patch('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('abc', Expense.query.get(expense_id).category)
+
+    def test_expenses_can_be_deleted_in_batch_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        account_id = new_account.account_id
+        ids = [self.create_expense(user_id=1, account_id=account_id, category=c).expense_id for c in ('Food', 'Food', 'Home', 'Car')]
+        response = self.app.delete('/api/v1/expenses', data = json.dumps({'ids': [ids[0], 999]}), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 207)
+        self.assertEquals([ids[0]], response.get_json()['deleted'])
+        self.assertEquals([{'expense_id': 999, 'status': 404}], response.get_json()['errors'])
+        response = self.app.delete('/api/v1/expenses?category=Food,Home', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(ids[1:3], response.get_json()['deleted'])
+        response = self.app.delete('/api/v1/expenses?ids=' + str(ids[3]), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([ids[3]], response.get_json()['deleted'])
+        self.assertEquals(0, Expense.query.filter_by(user_id=1).count())
+        self.assertEquals(0, MonthlySnapshot.query.get((account_id, datetime.date(2018, 1, 1))).amount)
+        self.assertEquals([], MonthlySnapshot.verify())
+        response = self.app.delete('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+
+    def test_expenses_can_be_filtered_by_amount_and_sorted_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        account_id = new_account.account_id
+        for amount, category, date in ((100, 'Food', '2018-01-03'), (500, 'Home', '2018-01-01'), (900, 'Food', '2018-01-02'), (300, 'Car', '2018-01-04')):
+            self.create_expense(user_id=1, account_id=account_id, amount=amount, category=category, date=date)
+        response = self.app.get('/api/v1/expenses?amount_min=200&amount_max=900&sort=-amount', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([900, 500, 300], [e['amount'] for e in response.get_json()['expenses']])
+        response = self.app.get('/api/v1/expenses?category=Food,Car&sort=date&account_id=' + str(account_id), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(['2018-01-02', '2018-01-03', '2018-01-04'], [e['date'] for e in response.get_json()['expenses']])
+        response = self.app.get('/api/v1/expenses?from=2018-01-02&to=2018-01-03&sort=category', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([100, 900], sorted(e['amount'] for e in response.get_json()['expenses']))
+        response = self.app.get('/api/v1/expenses?sort=note', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('SortError', response.get_json()['error']['type'])
+        response = self.app.get('/api/v1/expenses?amount_min=abc', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('FilterError', response.get_json()['error']['type'])
+
+    def test_filters_are_compiled_once_per_query_string_shape(self):
+        first = Expense.filters.plan(Expense, {'category': 'Food,Home', 'amount_min': '10', 'sort': '-date'})
+        second = Expense.filters.plan(Expense, {'category': 'Car,Food,Home', 'amount_min': '99', 'sort': '-date'})
+        self.assertIs(first, second)
+        self.assertIsNot(first, Expense.filters.plan(Expense, {'category': 'Food', 'amount_min': '10', 'sort': '-date'}))
+        first_sql = str(Expense.filter({'category': 'Food,Home', 'to': '2018-01-01'}))
+        second_sql = str(Expense.filter({'category': 'Car,Food', 'to': '2019-01-01'}))
+        self.assertEquals(first_sql, second_sql)
+
+    def test_expenses_can_be_searched_by_owner_via_api(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        account_id = new_account.account_id
+        march = self.create_expense(user_id=1, account_id=account_id, date='2018-03-10', note='Dinner with Anna').expense_id
+        april = self.create_expense(user_id=1, account_id=account_id, date='2018-04-02', note='Team dinner', category='Restaurant').expense_id
+        self.create_expense(user_id=1, account_id=account_id, date='2018-03-12', note='Groceries')
+        self.create_expense(user_id=2, date='2018-03-10', note='Dinner')
+        self.assertEquals('fts5', search.mode(self.db.engine))
+        response = self.app.get('/api/v1/expenses/search?q=dinner', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([april, march], sorted([e['expense_id'] for e in response.get_json()['expenses']], reverse=True))
+        response = self.app.get('/api/v1/expenses/search?q=din%22+ANNA&from=2018-03-01&to=2018-03-31', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([march], [e['expense_id'] for e in response.get_json()['expenses']])
+        response = self.app.get('/api/v1/expenses/search?q=restaurant&account_id=' + str(account_id), headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([april], [e['expense_id'] for e in response.get_json()['expenses']])
+        response = self.app.get('/api/v1/expenses/search?q=%22', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals('SearchError', response.get_json()['error']['type'])
+
+    def test_search_index_follows_expense_writes(self):
+        access_token = self.get_access_token()
+        new_account = self.create_account(user_id=1)
+        account_id = new_account.account_id
+        ids = [self.create_expense(user_id=1, account_id=account_id, note='Dinner').expense_id for i in range(2)]
+        data = {'ids': [ids[0]], 'changes': {'note': 'Lunch'}}
+        self.app.patch('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.app.delete('/api/v1/expenses/' + str(ids[1]), headers={'Authorization':'JWT '+ access_token})
+        response = self.app.get('/api/v1/expenses/search?q=dinner', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([], response.get_json()['expenses'])
+        response = self.app.get('/api/v1/expenses/search?q=lunch', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([ids[0]], [e['expense_id'] for e in response.get_json()['expenses']])
+        self.assertEquals('fts5', search.rebuild())
+        response = self.app.get('/api/v1/expenses/search?q=lunch', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals([ids[0]], [e['expense_id'] for e in response.get_json()['expenses']])
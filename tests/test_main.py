@@ -7,6 +7,9 @@ from datetime import date
 from myexpense import project
 from myexpense.project._config import basedir
 from myexpense.project.models.user import User
+from myexpense.project.users.auth import user_cache
+from myexpense.project.models.balance import balance_cache
+from myexpense.project.models.analytics import columns_cache
 
 TEST_DB = 'test.db'
 
@@ -23,13 +26,19 @@ class MainTests(unittest.TestCase):
         self.projetc_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, TEST_DB)
 
         self.app = self.projetc_app.test_client()
+        self.context = self.projetc_app.app_context()
+        self.context.push()
         self.db.init_app(self.projetc_app)
         self.db.app = self.projetc_app
         self.db.create_all()
+        user_cache.clear()
+        balance_cache.clear()
+        columns_cache.clear()
 
     def tearDown(self):
         self.db.session.remove()
         self.db.drop_all()
+        self.context.pop()
 
     def create_user(self, email = "janedoe@example.com", name = "Jane Doe", password = 'Secret12', confirmed = False):
         new_user = User(email = email, name = name, password = password, confirmed = confirmed)
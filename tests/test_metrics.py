@@ -0,0 +1,66 @@
+# tests/test_metrics.py
+
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from myexpense.project.models.expense import Expense
+from myexpense.tests.test_main import MainTests
+
+class MetricsTests(MainTests, unittest.TestCase):
+
+    # Helpers
+    def create_expense(self, amount = 1000, category = 'abc', date = '2018-01-01', note = 'efg', user_id = 1, account_id = 1):
+        new_expense = Expense(amount = amount, category = category, date = date, note = note, user_id = user_id, account_id = account_id)
+        self.db.session.add(new_expense)
+        self.db.session.commit()
+        return new_expense
+
+    # Tests
+    def test_responses_carry_server_timing(self):
+        access_token = self.get_access_token()
+        self.create_expense()
+        response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        timing = response.headers['Server-Timing']
+        for phase in ('db;', 'auth;', 'pagination;', 'serialize;', 'json;', 'total;'):
+            self.assertIn(phase, timing)
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_metrics_are_aggregated_per_route(self):
+        access_token = self.get_access_token()
+        self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+        self.projetc_app.config['METRICS_TOKEN'] = 'scraper'
+        try:
+            response = self.app.get('/metrics', headers={'Authorization':'Bearer scraper'})
+        finally:
+            del self.projetc_app.config['METRICS_TOKEN']
+        self.assertEquals(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn('myexpense_request_duration_seconds_bucket{method="GET",endpoint="api.api_expenses_get_items",status="200",le="+Inf"}', body)
+        self.assertIn('myexpense_db_queries_total{method="GET",endpoint="api.api_expenses_get_items",status="200"}', body)
+        self.assertIn('myexpense_user_cache{stat="hits"}', body)
+
+    def test_metrics_are_not_served_without_authorization(self):
+        self.assertEquals(404, self.app.get('/metrics').status_code)
+        self.projetc_app.config['METRICS_TOKEN'] = 'scraper'
+        try:
+            self.assertEquals(403, self.app.get('/metrics').status_code)
+            self.assertEquals(403, self.app.get('/metrics', headers={'Authorization':'Bearer other'}).status_code)
+            self.projetc_app.config['METRICS_ALLOWED_IPS'] = ['10.0.0.5']
+            self.assertEquals(403, self.app.get('/metrics').status_code)
+            self.assertEquals(200, self.app.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code)
+        finally:
+            del self.projetc_app.config['METRICS_TOKEN']
+            self.projetc_app.config.pop('METRICS_ALLOWED_IPS', None)
+
+    def test_failed_queries_leave_nothing_on_the_connection(self):
+        connection = self.db.engine.connect()
+        try:
+            for _ in range(3):
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM missing_table')
+            self.assertEquals(1, connection.execute('SELECT 1').scalar())
+            self.assertEquals([], [key for key in connection.info if key == 'query_started'])
+        finally:
+            connection.close()
@@ -0,0 +1,87 @@
+# tests/test_replica.py
+
+import os
+import shutil
+import unittest
+import json
+
+from myexpense.project.helpers import replica
+from myexpense.project.models.account import Account
+from myexpense.project.models.balance import Balance
+from myexpense.project.models.expense import Expense
+from myexpense.tests.test_main import MainTests, TEST_DB
+
+REPLICA_DB = 'replica.db'
+
+class ReplicaTests(MainTests, unittest.TestCase):
+
+    # SetUp and TearDown
+    def setUp(self):
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        self.primary_path = os.path.join(basedir, TEST_DB)
+        self.replica_path = os.path.join(basedir, REPLICA_DB)
+        self.projetc_app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + self.replica_path}
+        self.projetc_app.config['SQLALCHEMY_BIND_OPTIONS'] = {'replica': {'pool_pre_ping': True}}
+        super().setUp()
+        replica.recent_writers(self.projetc_app).clear()
+
+    def tearDown(self):
+        super().tearDown()
+        self.projetc_app.config['SQLALCHEMY_BINDS'] = None
+        self.projetc_app.config['SQLALCHEMY_BIND_OPTIONS'] = None
+        if os.path.exists(self.replica_path):
+            os.remove(self.replica_path)
+
+    # Helpers
+    def create_expense(self, amount = 1000, user_id = 1, account_id = 1):
+        new_expense = Expense(amount = amount, category = 'abc', date = '2018-01-01', note = 'efg', user_id = user_id, account_id = account_id)
+        self.db.session.add(new_expense)
+        self.db.session.commit()
+        return new_expense
+
+    def replicate(self):
+        self.db.session.remove()
+        shutil.copyfile(self.primary_path, self.replica_path)
+
+    def expense_count(self, access_token):
+        response = self.app.get('/api/v1/expenses', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 200)
+        return len(response.get_json()['expenses'])
+
+    # Tests
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        access_token = self.get_access_token()
+        account = Account(name = 'Conto', has_plafond = 0, user_id = 1, initial_balance = 0)
+        self.db.session.add(account)
+        self.db.session.commit()
+        account_id = account.account_id
+        self.create_expense(account_id=account_id)
+        self.replicate()
+        self.create_expense(account_id=account_id)
+        self.db.session.remove()
+        replica.recent_writers(self.projetc_app).clear()
+        self.assertEquals(1, self.expense_count(access_token))
+        data = dict(amount = 5000, category = 'Personal', date = '2018-01-01', note = 'Gasoline', account_id = account_id)
+        response = self.app.post('/api/v1/expenses', data = json.dumps(data), content_type='application/json', headers={'Authorization':'JWT '+ access_token})
+        self.assertEquals(response.status_code, 201)
+        # Requests share the app context of the test, end the session of the write like its teardown would
+        self.db.session.remove()
+        self.assertEquals(3, self.expense_count(access_token))
+        replica.recent_writers(self.projetc_app).clear()
+        self.assertEquals(1, self.expense_count(access_token))
+
+    def test_balance_reads_from_the_replica(self):
+        account = Account(name = 'Conto', has_plafond = 0, user_id = 1, initial_balance = 0)
+        self.db.session.add(account)
+        self.db.session.commit()
+        account_id = account.account_id
+        self.create_expense(amount=-1000, account_id=account_id)
+        self.replicate()
+        self.create_expense(amount=-500, account_id=account_id)
+        self.db.session.remove()
+        self.assertEquals(-1000, Balance(1).current_balance)
+        self.assertEquals(2, Expense.query.count())
+
+    def test_engine_options_are_configured_per_bind(self):
+        self.assertTrue(self.db.get_engine(self.projetc_app, 'replica').pool._pre_ping)
+        self.assertFalse(self.db.get_engine(self.projetc_app).pool._pre_ping)
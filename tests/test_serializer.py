@@ -0,0 +1,54 @@
+# tests/test_serializer.py
+
+import unittest
+import json
+
+from myexpense.project.helpers import serializer
+from myexpense.project.models.account import Account, AccountSchema
+from myexpense.project.models.expense import Expense, ExpenseSchema
+from myexpense.tests.test_main import MainTests
+
+class SerializerTests(MainTests, unittest.TestCase):
+
+    # Helpers
+    def create_account(self, plafond = 150000, has_plafond = 1, name = 'Carta', user_id = 1, initial_balance = None):
+        new_account = Account(plafond = plafond, has_plafond = has_plafond, name = name, user_id = user_id, initial_balance = initial_balance)
+        self.db.session.add(new_account)
+        self.db.session.commit()
+        return new_account
+
+    def create_expense(self, amount = 1000, category = 'abc', date = '2018-01-01', note = 'efg', user_id = 1, account_id = 1):
+        new_expense = Expense(amount = amount, category = category, date = date, note = note, user_id = user_id, account_id = account_id)
+        self.db.session.add(new_expense)
+        self.db.session.commit()
+        return new_expense
+
+    # Tests
+    def test_expenses_are_dumped_like_the_schema(self):
+        new_account = self.create_account()
+        self.create_expense(account_id=new_account.account_id)
+        self.create_expense(account_id=new_account.account_id, note=None, category='àèì')
+        with self.projetc_app.test_request_context('/api/v1/expenses'):
+            expenses = Expense.eager(Expense.query).all()
+            for options in ({}, {'exclude': ('account',)}):
+                expected = ExpenseSchema(many=True, **options).dump(expenses).data
+                self.assertEquals(expected, serializer.dump(ExpenseSchema, expenses, many=True, **options))
+                self.assertEquals(json.dumps(expected, sort_keys=True), json.dumps(serializer.dump(ExpenseSchema, expenses, many=True, **options), sort_keys=True))
+            self.assertEquals(ExpenseSchema().dump(expenses[0]).data, serializer.dump(ExpenseSchema, expenses[0]))
+
+    def test_accounts_are_dumped_like_the_schema(self):
+        self.create_account()
+        self.create_account(plafond=None, has_plafond=0, name='Conto', initial_balance=100)
+        with self.projetc_app.test_request_context('/api/v1/accounts'):
+            accounts = Account.query.all()
+            expected = AccountSchema(many=True, exclude=('expenses', )).dump(accounts).data
+            self.assertEquals(expected, serializer.dump(AccountSchema, accounts, many=True, exclude=('expenses', )))
+
+    def test_links_follow_the_script_root(self):
+        new_account = self.create_account()
+        self.create_expense(account_id=new_account.account_id)
+        with self.projetc_app.test_request_context('/api/v1/expenses', base_url='http://localhost/prefix'):
+            expense = Expense.eager(Expense.query, many=False).first()
+            links = serializer.dump(ExpenseSchema, expense)['_links']
+            self.assertEquals('/prefix/api/v1/expenses/' + str(expense.expense_id), links['self'])
+            self.assertEquals('/prefix/api/v1/expenses', links['collection'])